@@ -0,0 +1,255 @@
+import sys
+import json
+import time
+from pathlib import Path
+from multiprocessing import get_context
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from guv_calcs.room import Room
+from guv_calcs.lamp import Lamp
+from guv_calcs.calc_zone import CalcPlane, CalcVol
+from app import _pool
+from app._calculate import calculate_room
+from app._engine import room_results, standard_zones
+from app._fetch import local_lamp_files
+from app._photometry import WEIGHTS_URL, load_lamp_file, load_lamp_spectra
+from app._placement import get_lamp_position
+from app._spectral import get_weightings
+
+BATCH_PROCESSES = _pool.CALC_PROCESSES
+PARQUET_ROW_GROUP = 64  # results buffered before each parquet row group is written
+ZONE_TYPES = {"plane": CalcPlane, "volume": CalcVol}
+
+# result fields with one value per room, and their parquet types
+SCALAR_COLUMNS = {
+    "id": "string",
+    "error": "string",
+    "elapsed": "float64",
+    "fluence_mean": "float64",
+    "eACH_mean": "float64",
+    "ozone_ppb": "float64",
+    "volume_ft3": "float64",
+    "skin_max": "float64",
+    "eye_max": "float64",
+    "skin_hours_to_tlv_mono": "float64",
+    "eye_hours_to_tlv_mono": "float64",
+    "skin_hours_to_tlv": "float64",
+    "eye_hours_to_tlv": "float64",
+    "hours_to_tlv_mono": "float64",
+    "hours_to_tlv": "float64",
+}
+# result fields that vary in shape from room to room; JSON strings in parquet
+NESTED_COLUMNS = ["eACH", "zones", "missing_spectra"]
+
+
+def read_specs(path):
+    """
+    (spec_id, spec, base_dir) for every room spec under `path`: a .jsonl file
+    of one spec per line, a .json file holding a spec or a list of them, or a
+    directory of such files. specs without an "id" are named after their file,
+    and their position in it if it holds more than one. lamp and spectrum
+    paths in a spec are relative to its file's directory.
+    """
+    path = Path(path)
+    if path.is_dir():
+        for child in sorted(path.iterdir()):
+            if child.suffix.lower() in [".json", ".jsonl"]:
+                yield from read_specs(child)
+        return
+    if path.suffix.lower() == ".jsonl":
+        with open(path) as f:
+            specs = [json.loads(line) for line in f if line.strip()]
+        single = False
+    else:
+        specs = json.loads(path.read_text())
+        single = not isinstance(specs, list)
+        specs = [specs] if single else specs
+    for i, spec in enumerate(specs):
+        default_id = path.stem if single else f"{path.stem}:{i}"
+        yield spec.get("id", default_id), spec, str(path.parent)
+
+
+def build_room(spec, base_dir="."):
+    """
+    a Room, ready to calculate, from a spec of the form
+
+        {"room": {Room keyword arguments, e.g. "x", "y", "z", "units", "standard"},
+         "lamps": [{"file": bundled lamp name, or path to an ies file,
+                    "spectrum": path to a spectrum csv, or null for none,
+                    "x", "y", "z", "aim": [x, y, z], "tilt", "orientation",
+                    "rotation", "lamp_id", "name", "enabled"}],
+         "zones": [{"type": "plane" or "volume", "zone_id",
+                    CalcPlane or CalcVol keyword arguments}],
+         "standard_zones": true}
+
+    everything but each lamp's "file" is optional. lamps default to the same
+    positions and orientation as `Add Luminaire` gives them; bundled lamps
+    default to their bundled spectrum. the whole room fluence and skin/eye
+    limit zones are added unless "standard_zones" is false.
+    """
+    room = Room(**spec.get("room", {}))
+    if spec.get("standard_zones", True):
+        for zone in standard_zones(room):
+            room.add_calc_zone(zone)
+    for i, lamp_spec in enumerate(spec.get("lamps", [])):
+        room.add_lamp(_build_lamp(room, i + 1, lamp_spec, Path(base_dir)))
+    for zone_spec in spec.get("zones", []):
+        zone_spec = dict(zone_spec)
+        zone_type = zone_spec.pop("type", "plane")
+        room.add_calc_zone(ZONE_TYPES[zone_type](**zone_spec))
+    return room
+
+
+def _build_lamp(room, lamp_idx, lamp_spec, base_dir):
+    """a Lamp from one entry of a spec's "lamps", with photometry loaded"""
+    x, y = get_lamp_position(lamp_idx=lamp_idx, x=room.x, y=room.y)
+    lamp_id = lamp_spec.get("lamp_id", f"Lamp{lamp_idx}")
+    lamp = Lamp(
+        lamp_id=lamp_id,
+        name=lamp_spec.get("name", lamp_id),
+        x=lamp_spec.get("x", x),
+        y=lamp_spec.get("y", y),
+        z=lamp_spec.get("z", room.z - 0.1),
+        enabled=lamp_spec.get("enabled"),
+        spectral_weight_source=WEIGHTS_URL,
+        spectral_weightings=get_weightings(),
+    )
+    if "aim" in lamp_spec:
+        lamp.aim(*lamp_spec["aim"])
+    else:
+        lamp.set_tilt(lamp_spec.get("tilt", 0))
+        lamp.set_orientation(lamp_spec.get("orientation", 0))
+    lamp.rotate(lamp_spec.get("rotation", 0))
+
+    ies_path, spectrum_path = _lamp_files(lamp_spec, base_dir)
+    load_lamp_file(lamp, filename=ies_path.stem, filedata=ies_path.read_bytes())
+    if spectrum_path is not None:
+        load_lamp_spectra(lamp, spectrum_path.read_bytes())
+    return lamp
+
+
+def _lamp_files(lamp_spec, base_dir):
+    """(ies path, spectrum path or None) named by a lamp spec"""
+    bundled = local_lamp_files()
+    if lamp_spec["file"] in bundled:
+        ies_path, spectrum_path = bundled[lamp_spec["file"]]
+    else:
+        ies_path, spectrum_path = base_dir / lamp_spec["file"], None
+    if "spectrum" in lamp_spec:
+        spectrum = lamp_spec["spectrum"]
+        spectrum_path = None if spectrum is None else base_dir / spectrum
+    return ies_path, spectrum_path
+
+
+def evaluate_spec(spec_id, spec, base_dir="."):
+    """
+    build, calculate and summarize one room spec. a spec that can't be built
+    or calculated gives a result with only its id and the error, rather than
+    raising, so one bad room doesn't stop a batch.
+    """
+    started = time.perf_counter()
+    try:
+        room = calculate_room(build_room(spec, base_dir))
+        results = room_results(room)
+    except Exception as e:
+        return {"id": spec_id, "error": f"{type(e).__name__}: {e}"}
+    elapsed = time.perf_counter() - started
+    return {"id": spec_id, "error": None, "elapsed": elapsed, **results}
+
+
+def _init_worker():
+    # rooms are what's spread over the processes here, so each worker
+    # evaluates its rooms' zones itself rather than through a pool of its own
+    _pool.CALC_PROCESSES = 1
+
+
+def run_batch(specs, processes=BATCH_PROCESSES):
+    """
+    calculate every (spec_id, spec, base_dir) in `specs`, yielding each result
+    as soon as it's ready - in order of completion, not of `specs`.
+
+    rooms are spread over `processes` worker processes. each keeps its own
+    photometry registry and contribution cache, so lamps and zones that recur
+    across rooms are only parsed and evaluated once per worker. with a single
+    process, rooms are calculated here, in order.
+    """
+    if processes <= 1:
+        for spec in specs:
+            yield evaluate_spec(*spec)
+        return
+    executor = ProcessPoolExecutor(
+        max_workers=processes,
+        mp_context=get_context("spawn"),
+        initializer=_init_worker,
+    )
+    futures = [executor.submit(evaluate_spec, *spec) for spec in specs]
+    try:
+        for future in as_completed(futures):
+            yield future.result()
+    finally:
+        # if we're stopped early, don't start anything that hasn't started yet
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+class JsonlWriter:
+    """Writes each result as a line of JSON, to a file or stdout, as it arrives."""
+
+    def __init__(self, path=None):
+        self._file = sys.stdout if path is None else open(path, "w")
+
+    def write(self, result):
+        self._file.write(json.dumps(result) + "\n")
+        self._file.flush()
+
+    def close(self):
+        if self._file is not sys.stdout:
+            self._file.close()
+
+
+class ParquetWriter:
+    """
+    Writes results to a parquet file a row group at a time, so results reach
+    the disk while the batch is still running. Every room gets the same
+    columns: the nested fields (per-species eACH, zone stats, lamps without
+    spectra) are stored as JSON strings.
+    """
+
+    def __init__(self, path, row_group=PARQUET_ROW_GROUP):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError as e:
+            raise ImportError("Parquet output requires pyarrow") from e
+        self._pa = pa
+        fields = [pa.field(key, dtype) for key, dtype in SCALAR_COLUMNS.items()]
+        fields += [pa.field(key, "string") for key in NESTED_COLUMNS]
+        self.schema = pa.schema(fields)
+        self.row_group = row_group
+        self._rows = []
+        self._writer = pq.ParquetWriter(path, self.schema)
+
+    def write(self, result):
+        row = {key: result.get(key) for key in SCALAR_COLUMNS}
+        for key in NESTED_COLUMNS:
+            row[key] = json.dumps(result[key]) if key in result else None
+        self._rows.append(row)
+        if len(self._rows) >= self.row_group:
+            self._flush()
+
+    def _flush(self):
+        if self._rows:
+            table = self._pa.Table.from_pylist(self._rows, schema=self.schema)
+            self._writer.write_table(table)
+            self._rows = []
+
+    def close(self):
+        self._flush()
+        self._writer.close()
+
+
+def open_writer(path=None, fmt=None):
+    """a result writer for `path`; parquet if `fmt` says so or it ends .parquet"""
+    if fmt is None:
+        fmt = "parquet" if str(path).endswith(".parquet") else "jsonl"
+    if fmt == "parquet":
+        return ParquetWriter(path)
+    return JsonlWriter(path)
@@ -0,0 +1,304 @@
+import io
+import os
+import sys
+import json
+import time
+import platform
+import statistics
+from importlib import metadata
+from functools import lru_cache
+from datetime import datetime, timezone
+from app._batch import build_room
+from app._calculate import ContributionCache, calculate_room
+from app._disinfection import room_volume_ft3
+from app._engine import get_weighted_hours_to_tlv
+from app._placement import PlacementSequence, get_lamp_position
+
+BENCH_VERSION = 1
+BENCH_REPEATS = 5
+# a benchmark whose best time is this much slower than the baseline's is flagged
+REGRESSION_THRESHOLD = 0.25
+# the bundled luminaire every benchmark room is made of; its spectrum is bundled too
+BENCH_LAMP = "uvpro222_b1"
+BENCH_ROOM = {"x": 6, "y": 4, "z": 2.7}
+BENCH_SPACINGS = [0.2, 0.1, 0.05]
+BENCH_LAMP_COUNTS = [1, 4, 16]
+BENCH_PLACEMENTS = [4, 16, 64]
+# how long to wait for the app's background calculation before giving up
+APP_CALC_TIMEOUT = 300
+
+
+def bench_room(num_lamps=1, spacing=None):
+    """
+    the benchmark room with `num_lamps` of the bundled luminaire in their
+    usual new-lamp positions, and every zone's grid at `spacing` if given
+    """
+    room = build_room({"room": BENCH_ROOM, "lamps": [{"file": BENCH_LAMP}] * num_lamps})
+    if spacing is not None:
+        for zone in room.calc_zones.values():
+            if zone.calctype == "Volume":
+                zone.set_spacing(
+                    x_spacing=spacing, y_spacing=spacing, z_spacing=spacing
+                )
+            else:
+                zone.set_spacing(x_spacing=spacing, y_spacing=spacing)
+    return room
+
+
+class Benchmark:
+    """
+    One timed operation. `setup` is called before every repeat, untimed, and
+    whatever it returns is passed to `run`, which is what's timed - so each
+    repeat can start from a cold cache or a fresh room.
+    """
+
+    def __init__(self, name, run, setup=None):
+        self.name = name
+        self.run = run
+        self.setup = setup or (lambda: None)
+
+    def time(self, repeats=BENCH_REPEATS):
+        times = []
+        for _ in range(repeats):
+            state = self.setup()
+            start = time.perf_counter()
+            self.run(state)
+            times.append(time.perf_counter() - start)
+        return {
+            "min": min(times),
+            "median": statistics.median(times),
+            "mean": statistics.mean(times),
+            "stdev": statistics.stdev(times) if len(times) > 1 else 0.0,
+            "repeats": len(times),
+            "times": times,
+        }
+
+
+@lru_cache(maxsize=None)
+def _calculated(num_lamps):
+    """the benchmark room, calculated, for benchmarks that only read results"""
+    return calculate_room(bench_room(num_lamps), cache=ContributionCache())
+
+
+@lru_cache(maxsize=None)
+def _warm_cache(num_lamps):
+    """the benchmark room and a cache that already holds everything it needs"""
+    cache = ContributionCache()
+    return calculate_room(bench_room(num_lamps), cache=cache), cache
+
+
+def _calculate_benchmarks():
+    benchmarks = []
+    for spacing in BENCH_SPACINGS:
+        for num_lamps in BENCH_LAMP_COUNTS:
+            params = f"spacing={spacing},lamps={num_lamps}"
+            # guv_calcs' own calculation, for reference, and the app's
+            benchmarks.append(
+                Benchmark(
+                    f"calculate[reference,{params}]",
+                    lambda room: room.calculate(),
+                    setup=lambda n=num_lamps, s=spacing: bench_room(n, s),
+                )
+            )
+            benchmarks.append(
+                Benchmark(
+                    f"calculate[cold,{params}]",
+                    lambda room: calculate_room(room, cache=ContributionCache()),
+                    setup=lambda n=num_lamps, s=spacing: bench_room(n, s),
+                )
+            )
+    # recalculating an unchanged room, with everything cached
+    benchmarks.append(
+        Benchmark(
+            "calculate[warm,lamps=4]",
+            lambda state: calculate_room(state[0], cache=state[1]),
+            setup=lambda: _warm_cache(4),
+        )
+    )
+    return benchmarks
+
+
+def _results_benchmarks():
+    # these need streamlit and matplotlib, but no session
+    from app._plot import plot_species
+    from app._website_helpers import get_disinfection_table
+
+    def fluence(room):
+        return room.calc_zones["WholeRoomFluence"].values.mean()
+
+    def species(room):
+        fig = plot_species(fluence(room), room_volume_ft3(room))
+        fig.savefig(io.BytesIO(), format="png")  # as st.pyplot does
+
+    benchmarks = [
+        Benchmark(
+            "disinfection_table",
+            lambda room: get_disinfection_table(fluence(room), room),
+            setup=lambda: _calculated(4),
+        ),
+        Benchmark("plot_species", species, setup=lambda: _calculated(4)),
+    ]
+    for num_lamps in BENCH_LAMP_COUNTS:
+        benchmarks.append(
+            Benchmark(
+                f"weighted_hours_to_tlv[lamps={num_lamps}]",
+                get_weighted_hours_to_tlv,
+                setup=lambda n=num_lamps: _calculated(n),
+            )
+        )
+    return benchmarks
+
+
+def _placement_benchmarks():
+    benchmarks = []
+    for num_lamps in BENCH_PLACEMENTS:
+        # working the sequence out from scratch, as for a new grid size
+        benchmarks.append(
+            Benchmark(
+                f"placement[cold,lamps={num_lamps}]",
+                lambda seq, n=num_lamps: seq.extend(n),
+                setup=lambda: PlacementSequence((100, 100)),
+            )
+        )
+        # every position looked up, as when adding lamps one by one
+        benchmarks.append(
+            Benchmark(
+                f"placement[warm,lamps={num_lamps}]",
+                lambda _, n=num_lamps: [
+                    get_lamp_position(i, BENCH_ROOM["x"], BENCH_ROOM["y"])
+                    for i in range(1, n + 1)
+                ],
+            )
+        )
+    return benchmarks
+
+
+def _wait_for_calculation(at):
+    job = at.session_state["calc_job"]
+    deadline = time.monotonic() + APP_CALC_TIMEOUT
+    while job.running and time.monotonic() < deadline:
+        time.sleep(0.1)
+    if job.running:
+        raise TimeoutError("The app's calculation didn't finish in time")
+
+
+def _app_benchmarks():
+    from streamlit.testing.v1 import AppTest
+
+    def fresh():
+        return AppTest.from_file("guv_app.py", default_timeout=APP_CALC_TIMEOUT)
+
+    def calculated():
+        """a session with one luminaire, calculated, and its results showing"""
+        at = fresh().run()
+        [b for b in at.button if b.label == "Add Luminaire"][0].click().run()
+        at.selectbox(key="file_Lamp1").set_value(
+            at.session_state["lampfile_options"][1]
+        )
+        at.run()
+        [b for b in at.button if b.label == "Calculate!"][0].click().run()
+        _wait_for_calculation(at)
+        return at.run()
+
+    return [
+        Benchmark("app[first_run]", lambda at: at.run(), setup=fresh),
+        Benchmark("app[rerun,results]", lambda at: at.run(), setup=calculated),
+    ]
+
+
+SUITES = {
+    "calculate": _calculate_benchmarks,
+    "results": _results_benchmarks,
+    "placement": _placement_benchmarks,
+    "app": _app_benchmarks,
+}
+
+
+def run_benchmarks(suites=None, match=None, repeats=BENCH_REPEATS, log=None):
+    """
+    {name: timings} for every benchmark in `suites` (default: all) whose name
+    contains `match`. `log` is called with each benchmark's name and timings
+    as it finishes.
+    """
+    results = {}
+    for suite in suites or SUITES:
+        for benchmark in SUITES[suite]():
+            if match is not None and match not in benchmark.name:
+                continue
+            results[benchmark.name] = benchmark.time(repeats)
+            if log is not None:
+                log(benchmark.name, results[benchmark.name])
+    return results
+
+
+def environment():
+    """what a run's timings depend on, besides the code"""
+    packages = {}
+    for package in ["numpy", "guv_calcs", "streamlit", "matplotlib"]:
+        try:
+            packages[package] = metadata.version(package)
+        except metadata.PackageNotFoundError:
+            packages[package] = None
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "packages": packages,
+        "calc_processes": os.environ.get("GUV_CALC_PROCESSES"),
+        "argv": sys.argv,
+    }
+
+
+def save_results(results, path):
+    """write a run's timings, and the environment they were taken in, as JSON"""
+    report = {
+        "version": BENCH_VERSION,
+        "created": datetime.now(timezone.utc).isoformat(),
+        "environment": environment(),
+        "results": results,
+    }
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+
+
+def load_results(path):
+    """the timings from a file written by `save_results`"""
+    with open(path) as f:
+        report = json.load(f)
+    if report.get("version") != BENCH_VERSION:
+        raise ValueError(f"{path} is not a version {BENCH_VERSION} benchmark file")
+    return report["results"]
+
+
+def compare(results, baseline, threshold=REGRESSION_THRESHOLD):
+    """
+    [{"name", "baseline", "current", "ratio", "status"}] comparing the best
+    time of each benchmark against the baseline's. status is "regression" if
+    it's more than `threshold` slower, "improvement" if more than `threshold`
+    faster, "ok" otherwise, or "new"/"missing" if only one run has it.
+    """
+    rows = []
+    for name in list(baseline) + [name for name in results if name not in baseline]:
+        old = baseline.get(name, {}).get("min")
+        new = results.get(name, {}).get("min")
+        ratio = new / old if old and new is not None else None
+        if old is None:
+            status = "new"
+        elif new is None:
+            status = "missing"
+        elif ratio > 1 + threshold:
+            status = "regression"
+        elif ratio < 1 / (1 + threshold):
+            status = "improvement"
+        else:
+            status = "ok"
+        rows.append(
+            {
+                "name": name,
+                "baseline": old,
+                "current": new,
+                "ratio": ratio,
+                "status": status,
+            }
+        )
+    return rows
@@ -0,0 +1,251 @@
+import os
+import json
+import hashlib
+import logging
+import threading
+from functools import lru_cache
+from collections import OrderedDict
+from pathlib import Path
+from ._catalog import CACHE_DIR
+from ._metrics import get_metrics, stats_gauges
+from ._fetch import fetch_bytes, fetch_many, local_fallback, UpstreamUnavailable
+
+logger = logging.getLogger(__name__)
+
+BLOB_DIR = CACHE_DIR / "blobs"
+MAX_DISK_BYTES = 512 * 1024 ** 2
+MAX_MEMORY_BYTES = 64 * 1024 ** 2
+
+
+def content_hash(data):
+    """content address used for every blob"""
+    return hashlib.sha256(data).hexdigest()
+
+
+class BlobCache:
+    """
+    Two-tier cache for downloaded lamp files, keyed by URL and content hash.
+
+    `url -> sha256` is kept in memory and in an index file next to the blobs;
+    the bytes themselves live on disk under their hash, so two URLs serving the
+    same file are stored once. The disk tier is an LRU bounded by
+    `max_disk_bytes`, and the most recently used blobs are also held in memory
+    up to `max_memory_bytes`. Concurrent misses on the same URL only fetch once.
+    The lamp catalog drops a URL's mapping when that lamp's record changes, so
+    a file replaced upstream is fetched again.
+    """
+
+    def __init__(
+        self,
+        directory=BLOB_DIR,
+        max_disk_bytes=MAX_DISK_BYTES,
+        max_memory_bytes=MAX_MEMORY_BYTES,
+    ):
+        self.directory = Path(directory)
+        self.max_disk_bytes = max_disk_bytes
+        self.max_memory_bytes = max_memory_bytes
+
+        self._lock = threading.RLock()
+        self._inflight = {}  # url -> lock held while that url is being fetched
+        self._urls = {}  # url -> hash
+        self._disk = OrderedDict()  # hash -> size, least recently used first
+        self._memory = OrderedDict()  # hash -> bytes, least recently used first
+        self.disk_bytes = 0
+        self.memory_bytes = 0
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._scan()
+
+    def get(self, url, fetch=None):
+        """return the bytes at `url`, fetching them only if no tier has them"""
+        data = self._lookup(url)
+        if data is not None:
+            return data
+        with self._lock:
+            url_lock = self._inflight.setdefault(url, threading.Lock())
+        with url_lock:
+            # somebody else may have fetched it while we waited
+            data = self._lookup(url, count_miss=True)
+            if data is None:
+                fetch = fetch_bytes if fetch is None else fetch
+                data = fetch(url)
+                self.put(url, data)
+        with self._lock:
+            self._inflight.pop(url, None)
+        return data
+
+    def put(self, url, data):
+        """store `data` as the content of `url`; returns its content hash"""
+        digest = content_hash(data)
+        with self._lock:
+            if digest not in self._disk:
+                self._write_blob(digest, data)
+            else:
+                self._disk.move_to_end(digest)
+            self._urls[url] = digest
+            self._remember(digest, data)
+            self._save_index()
+        return digest
+
+    def get_by_hash(self, digest):
+        """return a blob by its content hash, or None"""
+        with self._lock:
+            return self._read(digest)
+
+    def forget(self, *urls):
+        """drop the url -> hash mappings, e.g. if the upstream files changed"""
+        with self._lock:
+            for url in urls:
+                self._urls.pop(url, None)
+            self._save_index()
+
+    def stats(self):
+        """hit/miss counters and tier sizes, for sizing the cache"""
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        hit_rate = (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": hit_rate,
+            "evictions": self.evictions,
+            "memory_bytes": self.memory_bytes,
+            "memory_blobs": len(self._memory),
+            "disk_bytes": self.disk_bytes,
+            "disk_blobs": len(self._disk),
+            "urls": len(self._urls),
+        }
+
+    def _lookup(self, url, count_miss=False):
+        with self._lock:
+            digest = self._urls.get(url)
+            data = None if digest is None else self._read(digest)
+            if data is None and count_miss:
+                self.misses += 1
+            return data
+
+    def _read(self, digest):
+        """read from memory, then disk, updating recency and counters"""
+        if digest in self._memory:
+            self._memory.move_to_end(digest)
+            self._disk.move_to_end(digest)
+            self.memory_hits += 1
+            return self._memory[digest]
+        if digest not in self._disk:
+            return None
+        path = self.directory / digest
+        try:
+            data = path.read_bytes()
+        except OSError:
+            self._drop(digest)
+            return None
+        if content_hash(data) != digest:
+            logger.warning(f"Discarding corrupt cached blob {digest}")
+            self._drop(digest)
+            return None
+        os.utime(path)  # keep disk recency across restarts
+        self._disk.move_to_end(digest)
+        self._remember(digest, data)
+        self.disk_hits += 1
+        return data
+
+    def _remember(self, digest, data):
+        """add to the in-memory tier, evicting the least recently used"""
+        if len(data) > self.max_memory_bytes:
+            return
+        if digest not in self._memory:
+            self._memory[digest] = data
+            self.memory_bytes += len(data)
+        self._memory.move_to_end(digest)
+        while self.memory_bytes > self.max_memory_bytes:
+            _, old = self._memory.popitem(last=False)
+            self.memory_bytes -= len(old)
+
+    def _write_blob(self, digest, data):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.directory / f"{digest}.tmp"
+        tmp_path.write_bytes(data)
+        tmp_path.replace(self.directory / digest)
+        self._disk[digest] = len(data)
+        self.disk_bytes += len(data)
+        while self.disk_bytes > self.max_disk_bytes and len(self._disk) > 1:
+            old = next(iter(self._disk))
+            self._drop(old)
+            self.evictions += 1
+
+    def _drop(self, digest):
+        """remove a blob from every tier and from the url index"""
+        size = self._disk.pop(digest, 0)
+        self.disk_bytes -= size
+        data = self._memory.pop(digest, None)
+        if data is not None:
+            self.memory_bytes -= len(data)
+        self._urls = {k: v for k, v in self._urls.items() if v != digest}
+        try:
+            (self.directory / digest).unlink()
+        except OSError:
+            pass
+
+    def _scan(self):
+        """rebuild the disk LRU and url index from whatever is already on disk"""
+        if not self.directory.is_dir():
+            return
+        blobs = [p for p in self.directory.iterdir() if p.is_file() and p.suffix == ""]
+        for path in sorted(blobs, key=lambda p: p.stat().st_mtime):
+            size = path.stat().st_size
+            self._disk[path.name] = size
+            self.disk_bytes += size
+        index_path = self.directory / "index.json"
+        if index_path.is_file():
+            try:
+                with open(index_path, "r") as f:
+                    urls = json.load(f)
+                self._urls = {k: v for k, v in urls.items() if v in self._disk}
+            except (OSError, ValueError) as e:
+                logger.warning(f"Ignoring unreadable blob cache index: {e}")
+
+    def _save_index(self):
+        try:
+            tmp_path = self.directory / "index.json.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(self._urls, f)
+            tmp_path.replace(self.directory / "index.json")
+        except OSError as e:
+            logger.warning(f"Could not write blob cache index: {e}")
+
+
+@lru_cache(maxsize=None)
+def get_blob_cache():
+    """the one BlobCache shared by every session in this process"""
+    cache = BlobCache()
+    get_metrics().add_collector(
+        lambda: stats_gauges("process_blob_cache", cache.stats(), "Lamp file cache")
+    )
+    return cache
+
+
+def fetch_vendored_file(url):
+    """
+    bytes of a vendored ies or spectrum file, served from cache when possible.
+    if the upstream is unreachable, fall back to the matching bundled file.
+    """
+    if not url.startswith(("http://", "https://")):
+        return Path(url).read_bytes()
+    try:
+        return get_blob_cache().get(url)
+    except UpstreamUnavailable:
+        local_path = local_fallback(url)
+        if local_path is None:
+            raise
+        logger.warning(f"Upstream unavailable, using bundled {local_path}")
+        return local_path.read_bytes()
+
+
+def fetch_lamp_files(ies_url, spectra_url=None):
+    """fetch a lamp's ies file and spectrum in parallel; returns (fdata, spectra_data)"""
+    fdata, spectra_data = fetch_many([ies_url, spectra_url], fetch=fetch_vendored_file)
+    return fdata, spectra_data
@@ -0,0 +1,360 @@
+import copy
+import time
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from pathlib import Path
+import numpy as np
+from guv_calcs.calc_zone import CalcPlane, CalcVol
+from app._blob_cache import content_hash
+from app._engine import TLV_ZONES
+from app._metrics import count, get_metrics, stats_gauges
+from app._pool import evaluate_zone_parallel
+
+CONTRIBUTION_CACHE_BYTES = 512 * 1024 ** 2
+# progressive calculations start from a grid of about this many points per zone
+COARSE_POINTS = 2000
+
+
+class CalculationCancelled(Exception):
+    """raised inside a calculation once its job has been cancelled"""
+
+
+class DeadlineExceeded(CalculationCancelled):
+    """raised inside a calculation once its deadline has passed"""
+
+
+def photometry_hash(lamp):
+    """content hash of the lamp's ies file, or None if it has none"""
+    digest = getattr(lamp, "photometry_hash", None)
+    if digest is None and isinstance(lamp.filedata, bytes):
+        digest = content_hash(lamp.filedata)
+    elif digest is None and isinstance(lamp.filedata, (str, Path)):
+        digest = content_hash(Path(lamp.filedata).read_bytes())
+    return digest
+
+
+def lamp_key(lamp):
+    """everything about a lamp that affects the values it contributes to a zone"""
+    return (
+        photometry_hash(lamp),
+        float(lamp.x),
+        float(lamp.y),
+        float(lamp.z),
+        float(lamp.angle),
+        float(lamp.heading),
+        float(lamp.bank),
+        lamp.intensity_units,
+    )
+
+
+def zone_key(zone):
+    """everything about a zone's grid and value type that affects its values"""
+    key = (
+        zone.calctype,
+        zone.x1,
+        zone.x2,
+        zone.y1,
+        zone.y2,
+        zone.x_spacing,
+        zone.y_spacing,
+        zone.offset,
+        zone.fov80,
+        zone.vert,
+        zone.horiz,
+        zone.dose,
+        zone.hours,
+    )
+    if isinstance(zone, CalcPlane):
+        key += (zone.height,)
+    elif isinstance(zone, CalcVol):
+        key += (zone.z1, zone.z2, zone.z_spacing)
+    return key
+
+
+def _calc_zones(room):
+    """the zones a calculation actually evaluates"""
+    return [
+        zone
+        for zone in room.calc_zones.values()
+        if zone.enabled and isinstance(zone, (CalcPlane, CalcVol))
+    ]
+
+
+def room_key(room):
+    """fingerprint of the parts of a room that a calculation depends on"""
+    lamps = tuple(
+        (lamp.lamp_id, lamp_key(lamp))
+        for lamp in room.lamps.values()
+        if lamp.enabled and lamp.filedata is not None
+    )
+    zones = tuple((zone.zone_id, zone_key(zone)) for zone in _calc_zones(room))
+    return (lamps, zones)
+
+
+def snapshot_room(room):
+    """
+    copy of a room that is safe to calculate on while the original keeps being
+    edited. lamp photometry and zone grids are shared rather than copied, since
+    they're only ever replaced, never modified in place.
+    """
+    snapshot = copy.copy(room)
+    snapshot.lamps = {}
+    for lamp_id, lamp in room.lamps.items():
+        new_lamp = copy.copy(lamp)
+        new_lamp.position = lamp.position.copy()
+        new_lamp.aim_point = lamp.aim_point.copy()  # Lamp.move updates it in place
+        new_lamp.max_irradiances = {}
+        snapshot.lamps[lamp_id] = new_lamp
+    snapshot.calc_zones = {
+        zone_id: copy.copy(zone) for zone_id, zone in room.calc_zones.items()
+    }
+    return snapshot
+
+
+def _num_points(zone, factor=1):
+    """roughly how many points a zone has with its spacing scaled by `factor`"""
+    return np.prod(zone.num_points) / factor ** len(zone.num_points)
+
+
+def stage_factors(room):
+    """
+    grid spacing multipliers for the stages of a progressive calculation,
+    coarsest first: starting from whatever brings every zone down to about
+    COARSE_POINTS points, and halving down to 1, the requested spacing.
+    """
+    zones = _calc_zones(room)
+    factor = 1
+    while factor < 64 and any(_num_points(z, factor) > COARSE_POINTS for z in zones):
+        factor *= 2
+    factors = [1]
+    while factors[0] < factor:
+        factors.insert(0, factors[0] * 2)
+    return factors
+
+
+def stage_points(room, factor):
+    """approximate number of points evaluated by a stage, for weighting progress"""
+    return sum(_num_points(zone, factor) for zone in _calc_zones(room))
+
+
+def coarsen_zone(zone, factor):
+    """scale a zone's grid spacing up by `factor`, in place"""
+    # never coarser than two points along any axis
+    spacing = {
+        "x_spacing": min(zone.x_spacing * factor, (zone.x2 - zone.x1) / 2),
+        "y_spacing": min(zone.y_spacing * factor, (zone.y2 - zone.y1) / 2),
+    }
+    if isinstance(zone, CalcVol):
+        spacing["z_spacing"] = min(zone.z_spacing * factor, (zone.z2 - zone.z1) / 2)
+    zone.set_spacing(**spacing)
+    return zone
+
+
+def coarsen_room(room, factor):
+    """snapshot of `room` with every zone's grid spacing scaled up by `factor`"""
+    coarse = snapshot_room(room)
+    for zone in _calc_zones(coarse):
+        coarsen_zone(zone, factor)
+    return coarse
+
+
+def upsample_results(coarse, room):
+    """
+    fill `room`'s zones with the values of the matching zones of a coarsened
+    copy, each point taking the value of the nearest coarse point
+    """
+    for zone in _calc_zones(room):
+        coarse_zone = coarse.calc_zones[zone.zone_id]
+        idx = np.ix_(
+            *[
+                np.abs(np.subtract.outer(coarse_points, points)).argmin(axis=0)
+                for coarse_points, points in zip(coarse_zone.points, zone.points)
+            ]
+        )
+        zone.values = coarse_zone.values[idx]
+        lamp_values = getattr(coarse_zone, "lamp_values", None)
+        zone.lamp_values = lamp_values and {
+            lamp_id: values[idx] for lamp_id, values in lamp_values.items()
+        }
+    for lamp_id, lamp in coarse.lamps.items():
+        room.lamps[lamp_id].max_irradiances = dict(lamp.max_irradiances)
+    return room
+
+
+def result_summary(room):
+    """the headline numbers of a calculated room, for comparing stages"""
+    summary = {}
+    for zone_id, stat in [
+        ("WholeRoomFluence", np.mean),
+        ("SkinLimits", np.max),
+        ("EyeLimits", np.max),
+    ]:
+        zone = room.calc_zones.get(zone_id)
+        if zone is not None and zone.values is not None:
+            summary[zone_id] = float(stat(zone.values))
+    return summary
+
+
+def summary_error(summary, previous):
+    """
+    relative change of each headline number since the previous stage - an
+    estimate of how far the previous stage was from converged, and so an upper
+    estimate for this one
+    """
+    return {
+        key: abs(val - previous[key]) / abs(val) if val else 0.0
+        for key, val in summary.items()
+        if key in previous
+    }
+
+
+class ContributionCache:
+    """
+    Process-wide LRU of each lamp's contribution to each zone.
+
+    Entries are keyed by (lamp_key, zone_key) - the lamp's photometry hash and
+    pose, and the zone's grid definition - and hold the lamp's value grid for
+    that zone along with its max irradiance. Moving one lamp therefore only
+    invalidates that lamp's entries; every other lamp/zone pair is re-summed
+    from cache. Bounded by `max_bytes`; arrays are stored read-only.
+    """
+
+    def __init__(self, max_bytes=CONTRIBUTION_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (values, max_irradiance)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, values, max_irradiance):
+        values = np.asarray(values)
+        values.setflags(write=False)
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = (values, max_irradiance)
+            self.nbytes += values.nbytes
+            while self.nbytes > self.max_bytes and len(self._entries) > 1:
+                _, (old, _) = self._entries.popitem(last=False)
+                self.nbytes -= old.nbytes
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "bytes": self.nbytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+@lru_cache(maxsize=None)
+def get_contribution_cache():
+    """the one ContributionCache shared by every session in this process"""
+    cache = ContributionCache()
+    get_metrics().add_collector(
+        lambda: stats_gauges(
+            "process_contribution_cache", cache.stats(), "Contribution cache"
+        )
+    )
+    return cache
+
+
+def calculate_room(room, progress=None, cancel_event=None, cache=None, deadline=None):
+    """
+    equivalent to `room.calculate()`, but with each lamp's contribution to each
+    zone cached. only lamp/zone pairs whose keys have changed since they were
+    last seen are actually computed - all together, by the batched kernel, with
+    large zones tiled across the process pool - and the rest are re-summed from
+    `cache`, which defaults to the process-wide ContributionCache.
+
+    `progress` is called as progress(fraction, message). if `cancel_event` is
+    set partway through, CalculationCancelled is raised and the room should be
+    thrown away; likewise DeadlineExceeded once `time.monotonic()` passes
+    `deadline`.
+
+    each lamp's `max_irradiances` entry is the max of that lamp's own
+    contribution to the zone. the skin and eye zones' `lamp_values` hold every
+    lamp's own grid, {lamp_id: values}, or None if they were too big to keep;
+    other zones' are None, as only the TLV needs them.
+    """
+    zones = _calc_zones(room)
+    lamps = [
+        lamp
+        for lamp in room.lamps.values()
+        if lamp.filedata is not None and lamp.enabled
+    ]
+    cache = get_contribution_cache() if cache is None else cache
+    lamp_keys = {lamp.lamp_id: lamp_key(lamp) for lamp in lamps}
+    hits = misses = 0
+
+    for i, zone in enumerate(zones):
+        this_zone_key = zone_key(zone)
+        total_values = np.zeros(zone.num_points)
+        lamp_values = {}
+        missing = []
+        for lamp in lamps:
+            entry = cache.get((lamp_keys[lamp.lamp_id], this_zone_key))
+            if entry is None:
+                missing.append(lamp)
+                continue
+            hits += 1
+            values, max_irradiance = entry
+            lamp.max_irradiances[zone.zone_id] = max_irradiance
+            lamp_values[lamp.lamp_id] = values
+            total_values = total_values + values
+
+        def on_chunk(fraction):
+            if cancel_event is not None and cancel_event.is_set():
+                raise CalculationCancelled
+            if deadline is not None and time.monotonic() > deadline:
+                raise DeadlineExceeded
+            if progress is not None:
+                progress((i + fraction) / len(zones), zone.name)
+
+        if missing:
+            misses += len(missing)
+            # only keep per-lamp grids if the cache could actually hold them
+            per_lamp = len(missing) * zone.coords.shape[0] * 8 <= cache.max_bytes
+            values, new_total, maxes = evaluate_zone_parallel(
+                missing, zone, per_lamp=per_lamp, on_chunk=on_chunk
+            )
+            for lamp in missing:
+                lamp.max_irradiances[zone.zone_id] = maxes[lamp.lamp_id]
+                if per_lamp:
+                    key = (lamp_keys[lamp.lamp_id], this_zone_key)
+                    cache.put(key, values[lamp.lamp_id], maxes[lamp.lamp_id])
+                    lamp_values[lamp.lamp_id] = values[lamp.lamp_id]
+            if not per_lamp:
+                lamp_values = None
+            total_values = total_values + new_total
+        else:
+            on_chunk(1.0)
+        zone.values = total_values
+        if zone.zone_id not in TLV_ZONES:
+            lamp_values = None
+        # in lamp order, so keys line up with the room's lamps
+        zone.lamp_values = lamp_values and {
+            lamp.lamp_id: lamp_values[lamp.lamp_id] for lamp in lamps
+        }
+    count("guv_contribution_cache_hits_total", hits)
+    count("guv_contribution_cache_misses_total", misses)
+    if progress is not None:
+        progress(1.0, "Done")
+    return room
@@ -0,0 +1,218 @@
+import json
+import time
+import logging
+import threading
+from functools import lru_cache
+from pathlib import Path
+from ._metrics import get_metrics, stats_gauges
+from ._fetch import http_get, local_lamp_files, UpstreamUnavailable
+
+logger = logging.getLogger(__name__)
+
+BASE_URL = "https://assay.osluv.org/static/assay"
+INDEX_URL = f"{BASE_URL}/index.json"
+CATALOG_TTL = 600  # seconds before the index is revalidated against the server
+CACHE_DIR = Path(".cache")
+SNAPSHOT_PATH = CACHE_DIR / "catalog.json"
+
+
+class LampCatalog:
+    """
+    Process-wide copy of the assay.osluv.org lamp index.
+
+    All sessions read from the same snapshot. Once the snapshot is older than
+    `ttl` seconds, the next read kicks off a refresh in a background thread and
+    keeps returning the last good snapshot until the refresh lands. Refreshes
+    are conditional requests (ETag / If-Modified-Since), so an unchanged index
+    costs a 304 and no parsing. The last good snapshot is also written to disk,
+    so a restarted process can serve immediately and revalidate in the background.
+    """
+
+    def __init__(self, url=INDEX_URL, ttl=CATALOG_TTL, snapshot_path=SNAPSHOT_PATH):
+        self.url = url
+        self.ttl = ttl
+        self.snapshot_path = None if snapshot_path is None else Path(snapshot_path)
+
+        self._lock = threading.Lock()
+        self._refreshing = False
+        self._snapshot = None  # (index_data, ies_files, spectra)
+        self.etag = None
+        self.last_modified = None
+        self.checked_at = None  # time.monotonic() of last successful check
+        self.num_fetches = 0
+        self.num_not_modified = 0
+        self.num_errors = 0
+
+        self._load_snapshot()
+
+    def get(self):
+        """return (index_data, ies_files, spectra), refreshing in the background if stale"""
+        if self._snapshot is None:
+            # nothing to serve yet, so the very first reads have to wait, on
+            # one fetch between them
+            with self._lock:
+                if self._snapshot is None:
+                    try:
+                        self.refresh()
+                    except UpstreamUnavailable as e:
+                        # serve the bundled files; the next read will try the
+                        # server again
+                        logger.warning(
+                            f"Lamp catalog unavailable, using bundled files: {e}"
+                        )
+                        self._set_index(_local_index())
+        elif self.is_stale():
+            self.refresh_async()
+        return self._snapshot
+
+    def is_stale(self):
+        """true if the snapshot hasn't been checked against the server within the ttl"""
+        if self.checked_at is None:
+            return True
+        return time.monotonic() - self.checked_at > self.ttl
+
+    def refresh_async(self):
+        """start a background refresh unless one is already in flight"""
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        thread = threading.Thread(
+            target=self._refresh_quietly, name="lamp-catalog-refresh", daemon=True
+        )
+        thread.start()
+
+    def refresh(self):
+        """revalidate the index against the server, blocking until done"""
+        headers = {}
+        if self._snapshot is not None:
+            # only send validators if we actually have something to fall back on
+            if self.etag is not None:
+                headers["If-None-Match"] = self.etag
+            if self.last_modified is not None:
+                headers["If-Modified-Since"] = self.last_modified
+
+        response = http_get(self.url, headers=headers)
+        if response.status_code == 304:
+            self.num_not_modified += 1
+        else:
+            response.raise_for_status()
+            index_data = response.json()
+            self.etag = response.headers.get("ETag")
+            self.last_modified = response.headers.get("Last-Modified")
+            previous = self._snapshot
+            self._set_index(index_data)
+            self._save_snapshot()
+            if previous is not None:
+                self._forget_changed(previous)
+            self.num_fetches += 1
+        self.checked_at = time.monotonic()
+        return self._snapshot
+
+    def _refresh_quietly(self):
+        """background refresh target; failures leave the last good snapshot in place"""
+        try:
+            self.refresh()
+        except Exception as e:
+            self.num_errors += 1
+            logger.warning(f"Lamp catalog refresh failed, serving last snapshot: {e}")
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+    def _set_index(self, index_data):
+        """build the name -> url lookups and swap the whole snapshot in at once"""
+        ies_files = {}
+        spectra = {}
+        for guid, data in index_data.items():
+            name = data["reporting_name"]
+            if "ies_path" in data:
+                # bundled file, see _local_index
+                ies_files[name] = data["ies_path"]
+                spectra[name] = data["spectra_path"]
+            else:
+                filename = data["slug"]
+                ies_files[name] = f"{BASE_URL}/{filename}.ies"
+                spectra[name] = f"{BASE_URL}/{filename}-spectrum.csv"
+        self._snapshot = (index_data, ies_files, spectra)
+
+    def _forget_changed(self, previous):
+        """
+        drop cached downloads of lamps whose record changed or went away, so a
+        file replaced upstream under the same url is fetched again
+        """
+        from ._blob_cache import get_blob_cache  # which imports this module
+
+        old_index, old_ies, old_spectra = previous
+        index_data = self._snapshot[0]
+        urls = []
+        for guid, data in old_index.items():
+            if index_data.get(guid) == data:
+                continue
+            name = data.get("reporting_name")
+            urls += [old_ies.get(name), old_spectra.get(name)]
+        urls = [url for url in urls if url and url.startswith(("http://", "https://"))]
+        if urls:
+            get_blob_cache().forget(*urls)
+
+    def _load_snapshot(self):
+        """load the last snapshot written to disk, if there is one"""
+        if self.snapshot_path is None or not self.snapshot_path.is_file():
+            return
+        try:
+            with open(self.snapshot_path, "r") as f:
+                data = json.load(f)
+            self.etag = data.get("etag")
+            self.last_modified = data.get("last_modified")
+            self._set_index(data["index_data"])
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"Ignoring unreadable lamp catalog snapshot: {e}")
+
+    def _save_snapshot(self):
+        """write the current snapshot to disk so a restart can serve it immediately"""
+        if self.snapshot_path is None:
+            return
+        data = {
+            "index_data": self._snapshot[0],
+            "etag": self.etag,
+            "last_modified": self.last_modified,
+        }
+        try:
+            self.snapshot_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.snapshot_path.with_suffix(".tmp")
+            with open(tmp_path, "w") as f:
+                json.dump(data, f)
+            tmp_path.replace(self.snapshot_path)
+        except OSError as e:
+            logger.warning(f"Could not write lamp catalog snapshot: {e}")
+
+
+def _local_index():
+    """an index in the same shape as index.json, built from the bundled files"""
+    index_data = {}
+    for name, (ies_path, spectra_path) in local_lamp_files().items():
+        index_data[f"local-{name}"] = {
+            "slug": name,
+            "reporting_name": name,
+            "ies_path": str(ies_path),
+            "spectra_path": None if spectra_path is None else str(spectra_path),
+        }
+    return index_data
+
+
+@lru_cache(maxsize=None)
+def get_catalog():
+    """the one LampCatalog shared by every session in this process"""
+    catalog = LampCatalog()
+    get_metrics().add_collector(
+        lambda: stats_gauges(
+            "process_catalog",
+            {
+                "fetches": catalog.num_fetches,
+                "not_modified": catalog.num_not_modified,
+                "errors": catalog.num_errors,
+            },
+            "Lamp catalog",
+        )
+    )
+    return catalog
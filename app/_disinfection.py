@@ -0,0 +1,112 @@
+import threading
+from functools import lru_cache
+from pathlib import Path
+import pandas as pd
+
+DISINFECTION_TABLE = Path("data/disinfection_table.csv")
+
+# columns shown alongside the computed eACH/CADR, in display order
+TABLE_KEYS = [
+    "Kingdom",
+    "Species",
+    "Strain",
+    "Type (Viral)",
+    "Enveloped (Viral)",
+    "k1 [cm2/mJ]",
+    "k2 [cm2/mJ]",
+    "% resistant",
+    "Medium (specific)",
+    "Full Citation",
+]
+
+
+class DisinfectionGroup:
+    """
+    The rows of the disinfection table for one (Medium, wavelength), sorted by
+    species, with each row's k1/k2/% resistant already reduced to a single
+    float: its eACH per uW/cm2 of average fluence. `display` holds the text
+    columns, formatted for the results table.
+    """
+
+    def __init__(self, df):
+        df = df.sort_values("Species")
+        k1 = df["k1 [cm2/mJ]"].fillna(0).astype(float).to_numpy()
+        k2 = df["k2 [cm2/mJ]"].fillna(0).astype(float).to_numpy()
+        f = df["% resistant"].str.rstrip("%").astype("float").fillna(0) / 100
+        f = f.to_numpy()
+        self.k = k1 * (1 - f) + k2 - k2 * (1 - f)
+        self.k.setflags(write=False)
+        self.kingdom = df["Kingdom"].to_numpy()
+        self.species = df["Species"].to_numpy()
+        display = df[TABLE_KEYS].fillna(" ")
+        self.display = display.rename(
+            columns={"Medium (specific)": "Medium", "Full Citation": "Reference"}
+        )
+
+    def __len__(self):
+        return len(self.k)
+
+    def eACH(self, fluence):
+        """equivalent air changes per hour at an average fluence in uW/cm2"""
+        return self.k * fluence * 3.6
+
+    def cadr(self, fluence, volume):
+        """(cfm, lps) clean air delivery rates, for a room volume in cubic feet"""
+        cadr_cfm = self.eACH(fluence) * volume / 60
+        return cadr_cfm, cadr_cfm * 0.47195
+
+    def table(self, fluence, volume):
+        """the results table for an average fluence and a volume in cubic feet"""
+        eACH = self.eACH(fluence)
+        cadr_cfm, cadr_lps = self.cadr(fluence, volume)
+        results = pd.DataFrame(
+            {
+                "eACH-UV": eACH.round(2),
+                "CADR-UV [cfm]": cadr_cfm.round(2),
+                "CADR-UV [lps]": cadr_lps.round(2),
+            },
+            index=self.display.index,
+        )
+        return pd.concat([results, self.display], axis=1)
+
+
+class DisinfectionIndex:
+    """
+    The disinfection table, read once and split into a DisinfectionGroup per
+    (Medium, wavelength). Groups are built the first time they're asked for.
+    """
+
+    def __init__(self, path=DISINFECTION_TABLE):
+        self._lock = threading.Lock()
+        self._df = pd.read_csv(path)
+        self._groups = {}
+
+    def get(self, medium="Aerosol", wavelength=222):
+        key = (medium, wavelength)
+        with self._lock:
+            group = self._groups.get(key)
+            if group is None:
+                df = self._df
+                mask = (df["Medium"] == medium) & (df["wavelength [nm]"] == wavelength)
+                group = DisinfectionGroup(df[mask])
+                self._groups[key] = group
+        return group
+
+    def keys(self):
+        """every (Medium, wavelength) the table has data for"""
+        pairs = self._df[["Medium", "wavelength [nm]"]].dropna().drop_duplicates()
+        return [tuple(pair) for pair in pairs.itertuples(index=False)]
+
+
+@lru_cache(maxsize=None)
+def get_disinfection_index():
+    """the one DisinfectionIndex shared by every session in this process"""
+    return DisinfectionIndex()
+
+
+def room_volume_ft3(room):
+    """room volume in cubic feet, as used for CADR in cfm"""
+    volume = room.get_volume()
+    if room.units == "meters":
+        volume = volume / (0.3048 ** 3)
+    return volume
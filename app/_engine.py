@@ -0,0 +1,229 @@
+import numpy as np
+from guv_calcs.calc_zone import CalcPlane, CalcVol
+from app._disinfection import get_disinfection_index, room_volume_ft3
+from app._spectral import TLV_UJ, effectiveness, mono_limit
+
+# zones every room has, with results of their own
+SPECIAL_ZONES = ["WholeRoomFluence", "SkinLimits", "EyeLimits"]
+# zones the TLV is taken over, which keep each lamp's own grid to weight it
+TLV_ZONES = ["SkinLimits", "EyeLimits"]
+
+
+def standard_zones(room):
+    """the whole room fluence volume and the skin and eye limit planes for a room"""
+
+    fluence = CalcVol(
+        zone_id="WholeRoomFluence",
+        name="Whole Room Fluence",
+        x1=0,
+        x2=room.x,
+        y1=0,
+        y2=room.y,
+        z1=0,
+        z2=room.z,
+    )
+
+    height = 1.9 if room.units == "meters" else 6.23
+
+    skinzone = CalcPlane(
+        zone_id="SkinLimits",
+        name="Skin Dose (8 Hours)",
+        height=height,
+        x1=0,
+        x2=room.x,
+        y1=0,
+        y2=room.y,
+        vert=False,
+        horiz=True,
+        fov80=False,
+        dose=True,
+        hours=8,
+    )
+    eyezone = CalcPlane(
+        zone_id="EyeLimits",
+        name="Eye Dose (8 Hours)",
+        height=height,
+        x1=0,
+        x2=room.x,
+        y1=0,
+        y2=room.y,
+        vert=True,
+        horiz=False,
+        fov80=True,
+        dose=True,
+        hours=8,
+    )
+    return [fluence, skinzone, eyezone]
+
+
+def get_unweighted_hours_to_tlv(room):
+    """
+    calculate hours to tlv without taking into account lamp spectra
+    """
+
+    skin_standard, eye_standard = get_standards(room.standard)
+    mono_skinmax, mono_eyemax = _get_mono_limits(222, room)
+
+    skin_limits = room.calc_zones["SkinLimits"]
+    eye_limits = room.calc_zones["EyeLimits"]
+
+    skin_hours = mono_skinmax * 8 / skin_limits.values.max()
+    eye_hours = mono_eyemax * 8 / eye_limits.values.max()
+    return skin_hours, eye_hours
+
+
+def get_weighted_hours_to_tlv(room):
+    """
+    calculate the hours to tlv in a particular room, given a particular installation of lamps
+
+    each lamp's own contribution to the skin and eye limit zones is weighted by
+    that lamp's spectrum before the contributions are summed, so overlapping
+    beams from lamps with different spectra are accounted for point by point.
+    lamps without a spectrum are treated as monochromatic 222nm sources; see
+    `missing_spectra`.
+    """
+
+    skin_standard, eye_standard = get_standards(room.standard)
+
+    skin_limits = room.calc_zones["SkinLimits"]
+    eye_limits = room.calc_zones["EyeLimits"]
+
+    skin_hours = _weighted_hours_over_zone(room, skin_limits, skin_standard)
+    eye_hours = _weighted_hours_over_zone(room, eye_limits, eye_standard)
+    return skin_hours, eye_hours
+
+
+def get_standards(standard):
+    """return the relevant skin and eye limit standards"""
+    if "ANSI IES RP 27.1-22" in standard:
+        skin_standard = "ANSI IES RP 27.1-22 (Skin)"
+        eye_standard = "ANSI IES RP 27.1-22 (Eye)"
+    elif "IEC 62471-6:2022" in standard:
+        skin_standard = "IEC 62471-6:2022 (Eye/Skin)"
+        eye_standard = skin_standard
+    else:
+        raise KeyError(f"Room standard {standard} is not valid")
+
+    return skin_standard, eye_standard
+
+
+def _get_mono_limits(wavelength, room):
+    """
+    load the monochromatic skin and eye limits at a given wavelength
+    """
+    skin_standard, eye_standard = get_standards(room.standard)
+    return mono_limit(skin_standard, wavelength), mono_limit(eye_standard, wavelength)
+
+
+def missing_spectra(room):
+    """calculated lamps that have no spectrum, and so are assumed monochromatic"""
+    return [
+        lamp
+        for lamp in room.lamps.values()
+        if len(lamp.max_irradiances) > 0 and len(lamp.spectra) == 0
+    ]
+
+
+def weighted_values(room, zone, standard):
+    """
+    a calculated zone's values with each lamp's contribution weighted by its
+    own spectral effectiveness under `standard`, in the zone's units
+    """
+    lamp_values = getattr(zone, "lamp_values", None)
+    # a lamp deleted since the zone was calculated has no spectrum to weight
+    # its grid by any more, so results are stale until the next calculation
+    if lamp_values and all(lamp_id in room.lamps for lamp_id in lamp_values):
+        lamps = [room.lamps[lamp_id] for lamp_id in lamp_values]
+        ratios = effectiveness(lamps, standard, mono_wavelength=222)
+        grids = np.stack(list(lamp_values.values()))
+        return np.tensordot(ratios, grids, axes=1)
+    # per-lamp grids weren't kept or are stale; assume the most effective
+    # spectrum everywhere
+    lamps = [lamp for lamp in room.lamps.values() if len(lamp.max_irradiances) > 0]
+    if len(lamps) == 0:
+        return np.zeros_like(zone.values)
+    ratios = effectiveness(lamps, standard, mono_wavelength=222)
+    return zone.values * ratios.max()
+
+
+def _weighted_hours_over_zone(room, zone, standard):
+    """
+    hours to tlv at the worst point of a zone, with each lamp's contribution
+    weighted by its own spectral effectiveness
+    """
+    weighted_max = weighted_values(room, zone, standard).max()
+    if zone.dose:
+        weighted_max = weighted_max / 3.6 / zone.hours  # to uW/cm2
+    with np.errstate(divide="ignore"):
+        seconds_to_tlv = TLV_UJ / weighted_max  # seconds to reach 3 mJ/3000 uJ
+    return seconds_to_tlv / 3600
+
+
+def calculate_ozone_increase(room):
+    """
+    ozone generation constant is currently hardcoded to 10 for GUV222
+    this should really be based on spectra instead
+    but this is a relatively not very big deal, because
+    """
+    avg_fluence = room.calc_zones["WholeRoomFluence"].values.mean()
+    ozone_gen = 10  # hardcoded for now, eventually should be based on spectra bu
+    ach = room.air_changes
+    ozone_decay = room.ozone_decay_constant
+    ozone_increase = avg_fluence * ozone_gen / (ach + ozone_decay)
+    return ozone_increase
+
+
+def zone_stats(zone):
+    """mean, min and max of a calculated zone, in its units"""
+    units = zone.units
+    if zone.dose:
+        units += "/" + str(zone.hours) + " hours"
+    return {
+        "mean": float(zone.values.mean()),
+        "min": float(zone.values.min()),
+        "max": float(zone.values.max()),
+        "units": units,
+    }
+
+
+def room_results(room, medium="Aerosol", wavelength=222):
+    """
+    everything the results page reports for a calculated room, as plain
+    numbers: average fluence, per-species eACH, ozone, max doses, hours to
+    tlv, and stats for every calculated zone. entries that need a special zone
+    the room doesn't have (or that wasn't calculated) are left out.
+    """
+    zones = {
+        zone_id: zone
+        for zone_id, zone in room.calc_zones.items()
+        if zone.enabled and getattr(zone, "values", None) is not None
+    }
+    results = {}
+    fluence = zones.get("WholeRoomFluence")
+    if fluence is not None:
+        avg_fluence = float(fluence.values.mean())
+        group = get_disinfection_index().get(medium, wavelength)
+        eACH = group.eACH(avg_fluence)
+        results["fluence_mean"] = avg_fluence
+        results["eACH_mean"] = float(eACH.mean()) if len(group) else None
+        results["ozone_ppb"] = float(calculate_ozone_increase(room))
+        results["volume_ft3"] = float(room_volume_ft3(room))
+        # the table has several rows per species; report each one's mean
+        results["eACH"] = {
+            species: float(eACH[group.species == species].mean())
+            for species in dict.fromkeys(group.species)
+        }
+    if "SkinLimits" in zones and "EyeLimits" in zones:
+        skin_hours, eye_hours = get_unweighted_hours_to_tlv(room)
+        skin_hours_w, eye_hours_w = get_weighted_hours_to_tlv(room)
+        results["skin_max"] = float(zones["SkinLimits"].values.max())
+        results["eye_max"] = float(zones["EyeLimits"].values.max())
+        results["skin_hours_to_tlv_mono"] = float(skin_hours)
+        results["eye_hours_to_tlv_mono"] = float(eye_hours)
+        results["skin_hours_to_tlv"] = float(skin_hours_w)
+        results["eye_hours_to_tlv"] = float(eye_hours_w)
+        results["hours_to_tlv_mono"] = float(min(skin_hours, eye_hours))
+        results["hours_to_tlv"] = float(min(skin_hours_w, eye_hours_w))
+        results["missing_spectra"] = [lamp.lamp_id for lamp in missing_spectra(room)]
+    results["zones"] = {zone_id: zone_stats(zone) for zone_id, zone in zones.items()}
+    return results
@@ -0,0 +1,191 @@
+import re
+import time
+import logging
+import threading
+from functools import lru_cache
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from ._metrics import current_session, get_metrics, log_event, session_bound
+
+logger = logging.getLogger(__name__)
+
+LOCAL_IES_DIR = Path("./data/ies_files")
+TIMEOUT = (3.05, 10)  # (connect, read) seconds
+RETRIES = 2
+POOL_SIZE = 16
+BREAKER_THRESHOLD = 3  # consecutive failures before the circuit opens
+BREAKER_COOLDOWN = 30  # seconds the circuit stays open before a trial request
+
+
+class UpstreamUnavailable(requests.exceptions.ConnectionError):
+    """raised when the upstream can't be reached, or the circuit is open"""
+
+
+class CircuitBreaker:
+    """
+    Stops hammering an upstream that is down. After `threshold` consecutive
+    failures the circuit opens and requests fail immediately; after `cooldown`
+    seconds a single trial request is let through, and its outcome decides
+    whether the circuit closes again.
+    """
+
+    def __init__(self, threshold=BREAKER_THRESHOLD, cooldown=BREAKER_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        self._trial_in_flight = False
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def allow(self):
+        """true if a request may be attempted right now"""
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at < self.cooldown:
+                return False
+            if self._trial_in_flight:
+                return False
+            self._trial_in_flight = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial_in_flight = False
+            if self.failures >= self.threshold:
+                if self.opened_at is None:
+                    logger.warning("Upstream failing, opening circuit breaker")
+                self.opened_at = time.monotonic()
+
+
+@lru_cache(maxsize=None)
+def get_session():
+    """one pooled keep-alive session, with bounded retries, shared by the process"""
+    retry = Retry(
+        total=RETRIES,
+        backoff_factor=0.3,
+        status_forcelist=[500, 502, 503, 504],
+        allowed_methods=["GET"],
+        raise_on_status=False,  # hand back the last response; http_get checks it
+    )
+    adapter = HTTPAdapter(
+        pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE, max_retries=retry
+    )
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+@lru_cache(maxsize=None)
+def get_breaker():
+    return CircuitBreaker()
+
+
+@lru_cache(maxsize=None)
+def get_executor():
+    """thread pool for fetching files in parallel"""
+    return ThreadPoolExecutor(max_workers=POOL_SIZE, thread_name_prefix="fetch")
+
+
+def http_get(url, headers=None):
+    """
+    GET through the shared session, with timeouts, retries and the circuit
+    breaker. Request failures and server errors that outlast the retries raise
+    UpstreamUnavailable; other responses are returned as they are.
+    """
+    breaker = get_breaker()
+    if not breaker.allow():
+        raise UpstreamUnavailable(f"Circuit open, not fetching {url}")
+    start = time.perf_counter()
+    status = "error"
+    try:
+        response = get_session().get(url, headers=headers, timeout=TIMEOUT)
+        status = str(response.status_code)
+    except Exception as e:
+        # every outcome has to be recorded, or a trial request left in flight
+        # would keep the circuit open for good
+        breaker.record_failure()
+        if isinstance(e, requests.exceptions.RequestException):
+            raise UpstreamUnavailable(str(e)) from e
+        raise
+    finally:
+        _record_request(url, status, time.perf_counter() - start)
+    if response.status_code >= 500:
+        breaker.record_failure()
+        raise UpstreamUnavailable(f"{url} answered {response.status_code}")
+    breaker.record_success()
+    return response
+
+
+def _record_request(url, status, seconds):
+    session = current_session()
+    host = urlsplit(url).netloc
+    get_metrics().observe(
+        "guv_http_request_seconds", seconds, session=session, host=host, status=status
+    )
+    log_event("http", url=url, status=status, seconds=seconds, session=session)
+
+
+def fetch_bytes(url):
+    """content at `url`; local paths are read from disk"""
+    if not url.startswith(("http://", "https://")):
+        return Path(url).read_bytes()
+    response = http_get(url)
+    response.raise_for_status()
+    return response.content
+
+
+def fetch_many(urls, fetch=fetch_bytes):
+    """fetch several urls concurrently; None entries are passed through as None"""
+    fetch = session_bound(fetch)
+    futures = [
+        None if url is None else get_executor().submit(fetch, url) for url in urls
+    ]
+    return [None if future is None else future.result() for future in futures]
+
+
+def _normalize(name):
+    """reduce a lamp slug or filename to lowercase alphanumerics for matching"""
+    name = re.sub(r"[-_ ]spectrum$", "", name.lower())
+    return re.sub(r"[^a-z0-9]", "", name)
+
+
+def local_lamp_files(root=LOCAL_IES_DIR):
+    """{name: (ies_path, spectrum_path or None)} for the bundled lamp files"""
+    files = {}
+    if not root.is_dir():
+        return files
+    for ies_path in sorted(root.glob("**/*.ies")):
+        spectra = [
+            p
+            for p in ies_path.parent.glob(f"{ies_path.stem}*.csv")
+            if _normalize(p.stem) == _normalize(ies_path.stem)
+        ]
+        files[ies_path.stem] = (ies_path, spectra[0] if spectra else None)
+    return files
+
+
+def local_fallback(url):
+    """the bundled file matching the slug of a vendored url, or None"""
+    slug = _normalize(Path(url).stem)
+    is_spectrum = url.endswith(".csv")
+    for ies_path, spectrum_path in local_lamp_files().values():
+        if _normalize(ies_path.stem) == slug:
+            return spectrum_path if is_spectrum else ies_path
+    return None
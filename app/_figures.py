@@ -0,0 +1,113 @@
+import weakref
+from collections import OrderedDict
+from functools import lru_cache
+import streamlit as st
+import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+from app._metrics import count, get_metrics, stats_gauges
+
+# figures kept per session; the least recently shown are closed beyond this
+MAX_SESSION_FIGURES = 8
+
+ss = st.session_state
+
+
+class FigureManager:
+    """
+    The matplotlib figures one session shows, by name, e.g. "spectra".
+
+    Figures are taken out of pyplot's global registry as soon as they're
+    handed over - guv_calcs plots with pyplot - so the manager is the only
+    thing keeping them alive. Putting a figure under a name closes the one
+    it replaces, beyond `max_figures` the least recently used are closed, and
+    all of them are closed when the session's state is dropped.
+    """
+
+    def __init__(self, max_figures=MAX_SESSION_FIGURES):
+        self.max_figures = max_figures
+        self._figures = OrderedDict()  # name -> (key, figure)
+        weakref.finalize(self, _close_all, self._figures)
+        get_figure_managers().add(self)
+
+    def __len__(self):
+        return len(self._figures)
+
+    def get(self, name, key=None):
+        """the figure under `name`, if there is one and it was put with `key`"""
+        if name not in self._figures or self._figures[name][0] != key:
+            return None
+        self._figures.move_to_end(name)
+        return self._figures[name][1]
+
+    def put(self, name, fig, key=None):
+        """keep `fig` under `name`, closing whatever was there, and return it"""
+        plt.close(fig)  # out of pyplot's registry; it still draws
+        old = self._figures.pop(name, None)
+        if old is None or old[1] is not fig:
+            count("guv_figures_created_total")
+            if old is not None:
+                _close(old[1])
+        self._figures[name] = (key, fig)
+        while len(self._figures) > self.max_figures:
+            _close(self._figures.popitem(last=False)[1][1])
+        return fig
+
+    def reuse(self, name):
+        """
+        the figure under `name`, cleared, with one set of axes, or a new one,
+        for plots that draw onto a figure they're given
+        """
+        fig = self.get(name)
+        if fig is None:
+            fig = self.put(name, Figure())
+        else:
+            fig.clear()
+            fig.set_size_inches(plt.rcParams["figure.figsize"])
+        fig.add_subplot()
+        return fig
+
+    def discard(self, name):
+        entry = self._figures.pop(name, None)
+        if entry is not None:
+            _close(entry[1])
+
+    def close_all(self):
+        _close_all(self._figures)
+
+
+def _close(fig):
+    plt.close(fig)
+    fig.clear()
+    count("guv_figures_closed_total")
+
+
+def _close_all(figures):
+    while figures:
+        _close(figures.popitem()[1][1])
+
+
+def session_figures():
+    """the FigureManager of the session whose script is running"""
+    if "figures" not in ss:
+        ss.figures = FigureManager()
+    return ss.figures
+
+
+def figure_stats():
+    """how many figures are open in pyplot and held by sessions"""
+    managers = list(get_figure_managers())
+    return {
+        "pyplot_open": len(plt.get_fignums()),
+        "sessions": len(managers),
+        "held": sum(len(manager) for manager in managers),
+    }
+
+
+@lru_cache(maxsize=None)
+def get_figure_managers():
+    """every session's FigureManager in this process, until it's dropped"""
+    managers = weakref.WeakSet()
+    get_metrics().add_collector(
+        lambda: stats_gauges("process_figures", figure_stats(), "Matplotlib figures")
+    )
+    return managers
@@ -0,0 +1,228 @@
+import time
+import threading
+from contextlib import nullcontext
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from app._calculate import (
+    CalculationCancelled,
+    DeadlineExceeded,
+    calculate_room,
+    coarsen_room,
+    result_summary,
+    room_key,
+    snapshot_room,
+    stage_factors,
+    stage_points,
+    summary_error,
+    upsample_results,
+)
+from app._metrics import count, current_session, session_context, span
+from app._profile import active_profiler
+from app._website_helpers import get_disinfection_table
+
+CALC_WORKERS = 4
+
+
+@lru_cache(maxsize=None)
+def get_calc_executor():
+    """worker pool shared by every session's calculations"""
+    return ThreadPoolExecutor(max_workers=CALC_WORKERS, thread_name_prefix="calc")
+
+
+class BackgroundJob:
+    """
+    Work running on the shared calculation pool, with progress, cancellation
+    and timing. Subclasses implement `_run`, which should let
+    CalculationCancelled propagate once `_cancel_event` is set, and call
+    `_start` at the end of their constructor.
+    """
+
+    label = "job"  # what the job is called in profiles
+
+    def __init__(self):
+        self.progress = 0.0
+        self.message = "Queued"
+        self.started_at = time.monotonic()
+        self.finished_at = None
+        self._cancel_event = threading.Event()
+        self.future = None
+        # metrics recorded by the worker belong to the session that started it
+        self.session = current_session()
+        # and it's profiled if that session is
+        self.profiler = active_profiler()
+
+    def _start(self):
+        self.future = get_calc_executor().submit(self._run_in_session)
+
+    def _run_in_session(self):
+        profiling = nullcontext()
+        if self.profiler is not None:
+            profiling = self.profiler.capture(self.label)
+        with session_context(self.session), profiling:
+            return self._run()
+
+    def _run(self):
+        raise NotImplementedError
+
+    @property
+    def running(self):
+        return not self.future.done()
+
+    @property
+    def cancelled(self):
+        return self._cancel_event.is_set()
+
+    @property
+    def succeeded(self):
+        return self.future.done() and self.error is None and not self.cancelled
+
+    @property
+    def error(self):
+        """the exception the job failed with, if any (cancellation isn't an error)"""
+        if not self.future.done() or self.future.cancelled():
+            return None
+        exc = self.future.exception()
+        return None if isinstance(exc, CalculationCancelled) else exc
+
+    @property
+    def elapsed(self):
+        end = time.monotonic() if self.finished_at is None else self.finished_at
+        return end - self.started_at
+
+    def cancel(self):
+        """ask the worker to stop at the next chunk boundary"""
+        self._cancel_event.set()
+        self.future.cancel()  # only succeeds if it hasn't started yet
+
+
+class CalcStage:
+    """
+    One finished stage of a progressive calculation: the room calculated with
+    its grid spacing scaled by `factor`, its headline numbers, and the
+    estimated relative error of each (None for the first stage)
+    """
+
+    def __init__(self, factor, room, summary, error, elapsed):
+        self.factor = factor
+        self.room = room
+        self.summary = summary
+        self.error = error
+        self.elapsed = elapsed
+
+
+class CalcJob(BackgroundJob):
+    """
+    A calculation running in the background on a snapshot of a room.
+
+    The live room is never touched by the worker; once the job is done, `apply`
+    copies the results onto it. `key` is the room fingerprint the job was
+    started from, so an unchanged room can reuse a job instead of starting another.
+
+    If `progressive`, the room is first calculated on coarse grids, refining
+    stage by stage down to the requested spacing; each finished stage is added
+    to `stages` so provisional results can be shown. If `deadline` (seconds) is
+    given, refinement stops once it passes, and the finest finished stage is
+    used as the result, with `partial` set.
+    """
+
+    label = "calculate"
+
+    def __init__(self, room, progressive=False, deadline=None):
+        super().__init__()
+        self.key = room_key(room)
+        self.room = snapshot_room(room)
+        self.progressive = progressive
+        self.deadline = deadline
+        self.stages = []
+        self.num_stages = None
+        self.partial = False
+        self.kdf = None
+        self.applied = False
+        self._start()
+
+    def _run(self):
+        outcome = "error"
+        try:
+            with span("calculate", progressive=self.progressive):
+                room = self._calculate()
+            outcome = "partial" if self.partial else "done"
+            return room
+        except CalculationCancelled:
+            outcome = "cancelled"
+            raise
+        finally:
+            count("guv_calculations_total", outcome=outcome)
+
+    def _calculate(self):
+        factors = stage_factors(self.room) if self.progressive else [1]
+        weights = [stage_points(self.room, factor) for factor in factors]
+        self.num_stages = len(factors)
+        deadline = None
+        if self.deadline:
+            deadline = self.started_at + self.deadline
+        for i, factor in enumerate(factors):
+            stage_room = self.room if factor == 1 else coarsen_room(self.room, factor)
+            progress = self._stage_progress(i, weights)
+            try:
+                calculate_room(
+                    stage_room,
+                    progress=progress,
+                    cancel_event=self._cancel_event,
+                    # always finish the first stage, so there's something to show
+                    deadline=deadline if self.stages else None,
+                )
+            except DeadlineExceeded:
+                self.partial = True
+                upsample_results(self.stages[-1].room, self.room)
+                break
+            self._add_stage(factor, stage_room)
+        # the disinfection table only depends on the results, so build it here too
+        fluence = self.room.calc_zones.get("WholeRoomFluence")
+        if fluence is not None and fluence.values is not None:
+            self.kdf = get_disinfection_table(fluence.values.mean(), self.room)
+        self.finished_at = time.monotonic()
+        return self.room
+
+    def _update(self, fraction, message):
+        self.progress = fraction
+        self.message = message
+
+    def _stage_progress(self, i, weights):
+        """progress callback for stage `i`, scaled to the job as a whole"""
+        if len(weights) == 1:
+            return self._update
+        done, total = sum(weights[:i]), sum(weights)
+
+        def progress(fraction, message):
+            self._update(
+                (done + fraction * weights[i]) / total,
+                f"Stage {i + 1} of {len(weights)}: {message}",
+            )
+
+        return progress
+
+    def _add_stage(self, factor, room):
+        summary = result_summary(room)
+        error = summary_error(summary, self.stages[-1].summary) if self.stages else None
+        stage = CalcStage(
+            factor, room, summary, error, time.monotonic() - self.started_at
+        )
+        self.stages.append(stage)
+
+    @property
+    def latest_stage(self):
+        return self.stages[-1] if self.stages else None
+
+    def apply(self, room):
+        """copy the finished results onto the live room"""
+        for zone_id, zone in self.room.calc_zones.items():
+            if zone_id in room.calc_zones and zone.enabled:
+                room.calc_zones[zone_id].values = zone.values
+                room.calc_zones[zone_id].lamp_values = getattr(
+                    zone, "lamp_values", None
+                )
+        for lamp_id, lamp in self.room.lamps.items():
+            if lamp_id in room.lamps:
+                room.lamps[lamp_id].max_irradiances = dict(lamp.max_irradiances)
+        self.applied = True
+        return room
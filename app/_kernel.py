@@ -0,0 +1,212 @@
+import hashlib
+import numpy as np
+
+# upper bound on lamps x points evaluated at once, to keep temporaries small
+CHUNK_ELEMENTS = 2 ** 20
+
+
+def _yaw(degrees):
+    """(L, 3, 3) rotation matrices about z, as in guv_calcs.trigonometry.attitude"""
+    a = np.radians(degrees)
+    c, s = np.cos(a), np.sin(a)
+    zero, one = np.zeros_like(a), np.ones_like(a)
+    return np.stack(
+        [
+            np.stack([c, -s, zero], axis=-1),
+            np.stack([s, c, zero], axis=-1),
+            np.stack([zero, zero, one], axis=-1),
+        ],
+        axis=-2,
+    )
+
+
+def _pitch(degrees):
+    """(L, 3, 3) rotation matrices about y, as in guv_calcs.trigonometry.attitude"""
+    a = np.radians(degrees)
+    c, s = np.cos(a), np.sin(a)
+    zero, one = np.zeros_like(a), np.ones_like(a)
+    return np.stack(
+        [
+            np.stack([c, zero, s], axis=-1),
+            np.stack([zero, one, zero], axis=-1),
+            np.stack([-s, zero, c], axis=-1),
+        ],
+        axis=-2,
+    )
+
+
+def _table_key(lamp):
+    """identifies a lamp's candela table; lamps sharing an ies file share a key"""
+    digest = getattr(lamp, "photometry_hash", None)
+    if digest is None:
+        values = np.ascontiguousarray(lamp.interpdict["values"], dtype=float)
+        digest = hashlib.sha256(values.tobytes()).hexdigest()
+    return digest
+
+
+class LampBatch:
+    """
+    Every lamp's position, inverse orientation and candela table stacked into
+    arrays, so they can all be evaluated against a grid of points in one pass.
+
+    Candela tables are stored once per distinct ies file, in `tables`, and
+    `table_index` says which row each lamp uses. Lamps must share the same
+    interpolated theta/phi grid (photompy always interpolates to the same one);
+    see `batches` for grouping mixed lamps.
+    """
+
+    def __init__(
+        self, lamp_ids, positions, rotations, thetamap, phimap, tables, table_index
+    ):
+        self.lamp_ids = lamp_ids
+        self.positions = positions
+        self.rotations = rotations
+        self.thetamap = thetamap
+        self.phimap = phimap
+        self.tables = tables
+        self.table_index = table_index
+
+    @classmethod
+    def from_lamps(cls, lamps):
+        for lamp in lamps:
+            if lamp.intensity_units != "mW/Sr":
+                raise KeyError("Units not recognized")
+        heading = np.array([lamp.heading for lamp in lamps], dtype=float)
+        bank = np.array([lamp.bank for lamp in lamps], dtype=float)
+        angle = np.array([lamp.angle for lamp in lamps], dtype=float)
+        lamp_table_keys = [_table_key(lamp) for lamp in lamps]
+        table_rows = {}
+        for key, lamp in zip(lamp_table_keys, lamps):
+            table_rows.setdefault(key, lamp.interpdict["values"])
+        table_keys = list(table_rows)
+        batch = cls(
+            lamp_ids=[lamp.lamp_id for lamp in lamps],
+            positions=np.array([lamp.position for lamp in lamps], dtype=float),
+            # undo heading, then bank, then rotation - the reverse of Lamp.transform
+            rotations=_yaw(-angle) @ _pitch(-bank) @ _yaw(-heading),
+            thetamap=np.asarray(lamps[0].interpdict["thetas"], dtype=float),
+            phimap=np.asarray(lamps[0].interpdict["phis"], dtype=float),
+            tables=np.stack(
+                [np.asarray(val, dtype=float).ravel() for val in table_rows.values()]
+            ),
+            table_index=np.array([table_keys.index(key) for key in lamp_table_keys]),
+        )
+        batch.table_keys = tuple(table_keys)
+        return batch
+
+    def posed(self, positions, heading, bank, angle=None):
+        """
+        a batch of copies of this batch's first lamp, one at each of `positions`
+        (M, 3) with the matching heading, bank and rotation angle in degrees
+        """
+        heading = np.asarray(heading, dtype=float)
+        bank = np.asarray(bank, dtype=float)
+        angle = np.zeros_like(heading) if angle is None else np.asarray(angle)
+        batch = LampBatch(
+            lamp_ids=list(range(len(positions))),
+            positions=np.asarray(positions, dtype=float),
+            rotations=_yaw(-angle) @ _pitch(-bank) @ _yaw(-heading),
+            thetamap=self.thetamap,
+            phimap=self.phimap,
+            tables=self.tables[self.table_index[:1]],
+            table_index=np.zeros(len(positions), dtype=int),
+        )
+        batch.table_keys = getattr(self, "table_keys", ())[:1]
+        return batch
+
+    def __len__(self):
+        return len(self.lamp_ids)
+
+    def _intensity(self, theta, phi):
+        """bilinear lookup into each lamp's table; same scheme as photompy"""
+        thetamap, phimap = self.thetamap, self.phimap
+        phi = np.mod(phi, 360)
+        pi = np.clip(np.searchsorted(phimap, phi, side="left"), 1, len(phimap) - 1)
+        ti = np.clip(
+            np.searchsorted(thetamap, theta, side="left"), 1, len(thetamap) - 1
+        )
+        pw = (phi - phimap[pi - 1]) / (phimap[pi] - phimap[pi - 1])
+        tw = (theta - thetamap[ti - 1]) / (thetamap[ti] - thetamap[ti - 1])
+
+        num_thetas = len(thetamap)
+        flat = self.tables.reshape(-1)
+        offsets = (self.table_index * self.tables.shape[1])[:, None]
+
+        def lookup(p, t):
+            return flat[offsets + p * num_thetas + t]
+
+        val1 = lookup(pi - 1, ti - 1) * (1 - pw) + lookup(pi, ti - 1) * pw
+        val2 = lookup(pi - 1, ti) * (1 - pw) + lookup(pi, ti) * pw
+        return val1 * (1 - tw) + val2 * tw
+
+    def evaluate(self, coords, fov80=False, vert=False, horiz=False):
+        """
+        (L, N) irradiance in uW/cm2 from each lamp at each of `coords` (N, 3),
+        matching CalcZone.calculate_values before any dose conversion
+        """
+        rel = coords[None, :, :] - self.positions[:, None, :]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            r = np.linalg.norm(rel, axis=-1)
+            theta0 = np.nan_to_num(np.degrees(np.arccos(-rel[..., 2] / r)), nan=0)
+            rotated = np.einsum("lij,lnj->lni", self.rotations, rel)
+            theta = np.degrees(np.arccos(-rotated[..., 2] / r))
+            theta = np.nan_to_num(theta, nan=0)
+            phi = np.degrees(np.arctan2(rotated[..., 0], rotated[..., 1]))
+            values = self._intensity(theta, phi) / r ** 2
+
+        if fov80:
+            values[theta0 < 50] = 0
+        if vert:
+            values *= np.sin(np.radians(theta0))
+        if horiz:
+            values *= np.cos(np.radians(theta0))
+        return values / 10  # mW/Sr to uW/cm2
+
+
+def batches(lamps):
+    """split lamps into LampBatches that each share an interpolation grid"""
+    groups = {}
+    for lamp in lamps:
+        grid = lamp.interpdict["thetas"], lamp.interpdict["phis"]
+        key = tuple(np.asarray(g).tobytes() for g in grid)
+        groups.setdefault(key, []).append(lamp)
+    return [LampBatch.from_lamps(group) for group in groups.values()]
+
+
+def evaluate_zone(lamps, zone, per_lamp=True, on_chunk=None):
+    """
+    evaluate every lamp against a zone's points in bounded-size chunks.
+
+    returns (values, total, maxes): `values` is {lamp_id: grid} in the zone's
+    shape and units (or None if `per_lamp` is False), `total` is their sum,
+    and `maxes` is {lamp_id: max irradiance in uW/cm2} - the same by-product
+    that calculate_values stores in `lamp.max_irradiances`. `on_chunk` is
+    called before each chunk with the fraction of the zone done so far.
+    """
+    coords = zone.coords
+    num_points = coords.shape[0]
+    scale = 3.6 * zone.hours if zone.dose else 1
+    total = np.zeros(num_points)
+    values = {} if per_lamp else None
+    maxes = {}
+    lamp_batches = batches(lamps)
+    for b, batch in enumerate(lamp_batches):
+        grids = np.empty((len(batch), num_points)) if per_lamp else None
+        batch_max = np.full(len(batch), -np.inf)
+        chunk = max(CHUNK_ELEMENTS // len(batch), 1)
+        for start in range(0, num_points, chunk):
+            if on_chunk is not None:
+                on_chunk((b * num_points + start) / (len(lamp_batches) * num_points))
+            stop = min(start + chunk, num_points)
+            irradiance = batch.evaluate(
+                coords[start:stop], fov80=zone.fov80, vert=zone.vert, horiz=zone.horiz
+            )
+            batch_max = np.maximum(batch_max, irradiance.max(axis=1))
+            total[start:stop] += irradiance.sum(axis=0) * scale
+            if per_lamp:
+                grids[:, start:stop] = irradiance * scale
+        for i, lamp_id in enumerate(batch.lamp_ids):
+            maxes[lamp_id] = batch_max[i]
+            if per_lamp:
+                values[lamp_id] = grids[i].reshape(*zone.num_points)
+    return values, total.reshape(*zone.num_points), maxes
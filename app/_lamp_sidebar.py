@@ -1,6 +1,9 @@
 import streamlit as st
-import matplotlib.pyplot as plt
+from app._figures import session_figures
+from app._uploads import QuotaExceeded
 from app._website_helpers import make_file_list
+from app._photometry import load_lamp_file, load_lamp_spectra
+from app._sweep_sidebar import show_sweep
 from app._widget import (
     initialize_lamp,
     update_lamp_filename,
@@ -152,6 +155,14 @@ def lamp_sidebar(room):
         use_container_width=True,
         key="close_lamp2",
     )
+    st.button(
+        "Parameter Sweep",
+        on_click=show_sweep,
+        args=[room],
+        disabled=selected_lamp.filedata is None,
+        use_container_width=True,
+        key="sweep_lamp",
+    )
 
 
 def lamp_file_options(selected_lamp):
@@ -179,11 +190,15 @@ def lamp_file_options(selected_lamp):
         if uploaded_file is not None:
             fdata = uploaded_file.read()
             fname = uploaded_file.name
-            # add the uploaded file to the session state and upload
-            ss.uploaded_files[fname] = fdata
+            # add the uploaded file to the session's uploads and the file list
+            try:
+                ss.uploaded_files.add_file(fname, fdata)
+            except QuotaExceeded as e:
+                st.error(f"Could not upload {fname}: {e}")
+                return
             make_file_list()
             # load into lamp object
-            selected_lamp.reload(filename=fname, filedata=fdata)
+            load_lamp_file(selected_lamp, filename=fname, filedata=fdata)
             # st.rerun here?
             st.rerun()
 
@@ -203,9 +218,13 @@ def lamp_file_options(selected_lamp):
         )
         if uploaded_spectra is not None:
             spectra_data = uploaded_spectra.read()
-            selected_lamp.load_spectra(spectra_data)
-            fig, ax = plt.subplots()
-            ss.spectrafig = selected_lamp.plot_spectra(fig=fig, title="")
+            try:
+                ss.uploaded_files.add_spectra(selected_lamp.filename, spectra_data)
+            except QuotaExceeded as e:
+                st.error(f"Could not upload {uploaded_spectra.name}: {e}")
+                return
+            load_lamp_spectra(selected_lamp, spectra_data)
+            selected_lamp.plot_spectra(fig=session_figures().reuse("spectra"), title="")
             st.rerun()
 
     # plot if there is data to plot with
@@ -226,20 +245,27 @@ def lamp_file_options(selected_lamp):
         if yscale is None:
             yscale = "linear"  # kludgey default value setting
 
+    figures = session_figures()
+    if PLOT_SPECTRA:
+        spectrafig = figures.get("spectra")
+        if spectrafig is None:
+            spectrafig = selected_lamp.plot_spectra(
+                fig=figures.reuse("spectra"), title=""
+            )
     if PLOT_IES and PLOT_SPECTRA:
         # plot both charts side by side
-        iesfig, iesax = selected_lamp.plot_ies()
-        ss.spectrafig.set_size_inches(5, 6, forward=True)
-        ss.spectrafig.axes[0].set_yscale(yscale)
+        iesfig = figures.put("ies", selected_lamp.plot_ies()[0])
+        spectrafig.set_size_inches(5, 6, forward=True)
+        spectrafig.axes[0].set_yscale(yscale)
         cols = st.columns(2)
-        cols[1].pyplot(ss.spectrafig, use_container_width=True)
+        cols[1].pyplot(spectrafig, use_container_width=True)
         cols[0].pyplot(iesfig, use_container_width=True)
     elif PLOT_IES and not PLOT_SPECTRA:
         # just display the ies file plot
-        iesfig, iesax = selected_lamp.plot_ies()
+        iesfig = figures.put("ies", selected_lamp.plot_ies()[0])
         st.pyplot(iesfig, use_container_width=True)
     elif PLOT_SPECTRA and not PLOT_IES:
         # display just the spectra
-        ss.spectrafig.set_size_inches(6.4, 4.8, forward=True)
-        ss.spectrafig.axes[0].set_yscale(yscale)
-        st.pyplot(ss.spectrafig, use_container_width=True)
+        spectrafig.set_size_inches(6.4, 4.8, forward=True)
+        spectrafig.axes[0].set_yscale(yscale)
+        st.pyplot(spectrafig, use_container_width=True)
@@ -0,0 +1,301 @@
+import os
+import sys
+import json
+import time
+import bisect
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# port for the Prometheus text endpoint, on localhost only; 0 turns it off
+METRICS_PORT = int(os.environ.get("GUV_METRICS_PORT", 9464))
+METRICS_HOST = "127.0.0.1"
+# file to write a JSON line per span to, or "-" for stderr; unset turns it off
+METRICS_LOG = os.environ.get("GUV_METRICS_LOG")
+# sessions whose series are kept; the least recently active are dropped beyond this
+METRICS_MAX_SESSIONS = 256
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+NO_SESSION = "none"
+
+METRICS = {
+    "guv_stage_seconds": ("histogram", "Time spent in each stage of a rerun or job"),
+    "guv_http_request_seconds": ("histogram", "Time spent on outbound HTTP requests"),
+    "guv_reruns_total": ("counter", "App reruns"),
+    "guv_calculations_total": ("counter", "Calculations finished, by outcome"),
+    "guv_contribution_cache_hits_total": (
+        "counter",
+        "Lamp/zone contributions re-summed from the contribution cache",
+    ),
+    "guv_contribution_cache_misses_total": (
+        "counter",
+        "Lamp/zone contributions that had to be computed",
+    ),
+    "guv_figures_created_total": ("counter", "Matplotlib figures made for display"),
+    "guv_figures_closed_total": ("counter", "Matplotlib figures closed once replaced"),
+}
+
+_local = threading.local()
+_span_log = logging.getLogger(__name__ + ".spans")
+
+
+def current_session():
+    """
+    the session metrics recorded by this thread belong to: whatever
+    `session_context` set, else the Streamlit session whose script is running,
+    else NO_SESSION
+    """
+    session = getattr(_local, "session", None)
+    if session is not None:
+        return session
+    try:
+        from streamlit.runtime.scriptrunner import get_script_run_ctx
+    except ImportError:
+        return NO_SESSION
+    ctx = get_script_run_ctx(suppress_warning=True)
+    return NO_SESSION if ctx is None else ctx.session_id
+
+
+@contextmanager
+def session_context(session):
+    """tag what this thread records with `session`, e.g. in a background job"""
+    previous = getattr(_local, "session", None)
+    _local.session = session
+    try:
+        yield
+    finally:
+        _local.session = previous
+
+
+def session_bound(fn):
+    """
+    `fn`, recording under the session current where it's bound rather than
+    where it runs, for handing work to a thread pool
+    """
+    session = current_session()
+
+    def run(*args, **kwargs):
+        with session_context(session):
+            return fn(*args, **kwargs)
+
+    return run
+
+
+class Histogram:
+    """Counts of observations per latency bucket, and their total."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last is for +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class MetricsRegistry:
+    """
+    Process-wide counters and latency histograms.
+
+    Every series is labelled with the session that recorded it, so a slow or
+    busy session stands out; sum over `session` for the process as a whole.
+    Series of the `max_sessions` most recently active sessions are kept, and
+    older ones dropped. Collectors add gauges that are read at scrape time,
+    like cache sizes.
+    """
+
+    def __init__(self, max_sessions=METRICS_MAX_SESSIONS):
+        self.max_sessions = max_sessions
+        self._lock = threading.Lock()
+        self._series = {}  # (name, labels) -> value or Histogram
+        self._sessions = OrderedDict()  # session -> keys of its series
+        self._collectors = []
+
+    def _key(self, name, session, labels):
+        session = current_session() if session is None else session
+        labels = tuple(sorted({**labels, "session": session}.items()))
+        key = (name, labels)
+        if session != NO_SESSION:
+            self._sessions.setdefault(session, set()).add(key)
+            self._sessions.move_to_end(session)
+            while len(self._sessions) > self.max_sessions:
+                _, keys = self._sessions.popitem(last=False)
+                for old in keys:
+                    self._series.pop(old, None)
+        return key
+
+    def inc(self, name, value=1, session=None, **labels):
+        with self._lock:
+            key = self._key(name, session, labels)
+            self._series[key] = self._series.get(key, 0) + value
+
+    def observe(self, name, value, session=None, **labels):
+        with self._lock:
+            key = self._key(name, session, labels)
+            if key not in self._series:
+                self._series[key] = Histogram()
+            self._series[key].observe(value)
+
+    def add_collector(self, collect):
+        """
+        `collect()` is called at every scrape and returns
+        [(name, help, {label: value}, value)] gauges
+        """
+        self._collectors.append(collect)
+
+    def sessions(self):
+        """the sessions with series, most recently active last"""
+        with self._lock:
+            return list(self._sessions)
+
+    def render(self):
+        """every series, in the Prometheus text exposition format"""
+        with self._lock:
+            series = sorted(self._series.items(), key=lambda item: item[0])
+            series = [(key, _copy(val)) for key, val in series]
+        lines = []
+        described = set()
+        for (name, labels), val in series:
+            if name not in described:
+                kind, help_text = METRICS.get(name, ("untyped", name))
+                lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+                described.add(name)
+            if isinstance(val, Histogram):
+                cumulative = 0
+                bounds = [str(b) for b in val.buckets] + ["+Inf"]
+                for bound, count in zip(bounds, val.counts):
+                    cumulative += count
+                    bucket_labels = labels + (("le", bound),)
+                    lines.append(f"{name}_bucket{_labels(bucket_labels)} {cumulative}")
+                lines.append(f"{name}_sum{_labels(labels)} {val.sum}")
+                lines.append(f"{name}_count{_labels(labels)} {val.count}")
+            else:
+                lines.append(f"{name}{_labels(labels)} {val}")
+        for collect in self._collectors:
+            try:
+                gauges = collect()
+            except Exception as e:
+                logger.warning(f"Metrics collector failed: {e}")
+                continue
+            for name, help_text, labels, val in gauges:
+                if name not in described:
+                    lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge"]
+                    described.add(name)
+                lines.append(f"{name}{_labels(tuple(labels.items()))} {val}")
+        return "\n".join(lines) + "\n"
+
+
+def stats_gauges(prefix, stats, help_text):
+    """a collector's gauges for the numbers in a `stats()` dict"""
+    return [
+        (f"guv_{prefix}_{key}", f"{help_text}: {key}", {}, val)
+        for key, val in stats.items()
+        if isinstance(val, (int, float))
+    ]
+
+
+def _copy(val):
+    if isinstance(val, Histogram):
+        copy = Histogram(val.buckets)
+        copy.counts, copy.sum, copy.count = list(val.counts), val.sum, val.count
+        return copy
+    return val
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    escaped = [
+        (key, str(val).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for key, val in labels
+    ]
+    return "{" + ",".join(f'{key}="{val}"' for key, val in escaped) + "}"
+
+
+@lru_cache(maxsize=None)
+def get_metrics():
+    """the one MetricsRegistry shared by every session in this process"""
+    if METRICS_LOG:
+        handler = (
+            logging.StreamHandler(sys.stderr)
+            if METRICS_LOG == "-"
+            else logging.FileHandler(METRICS_LOG)
+        )
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        _span_log.addHandler(handler)
+        _span_log.setLevel(logging.INFO)
+        _span_log.propagate = False
+    return MetricsRegistry()
+
+
+def log_event(event, **fields):
+    """one JSON line in the structured log, if it's turned on"""
+    if _span_log.isEnabledFor(logging.INFO):
+        record = {"ts": round(time.time(), 6), "event": event, **fields}
+        _span_log.info(json.dumps(record, default=str))
+
+
+def record_stage(stage, seconds, session=None, **labels):
+    """add a stage's duration to the stage latency histogram and the log"""
+    session = current_session() if session is None else session
+    get_metrics().observe(
+        "guv_stage_seconds", seconds, session=session, stage=stage, **labels
+    )
+    log_event("span", stage=stage, seconds=seconds, session=session, **labels)
+
+
+@contextmanager
+def span(stage, **labels):
+    """time the block as `stage` of whatever's running"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - start, **labels)
+
+
+def count(name, value=1, **labels):
+    """add to a counter for the current session"""
+    get_metrics().inc(name, value, **labels)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = get_metrics().render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # scrapes would otherwise be logged to stderr
+
+
+@lru_cache(maxsize=None)
+def start_metrics_server(port=METRICS_PORT):
+    """
+    serve /metrics on localhost from a daemon thread, once per process.
+    returns the server, or None if it's turned off or the port is taken.
+    """
+    if not port:
+        return None
+    try:
+        server = ThreadingHTTPServer((METRICS_HOST, port), _MetricsHandler)
+    except OSError as e:
+        logger.warning(f"Not serving metrics on port {port}: {e}")
+        return None
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name="metrics", daemon=True)
+    thread.start()
+    return server
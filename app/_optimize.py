@@ -0,0 +1,359 @@
+import time
+import threading
+from collections import OrderedDict
+import numpy as np
+from app._calculate import (
+    CalculationCancelled,
+    calculate_room,
+    coarsen_zone,
+    snapshot_room,
+    stage_factors,
+)
+from app._engine import SPECIAL_ZONES, get_standards, weighted_values
+from app._jobs import BackgroundJob
+from app._kernel import CHUNK_ELEMENTS, LampBatch
+from app._metrics import session_bound
+from app._placement import get_lamp_position
+from app._spectral import TLV_UJ, effectiveness
+from app._sweep import SWEEP_WORKERS, get_sweep_executor
+
+TLV_HOURS = 8
+MAX_OPTIMIZER_LAMPS = 8
+MAX_TILT = 90
+OPTIMIZER_POPULATION = 32
+OPTIMIZER_ELITES = 8
+OPTIMIZER_GENERATIONS = 40
+# search steps, as a fraction of each parameter's range, below which it stops
+MIN_STEP = 0.005
+BASIS_CACHE_BYTES = 128 * 1024 ** 2
+# candidate poses are snapped to this lattice, so nearby candidates share bases
+POSITION_STEPS = 100
+ANGLE_STEP = 2.5
+# parameters of each lamp in a layout, in the order they're stored
+POSE_FIELDS = ["x", "y", "tilt", "orientation"]
+
+
+class BasisCache:
+    """
+    LRU of one lamp pose's contribution to each of a surrogate's zones.
+    Bounded by `max_bytes`; arrays are stored read-only.
+    """
+
+    def __init__(self, max_bytes=BASIS_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # pose -> (fluence, skin, eye)
+
+    def get(self, pose):
+        with self._lock:
+            entry = self._entries.get(pose)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(pose)
+            self.hits += 1
+            return entry
+
+    def put(self, pose, grids):
+        for grid in grids:
+            grid.setflags(write=False)
+        with self._lock:
+            if pose in self._entries:
+                return
+            self._entries[pose] = grids
+            self.nbytes += sum(grid.nbytes for grid in grids)
+            while self.nbytes > self.max_bytes and len(self._entries) > 1:
+                _, old = self._entries.popitem(last=False)
+                self.nbytes -= sum(grid.nbytes for grid in old)
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "bytes": self.nbytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+class LayoutSurrogate:
+    """
+    A fast stand-in for calculating a room with some number of copies of one
+    lamp added to it.
+
+    The whole room fluence volume is coarsened to the first stage of a
+    progressive calculation; the skin and eye planes are cheap enough to keep
+    at full resolution, so the TLV constraint is checked exactly. The lamps
+    already in the room (unless `keep_lamps` is False) are calculated on these
+    zones once - the background every layout is added to. Each candidate pose
+    of the new lamp is snapped to a lattice and its contribution to the three
+    zones, its basis, is evaluated by the batched kernel and cached, so
+    scoring a layout is a sum of cached grids plus the background, with the
+    skin and eye grids weighted by the lamps' spectra just as
+    `get_weighted_hours_to_tlv` does.
+
+    Close to a lamp, the coarse volume would see the 1/r^2 peak at a single
+    point standing for a whole cell, and a search would learn to put lamps
+    right next to grid points. So within one grid spacing of the lamp, each
+    basis is held at its value one grid spacing away.
+    """
+
+    def __init__(self, room, template, keep_lamps=True, z=None, max_tilt=MAX_TILT):
+        missing = [
+            zone_id for zone_id in SPECIAL_ZONES if zone_id not in room.calc_zones
+        ]
+        if missing:
+            raise ValueError(f"The room has no {', '.join(missing)} zone")
+        if template.filedata is None:
+            raise ValueError("The luminaire has no photometry")
+        coarse = snapshot_room(room)
+        if not keep_lamps:
+            coarse.lamps = {}
+        coarse.calc_zones = {
+            zone_id: coarse.calc_zones[zone_id] for zone_id in SPECIAL_ZONES
+        }
+        for zone in coarse.calc_zones.values():
+            zone.enabled = True
+        coarsen_zone(coarse.calc_zones["WholeRoomFluence"], stage_factors(coarse)[0])
+        calculate_room(coarse)
+        self.room = coarse
+        self.zones = list(coarse.calc_zones.values())
+        self.z = room.z - 0.1 if z is None else z
+        self.max_tilt = max_tilt
+        # allowed x and y ranges, and the lattice poses are snapped to
+        self.lower = np.array([0, 0, 0, 0], dtype=float)
+        self.upper = np.array([room.x, room.y, max_tilt, 360], dtype=float)
+        self.steps = np.array(
+            [room.x / POSITION_STEPS, room.y / POSITION_STEPS, ANGLE_STEP, ANGLE_STEP]
+        )
+
+        fluence, skin, eye = self.zones
+        skin_standard, eye_standard = get_standards(room.standard)
+        self.background = [
+            fluence.values.ravel(),
+            weighted_values(coarse, skin, skin_standard).ravel(),
+            weighted_values(coarse, eye, eye_standard).ravel(),
+        ]
+        self.ratios = [
+            1.0,
+            effectiveness([template], skin_standard, mono_wavelength=222)[0],
+            effectiveness([template], eye_standard, mono_wavelength=222)[0],
+        ]
+        self.scales = [3.6 * zone.hours if zone.dose else 1 for zone in self.zones]
+        self.near_field = max(fluence.x_spacing, fluence.y_spacing, fluence.z_spacing)
+        self._template = LampBatch.from_lamps([template])
+        self.bases = BasisCache()
+
+    def snap(self, poses):
+        """poses (..., 4) clipped to the room and rounded onto the lattice"""
+        poses = np.asarray(poses, dtype=float).copy()
+        poses[..., 3] = np.mod(poses[..., 3], 360)
+        poses = np.round(poses / self.steps) * self.steps
+        poses[..., 3] = np.mod(poses[..., 3], 360)
+        return np.clip(poses, self.lower, self.upper)
+
+    def _evaluate(self, poses):
+        """[(fluence, skin, eye)] contributions of the template at each pose"""
+        positions = np.column_stack(
+            [poses[:, 0], poses[:, 1], np.full(len(poses), self.z)]
+        )
+        batch = self._template.posed(positions, heading=poses[:, 3], bank=poses[:, 2])
+        grids = []
+        for zone, scale in zip(self.zones, self.scales):
+            coords = zone.coords
+            out = np.empty((len(batch), coords.shape[0]))
+            chunk = max(CHUNK_ELEMENTS // len(batch), 1)
+            for start in range(0, coords.shape[0], chunk):
+                stop = min(start + chunk, coords.shape[0])
+                points = coords[start:stop]
+                values = batch.evaluate(
+                    points, fov80=zone.fov80, vert=zone.vert, horiz=zone.horiz
+                )
+                r = np.linalg.norm(points[None] - positions[:, None], axis=-1)
+                near = np.minimum(r / self.near_field, 1) ** 2
+                out[:, start:stop] = scale * values * near
+            grids.append(out)
+        return [tuple(grid[i] for grid in grids) for i in range(len(batch))]
+
+    def _fetch(self, keys):
+        """{pose: bases} for every key, evaluating the ones not yet cached"""
+        found = {}
+        missing = []
+        for key in dict.fromkeys(keys):
+            entry = self.bases.get(key)
+            if entry is None:
+                missing.append(key)
+            else:
+                found[key] = entry
+        if missing:
+            # split the new poses over the sweep workers
+            chunks = np.array_split(np.array(missing), min(SWEEP_WORKERS, len(missing)))
+            evaluate = session_bound(self._evaluate)
+            futures = [get_sweep_executor().submit(evaluate, c) for c in chunks]
+            grids = [entry for future in futures for entry in future.result()]
+            for key, entry in zip(missing, grids):
+                self.bases.put(key, entry)
+                found[key] = entry
+        return found
+
+    def score(self, layouts):
+        """
+        (fluence, hours) arrays for layouts (P, N, 4) of N lamps each: the
+        average fluence and the weighted hours to TLV, skin or eye, whichever
+        is shorter. layouts must already be snapped.
+        """
+        num_layouts, num_lamps = layouts.shape[:2]
+        keys = [tuple(pose) for pose in layouts.reshape(-1, 4)]
+        bases = self._fetch(keys)
+        totals = []
+        for z, (background, ratio) in enumerate(zip(self.background, self.ratios)):
+            grids = np.stack([bases[key][z] for key in keys])
+            grids = grids.reshape(num_layouts, num_lamps, -1).sum(axis=1)
+            totals.append(background + ratio * grids)
+        fluence = totals[0].mean(axis=1)
+        hours = []
+        for total, scale in zip(totals[1:], self.scales[1:]):
+            with np.errstate(divide="ignore"):
+                hours.append(TLV_UJ / (total.max(axis=1) / scale) / 3600)
+        return fluence, np.minimum(*hours)
+
+
+def starting_layout(room, num_lamps):
+    """the usual new-lamp positions, pointing straight down, as (N, 4) poses"""
+    poses = []
+    for i in range(num_lamps):
+        x, y = get_lamp_position(lamp_idx=len(room.lamps) + i + 1, x=room.x, y=room.y)
+        poses.append([x, y, 0, 0])
+    return np.array(poses, dtype=float)
+
+
+def elite_stats(elites):
+    """
+    mean and spread (N, 4) of elite layouts (E, N, 4) in units of each
+    parameter's range; orientation wraps around, so it's averaged on the circle
+    """
+    mean = elites.mean(axis=0)
+    std = elites.std(axis=0)
+    turns = 2 * np.pi * elites[..., 3]
+    angle = np.arctan2(np.sin(turns).mean(axis=0), np.cos(turns).mean(axis=0))
+    mean[..., 3] = np.mod(angle / (2 * np.pi), 1)
+    offsets = np.mod(elites[..., 3] - mean[..., 3] + 0.5, 1) - 0.5
+    std[..., 3] = np.sqrt((offsets ** 2).mean(axis=0))
+    return mean, std
+
+
+def layout_score(fluence, hours, target=TLV_HOURS):
+    """
+    what the search maximizes: the average fluence, for layouts that are
+    within the TLV, and otherwise the fluence they'd have if dimmed until
+    they were, penalized again by the same factor so that a compliant layout
+    is preferred to an equally bright one that needs dimming
+    """
+    with np.errstate(invalid="ignore"):
+        dimming = np.minimum(hours / target, 1)
+    return np.nan_to_num(fluence * dimming ** 2)
+
+
+class OptimizeJob(BackgroundJob):
+    """
+    A search, in the background, for where to put `num_lamps` copies of a lamp
+    in a room, and how to aim them, to get the highest average fluence while
+    the weighted hours to TLV stay at least TLV_HOURS.
+
+    Layouts are scored on a LayoutSurrogate. The search is a simple
+    evolution strategy - a population of layouts sampled around the best ones
+    so far, with steps that shrink as they agree - so it needs no gradients,
+    and each generation's new poses are evaluated together, spread over the
+    sweep workers. Lamps start from the usual new-lamp positions, pointing
+    down. `best` is the best compliant layout found, as (N, 4) poses, or,
+    if none was, the one closest to compliance.
+    """
+
+    label = "optimize"
+
+    def __init__(
+        self, room, template, num_lamps, keep_lamps=True, max_tilt=MAX_TILT, seed=0
+    ):
+        super().__init__()
+        if not 1 <= num_lamps <= MAX_OPTIMIZER_LAMPS:
+            raise ValueError(
+                f"Number of luminaires must be between 1 and {MAX_OPTIMIZER_LAMPS}"
+            )
+        self.room = snapshot_room(room)
+        self.template = template
+        self.num_lamps = num_lamps
+        self.keep_lamps = keep_lamps
+        self.max_tilt = max_tilt
+        self.seed = seed
+        self.generation = 0
+        self.evaluations = 0
+        self.history = []  # best fluence so far, per generation
+        self.best = None
+        self.best_fluence = None
+        self.best_hours = None
+        self.surrogate = None
+        self._start()
+
+    def _run(self):
+        self.message = "Preparing"
+        surrogate = LayoutSurrogate(
+            self.room, self.template, keep_lamps=self.keep_lamps, max_tilt=self.max_tilt
+        )
+        self.surrogate = surrogate
+        rng = np.random.default_rng(self.seed)
+        # search in units of each parameter's range, so one step size fits all;
+        # parameters with no range, e.g. tilt with a maximum of 0, stay put
+        fixed = surrogate.upper == surrogate.lower
+        fixed[3] |= fixed[2]  # without tilt, orientation changes nothing
+        span = np.where(fixed, 1, surrogate.upper - surrogate.lower)
+        mean = (starting_layout(self.room, self.num_lamps) - surrogate.lower) / span
+        step = np.where(fixed, 0, np.full(mean.shape, 0.2))
+        best_score = -np.inf
+        self.message = "Searching"
+        for generation in range(OPTIMIZER_GENERATIONS):
+            if self._cancel_event.is_set():
+                raise CalculationCancelled
+            samples = mean + step * rng.standard_normal(
+                (OPTIMIZER_POPULATION - 1,) + mean.shape
+            )
+            samples = np.concatenate([mean[None], samples])
+            layouts = surrogate.snap(surrogate.lower + samples * span)
+            fluence, hours = surrogate.score(layouts)
+            scores = layout_score(fluence, hours)
+            self.evaluations += len(layouts)
+
+            top = np.argsort(scores)[::-1][:OPTIMIZER_ELITES]
+            if scores[top[0]] > best_score:
+                best_score = scores[top[0]]
+                self.best = layouts[top[0]]
+                self.best_fluence = float(fluence[top[0]])
+                self.best_hours = float(hours[top[0]])
+            elites = (layouts[top] - surrogate.lower) / span
+            mean, std = elite_stats(elites)
+            step = np.where(fixed, 0, np.clip(std, MIN_STEP / 2, 0.3))
+            self.generation = generation + 1
+            self.history.append(self.best_fluence)
+            self.progress = self.generation / OPTIMIZER_GENERATIONS
+            if step.max() < MIN_STEP:
+                break
+        self.progress = 1.0
+        self.message = "Done"
+        self.finished_at = time.monotonic()
+        return self.best
+
+    @property
+    def compliant(self):
+        """whether the best layout is within the TLV, on the surrogate"""
+        return self.best_hours is not None and self.best_hours >= TLV_HOURS
+
+    def layout(self):
+        """the best layout as a list of {"x", "y", "z", "tilt", "orientation"}"""
+        return [
+            {
+                **{field: float(val) for field, val in zip(POSE_FIELDS, pose)},
+                "z": float(self.surrogate.z),
+            }
+            for pose in self.best
+        ]
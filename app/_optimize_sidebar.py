@@ -0,0 +1,222 @@
+import pandas as pd
+import streamlit as st
+from guv_calcs.lamp import Lamp
+from app._fetch import UpstreamUnavailable
+from app._optimize import MAX_OPTIMIZER_LAMPS, MAX_TILT, TLV_HOURS, OptimizeJob
+from app._photometry import load_lamp_file, load_lamp_spectra
+from app._spectral import WEIGHTS_URL, get_weightings
+from app._top_ribbon import calculate
+from app._uploads import UploadMissing
+from app._website_helpers import add_new_lamp
+from app._widget import (
+    close_sidebar,
+    get_lamp_file_data,
+    initialize_optimize,
+    remove_lamp,
+    update_optimize_settings,
+)
+
+SELECT_LOCAL = "Select local file..."
+ss = st.session_state
+
+
+def layout_lamp_options():
+    """the lamp files a layout can be made of"""
+    return [fname for fname in ss.lampfile_options if fname not in [None, SELECT_LOCAL]]
+
+
+def show_optimize(room):
+    """update sidebar to show the layout optimizer"""
+    if "optimize_settings" not in ss:
+        options = layout_lamp_options()
+        # start from a luminaire that's already in the room, if there is one
+        in_room = [lamp.filename for lamp in room.lamps.values()] + options
+        ss.optimize_settings = {
+            "lamp": next((f for f in in_room if f in options), None),
+            "count": 2,
+            "max_tilt": float(MAX_TILT),
+            "keep_lamps": True,
+        }
+    ss.editing = "optimize"
+
+
+def start_optimize(room):
+    """start searching in the background, replacing any search already running"""
+    job = ss.get("optimize_job")
+    if job is not None and job.running:
+        job.cancel()
+    settings = ss.optimize_settings
+    fname = settings["lamp"]
+    try:
+        fdata, spectra_data = get_lamp_file_data(fname)
+    except UpstreamUnavailable:
+        st.warning(
+            f"{fname} could not be downloaded right now. Please try again shortly."
+        )
+        return
+    except UploadMissing as e:
+        st.warning(f"{e}. Please upload it again.")
+        return
+    template = Lamp(
+        lamp_id="_optimize",
+        spectral_weight_source=WEIGHTS_URL,
+        spectral_weightings=get_weightings(),
+    )
+    load_lamp_file(template, filename=fname, filedata=fdata)
+    load_lamp_spectra(template, spectra_data)
+    try:
+        ss.optimize_job = OptimizeJob(
+            room,
+            template,
+            settings["count"],
+            keep_lamps=settings["keep_lamps"],
+            max_tilt=settings["max_tilt"],
+        )
+    except ValueError as e:
+        st.error(str(e))
+
+
+def cancel_optimize():
+    job = ss.get("optimize_job")
+    if job is not None:
+        job.cancel()
+
+
+def apply_layout(room):
+    """add the best layout to the room as ordinary luminaires, and calculate"""
+    job = ss.optimize_job
+    if not job.keep_lamps:
+        for lamp in list(room.lamps.values()):
+            remove_lamp(lamp)
+            room.remove_lamp(lamp.lamp_id)
+    template = job.template
+    for pose in job.layout():
+        lamp_id = add_new_lamp(room, interactive=False, defaults=pose)
+        lamp = room.lamps[lamp_id]
+        load_lamp_file(lamp, filename=template.filename, filedata=template.filedata)
+        load_lamp_spectra(lamp, template.spectra_source)
+    ss.optimize_applied = id(job)
+    calculate(room)
+
+
+def optimize_sidebar(room):
+    """sidebar content for searching for the best layout of a luminaire"""
+    cols = st.columns([10, 1])
+    cols[0].subheader("Optimize Layout")
+    cols[1].button(
+        "X",
+        on_click=close_sidebar,
+        args=[room],
+        use_container_width=True,
+        key="close_optimize",
+    )
+    initialize_optimize()
+    st.write(
+        f"Find where to place luminaires, and how to aim them, for the highest average fluence while staying within {TLV_HOURS} hours to TLV for skin and eyes."
+    )
+    st.selectbox(
+        "Luminaire",
+        layout_lamp_options(),
+        on_change=update_optimize_settings,
+        key="optimize_lamp",
+    )
+    cols = st.columns(2)
+    cols[0].number_input(
+        "Number of luminaires",
+        min_value=1,
+        max_value=MAX_OPTIMIZER_LAMPS,
+        step=1,
+        on_change=update_optimize_settings,
+        key="optimize_count",
+    )
+    cols[1].number_input(
+        "Maximum tilt",
+        min_value=0.0,
+        max_value=float(MAX_TILT),
+        step=5.0,
+        on_change=update_optimize_settings,
+        key="optimize_max_tilt",
+    )
+    st.checkbox(
+        "Keep existing luminaires",
+        on_change=update_optimize_settings,
+        key="optimize_keep_lamps",
+        help="Place the new luminaires around the ones already in the room. Otherwise, they replace them.",
+    )
+    st.button(
+        "Find Layout",
+        on_click=start_optimize,
+        args=[room],
+        type="primary",
+        use_container_width=True,
+        disabled=ss.optimize_settings["lamp"] is None,
+        key="run_optimize",
+    )
+    optimize_status(room)
+
+
+def optimize_status(room):
+    """progress of the search while it runs, and the layout it found once done"""
+    job = ss.get("optimize_job")
+    if job is None:
+        return
+    if job.running:
+        optimize_progress()
+    elif job.error is not None:
+        st.error(f"Layout search failed: {job.error}")
+    elif job.cancelled:
+        st.info("Layout search cancelled.")
+    elif job.succeeded:
+        optimize_results(room, job)
+
+
+@st.experimental_fragment(run_every=0.5)
+def optimize_progress():
+    """progress bar and cancel button, polled while the search runs"""
+    job = ss.get("optimize_job")
+    if job is None:
+        return
+    if job.running:
+        cols = st.columns([6, 1])
+        text = f"{job.message}... generation {job.generation}"
+        if job.best_fluence is not None:
+            fluence = round(job.best_fluence, 3)
+            text += f", best estimated average fluence {fluence} μW/cm2"
+        cols[0].progress(job.progress, text=text)
+        cols[1].button(
+            "Cancel",
+            on_click=cancel_optimize,
+            use_container_width=True,
+            key="cancel_optimize",
+        )
+    else:
+        st.rerun()
+
+
+def optimize_results(room, job):
+    """the best layout found, and a button to add it to the room"""
+    st.subheader("Layout", divider="grey")
+    st.caption(
+        f"{job.evaluations} layouts tried in {round(job.elapsed, 1)} seconds. The average fluence is estimated on a reduced-resolution grid; the room's results show the exact value once the layout is added."
+    )
+    st.write(f"Estimated average fluence: **{round(job.best_fluence, 3)} μW/cm2**")
+    st.write(f"Hours to TLV: **{round(job.best_hours, 2)}**")
+    if not job.compliant:
+        dimming = round(100 * job.best_hours / TLV_HOURS)
+        st.warning(
+            f"No layout within {TLV_HOURS} hours to TLV was found. This is the closest; it would need to be dimmed to about {dimming}% to comply."
+        )
+    layout = pd.DataFrame(job.layout())
+    layout.index = [f"{job.template.filename} {i + 1}" for i in range(len(layout))]
+    layout.columns = [col.title() for col in layout.columns]
+    st.dataframe(layout.round(2))
+    applied = ss.get("optimize_applied") == id(job)
+    st.button(
+        "Add to Room" if not applied else "Added to Room",
+        on_click=apply_layout,
+        args=[room],
+        type="primary",
+        disabled=applied,
+        use_container_width=True,
+        key="apply_optimize",
+    )
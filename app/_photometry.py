@@ -0,0 +1,161 @@
+import threading
+from functools import lru_cache
+from pathlib import Path
+import numpy as np
+from guv_calcs.lamp import Lamp
+from app._blob_cache import content_hash
+from app._spectral import SpectralProfile, get_weightings
+
+WEIGHTS_URL = "data/UV Spectral Weighting Curves.csv"
+
+# attributes that Lamp._load and Lamp._orient derive from the ies file alone
+PHOTOMETRY_KEYS = [
+    "lampdict",
+    "valdict",
+    "thetas",
+    "phis",
+    "values",
+    "interpdict",
+    "units",
+    "dimensions",
+    "input_watts",
+    "keywords",
+    "radiation_type",
+    "coords",
+    "photometric_coords",
+]
+
+
+class PhotometryRegistry:
+    """
+    Process-wide, content-addressed store of parsed lamp files.
+
+    Each distinct ies file is parsed (and its unit-sphere coordinates computed)
+    exactly once; each distinct spectrum file is parsed, weighted and reduced to
+    a SpectralProfile once. Lamps
+    then point at the shared entries rather than holding their own copies, so
+    memory grows with the number of distinct files rather than the number of
+    lamps. Entries are treated as immutable - arrays are flagged read-only.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._photometry = {}  # sha256 -> dict of lamp attributes
+        self._spectra = {}  # sha256 -> (spectra dict, SpectralProfile)
+        self.hits = 0
+        self.misses = 0
+
+    def get_photometry(self, filedata):
+        """parsed photometry for this ies file, parsing it only on first sight"""
+        digest = content_hash(filedata)
+        with self._lock:
+            entry = self._photometry.get(digest)
+            if entry is not None:
+                self.hits += 1
+                return digest, entry
+        # parse outside the lock; a duplicate parse on a race is harmless
+        entry = _parse_photometry(filedata)
+        with self._lock:
+            self.misses += 1
+            entry = self._photometry.setdefault(digest, entry)
+        return digest, entry
+
+    def get_spectra(self, spectra_data):
+        """
+        parsed + weighted spectra for this csv file, and its SpectralProfile,
+        parsing it only on first sight
+        """
+        digest = content_hash(spectra_data)
+        with self._lock:
+            entry = self._spectra.get(digest)
+            if entry is not None:
+                self.hits += 1
+                return digest, entry
+        entry = _parse_spectra(spectra_data)
+        with self._lock:
+            self.misses += 1
+            entry = self._spectra.setdefault(digest, entry)
+        return digest, entry
+
+    def stats(self):
+        return {
+            "photometry_entries": len(self._photometry),
+            "spectra_entries": len(self._spectra),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+def _freeze(val):
+    """mark arrays (including those nested in dicts) read-only"""
+    if isinstance(val, np.ndarray):
+        val.setflags(write=False)
+    elif isinstance(val, dict):
+        for v in val.values():
+            _freeze(v)
+    return val
+
+
+def _parse_photometry(filedata):
+    """run the library's own loader once on a scratch lamp and keep the results"""
+    scratch = Lamp(lamp_id="_scratch", filedata=filedata)
+    return {key: _freeze(getattr(scratch, key)) for key in PHOTOMETRY_KEYS}
+
+
+def _parse_spectra(spectra_data):
+    """parse and weight a spectrum once, storing every curve as a read-only array"""
+    scratch = Lamp(
+        lamp_id="_scratch",
+        spectra_source=spectra_data,
+        spectral_weight_source=WEIGHTS_URL,
+        spectral_weightings=get_weightings(),
+    )
+    spectra = {key: _freeze(np.asarray(val)) for key, val in scratch.spectra.items()}
+    return spectra, SpectralProfile(spectra, get_weightings())
+
+
+@lru_cache(maxsize=None)
+def get_registry():
+    """the one PhotometryRegistry shared by every session in this process"""
+    return PhotometryRegistry()
+
+
+def load_lamp_file(lamp, filename=None, filedata=None):
+    """
+    drop-in replacement for `lamp.reload` that points the lamp at shared,
+    already-parsed photometry instead of re-reading the ies file
+    """
+    if isinstance(filedata, (str, Path)) and Path(filedata).is_file():
+        filedata = Path(filedata).read_bytes()
+    if filedata is None:
+        lamp.reload(filename=filename, filedata=None)
+        lamp.photometry_hash = None
+        return lamp
+
+    digest, entry = get_registry().get_photometry(filedata)
+    lamp.filename = filename
+    lamp.filedata = filedata
+    for key, val in entry.items():
+        setattr(lamp, key, val)
+    lamp.photometry_hash = digest
+    return lamp
+
+
+def load_lamp_spectra(lamp, spectra_data=None):
+    """
+    drop-in replacement for `lamp.load_spectra` that points the lamp at a
+    shared, already-weighted spectrum instead of re-parsing the csv
+    """
+    lamp.spectra_source = spectra_data
+    if spectra_data is None:
+        lamp.spectra = {}
+        lamp.spectra_hash = None
+        lamp.spectral_profile = None
+        return lamp
+
+    digest, (spectra, profile) = get_registry().get_spectra(spectra_data)
+    # the dict is shared; lamps only ever rebind it, never mutate it
+    lamp.spectra = spectra
+    lamp.spectra_hash = digest
+    lamp.spectral_profile = profile
+    return lamp
@@ -0,0 +1,70 @@
+import threading
+from functools import lru_cache
+import numpy as np
+
+PLACEMENTS_CACHED = 256  # placements worked out up front for each grid size
+
+
+class PlacementSequence:
+    """
+    Greedy max-min placement of points on a grid: the first in the center, and
+    each after it on the free cell farthest from both the points so far and
+    the edge of the grid, ties going to the first such cell in x-major order.
+
+    The distance from every cell to its nearest point is kept as an array and
+    updated as each point is placed, so extending the sequence by one costs a
+    single vectorized pass over the grid, and placed points are never redone.
+    """
+
+    def __init__(self, grid_size):
+        M, N = grid_size
+        self._lock = threading.Lock()
+        self._x, self._y = np.indices(grid_size)
+        self._boundary = np.minimum.reduce(
+            [self._x, M - 1 - self._x, self._y, N - 1 - self._y]
+        )
+        self._nearest = np.full(grid_size, np.inf)
+        self._free = np.ones(grid_size, dtype=bool)
+        self.points = []
+        self._add((M // 2, N // 2))
+
+    def _add(self, point):
+        px, py = point
+        dist = np.sqrt((self._x - px) ** 2 + (self._y - py) ** 2)
+        np.minimum(self._nearest, dist, out=self._nearest)
+        self._free[point] = False
+        self.points.append(point)
+
+    def extend(self, num_points):
+        """
+        the first `num_points` points (at least one), placing any that haven't
+        been yet. fewer are returned if the grid fills up.
+        """
+        with self._lock:
+            while len(self.points) < num_points and self._free.any():
+                score = np.minimum(self._nearest, self._boundary)
+                score[~self._free] = -1
+                x, y = np.unravel_index(np.argmax(score), score.shape)
+                self._add((int(x), int(y)))
+        return self.points[: max(num_points, 1)]
+
+
+@lru_cache(maxsize=None)
+def get_placement_sequence(grid_size):
+    """the PlacementSequence for a grid size, shared by every session"""
+    sequence = PlacementSequence(grid_size)
+    sequence.extend(PLACEMENTS_CACHED)
+    return sequence
+
+
+def get_lamp_position(lamp_idx, x, y, num_divisions=100):
+    """get the default position for an additional new lamp"""
+    xp = np.linspace(0, x, num_divisions + 1)
+    yp = np.linspace(0, y, num_divisions + 1)
+    xidx, yidx = _get_idx(lamp_idx, num_divisions=num_divisions)
+    return xp[xidx], yp[yidx]
+
+
+def _get_idx(num_points, num_divisions=100):
+    grid_size = (num_divisions, num_divisions)
+    return get_placement_sequence(grid_size).extend(num_points)[-1]
@@ -1,6 +1,37 @@
+from functools import lru_cache
 import streamlit as st
+import numpy as np
+import pandas as pd
 import seaborn as sns
-import matplotlib.pyplot as plt
+import plotly.graph_objs as go
+from scipy.spatial import Delaunay
+from matplotlib.figure import Figure
+from matplotlib.collections import PathCollection, PolyCollection
+from matplotlib.lines import Line2D
+from guv_calcs.calc_zone import CalcPlane, CalcVol
+from guv_calcs.trigonometry import to_polar
+from app._disinfection import get_disinfection_index
+from app._sweep import METRICS
+
+# trace colours, as guv_calcs draws them
+SELECTED_COLOR = "#cc61ff"
+ENABLED_COLOR = "#5e8ff7"
+DISABLED_COLOR = "#d1d1d1"
+# the edges of a volume's box, as indices into its corners
+BOX_EDGES = [
+    (0, 1),
+    (1, 2),
+    (2, 3),
+    (3, 0),  # bottom face
+    (4, 5),
+    (5, 6),
+    (6, 7),
+    (7, 4),  # top face
+    (0, 4),
+    (1, 5),
+    (2, 6),
+    (3, 7),  # side edges
+]
 
 ss = st.session_state
 
@@ -12,8 +43,6 @@ def room_plot(room):
         select_id = ss.selected_zone_id
     else:
         select_id = None
-    fig = room.plotly(fig=ss.fig, select_id=select_id)
-
     if ss.show_results:
         if ss.editing is None:
             ar_scale = 0.5
@@ -25,62 +54,452 @@ def room_plot(room):
         else:
             ar_scale = 0.6
     # ar_scale = 0.8 if (ss.editing != "results") else 0.5
-    fig.layout.scene.aspectratio.x *= ar_scale
-    fig.layout.scene.aspectratio.y *= ar_scale
-    fig.layout.scene.aspectratio.z *= ar_scale
-    fig.layout.scene.xaxis.range = fig.layout.scene.xaxis.range[::-1]
+    if "room_figure" not in ss:
+        ss.room_figure = RoomFigure()
+    fig = ss.room_figure.update(room, select_id=select_id, scale=ar_scale)
 
     st.plotly_chart(fig, use_container_width=True, height=750)
 
 
-def plot_species(df, fluence):
-    """violin (kde) and swarmplots showing eACH and CADR for variety of species that have had k measured at 222nm in aerosol"""
-    # Plot configuration
-    fig, ax1 = plt.subplots(figsize=(8, 5))
-    sns.violinplot(
-        data=df,
-        x="Species",
-        y="eACH-UV",
-        hue="Kingdom",
-        hue_order=["Bacteria", "Virus"],
-        inner=None,
-        ax=ax1,
-        alpha=0.5,
-        legend=False,
-    )
-    sns.swarmplot(
-        data=df,
-        x="Species",
-        y="eACH-UV",
-        hue="Kingdom",
-        hue_order=["Bacteria", "Virus"],
-        ax=ax1,
-        size=8,
-        alpha=0.9,
+def _color(select_id, trace_id, enabled):
+    if not enabled:
+        return DISABLED_COLOR
+    if select_id is not None and select_id == trace_id:
+        return SELECTED_COLOR
+    return ENABLED_COLOR
+
+
+class RoomFigure:
+    """
+    The 3D room plot, kept as a set of traces keyed by id - one per lamp, lamp
+    aim line, zone and volume isosurface - drawn as `Room.plotly` draws them.
+
+    Each trace remembers the geometry it was drawn from and its style. On
+    `update`, a trace is only rebuilt if its geometry changed (a lamp's pose
+    or photometry, a zone's extent or grid, a volume's values), only
+    restyled if just its colour or name did, and dropped along with its
+    lamp or zone; the layout is only touched if the room's size did. So an
+    unchanged room leaves the figure exactly as it was, and it serializes to
+    the same bytes, which Streamlit sends to the browser as a reference to
+    the copy it already has. `version` counts the updates that changed it.
+    """
+
+    def __init__(self):
+        self.fig = go.Figure()
+        self.version = 0
+        self._drawn = {}  # uid -> (geometry, objects it refers to by id, style)
+        self._layout = None
+        self._triangulations = {}  # id(photometric coords) -> (coords, simplices)
+
+    def update(self, room, select_id=None, scale=1.0):
+        """bring the figure up to date with `room`, and return it"""
+        # an invisible trace, so the scene shows even with nothing in it
+        specs = {
+            "placeholder": (
+                (),
+                (),
+                {},
+                lambda: go.Scatter3d(
+                    x=[0],
+                    y=[0],
+                    z=[0],
+                    opacity=0,
+                    showlegend=False,
+                    customdata=["placeholder"],
+                ),
+            )
+        }
+        in_use = []  # photometric coords of lamps being drawn
+        for lamp in room.lamps.values():
+            if lamp.filedata is not None:
+                specs.update(self._lamp_specs(lamp, select_id))
+                in_use.append(id(lamp.photometric_coords))
+        for zone in room.calc_zones.values():
+            if isinstance(zone, CalcPlane):
+                specs.update(_plane_specs(zone, select_id))
+            elif isinstance(zone, CalcVol):
+                specs.update(_vol_specs(zone, select_id))
+        changed = self._sync(specs)
+
+        self._triangulations = {
+            key: val for key, val in self._triangulations.items() if key in in_use
+        }
+        layout = (room.x, room.y, room.z, scale)
+        if layout != self._layout:
+            self.fig.update_layout(**_room_layout(*layout))
+            self._layout = layout
+            changed = True
+        if changed:
+            self.version += 1
+        return self.fig
+
+    def _sync(self, specs):
+        """
+        make the figure's traces match `specs`, {uid: (geometry, refs, style,
+        make)}, in order; returns whether anything changed
+        """
+        kept = [
+            trace
+            for trace in self.fig.data
+            if trace.uid in specs and specs[trace.uid][0] == self._drawn[trace.uid][0]
+        ]
+        changed = len(kept) < len(self.fig.data)
+        if changed:
+            self.fig.data = kept
+        for trace in kept:
+            style = specs[trace.uid][2]
+            if style != self._drawn[trace.uid][2]:
+                trace.update(style)
+                changed = True
+        kept_uids = {trace.uid for trace in kept}
+        new = []
+        for uid, (_, _, style, make) in specs.items():
+            if uid not in kept_uids:
+                trace = make()
+                trace.update(style, uid=uid)
+                new.append(trace)
+        if new:
+            self.fig.add_traces(new)
+            changed = True
+        self._drawn = {uid: spec[:3] for uid, spec in specs.items()}
+
+        order = {uid: i for i, uid in enumerate(specs)}
+        if [trace.uid for trace in self.fig.data] != list(specs):
+            self.fig.data = sorted(self.fig.data, key=lambda trace: order[trace.uid])
+        return changed
+
+    def _lamp_specs(self, lamp, select_id):
+        coords, values = lamp.photometric_coords, lamp.values
+        pose = (lamp.x, lamp.y, lamp.z, lamp.angle, lamp.heading, lamp.bank)
+        aim = (lamp.x, lamp.y, lamp.z, lamp.aimx, lamp.aimy, lamp.aimz)
+        color = _color(select_id, lamp.lamp_id, lamp.enabled)
+        aim_id = lamp.lamp_id + "_aim"
+        return {
+            lamp.lamp_id: (
+                (pose, id(coords), id(values)),
+                (coords, values),
+                {"color": color, "name": lamp.name},
+                lambda: self._lamp_mesh(lamp),
+            ),
+            aim_id: (
+                aim,
+                (),
+                {"name": lamp.name},
+                lambda: go.Scatter3d(
+                    x=[lamp.x, lamp.aimx],
+                    y=[lamp.y, lamp.aimy],
+                    z=[lamp.z, lamp.aimz],
+                    mode="lines",
+                    line=dict(color="black", width=2, dash="dash"),
+                    customdata=[aim_id],
+                    showlegend=False,
+                ),
+            ),
+        }
+
+    def _lamp_mesh(self, lamp):
+        """the lamp's photometric web"""
+        coords = lamp.photometric_coords
+        x, y, z = lamp.transform(coords, scale=lamp.values.max()).T
+        simplices = self._triangulate(coords)
+        return go.Mesh3d(
+            x=x,
+            y=y,
+            z=z,
+            i=simplices[:, 0],
+            j=simplices[:, 1],
+            k=simplices[:, 2],
+            opacity=0.4,
+            customdata=[lamp.lamp_id],
+            legendgroup="lamps",
+            legendgrouptitle_text="Lamps",
+            showlegend=True,
+        )
+
+    def _triangulate(self, coords):
+        """
+        the web's triangles, which only depend on the photometry, so they're
+        shared by every lamp of the same file and kept when a lamp moves
+        """
+        cached = self._triangulations.get(id(coords))
+        if cached is None or cached[0] is not coords:
+            theta, phi, _ = to_polar(*coords.T)
+            tri = Delaunay(np.column_stack((theta.flatten(), phi.flatten())))
+            cached = self._triangulations[id(coords)] = (coords, tri.simplices)
+        return cached[1]
+
+
+def _plane_specs(zone, select_id):
+    color = _color(select_id, zone.zone_id, zone.enabled)
+    coords = zone.coords
+    return {
+        zone.zone_id: (
+            (id(coords),),
+            (coords,),
+            {"marker": {"size": 2, "color": color}, "name": zone.name},
+            lambda: go.Scatter3d(
+                x=coords.T[0],
+                y=coords.T[1],
+                z=coords.T[2],
+                mode="markers",
+                opacity=0.5,
+                legendgroup="zones",
+                legendgrouptitle_text="Calculation Zones",
+                showlegend=True,
+                customdata=[zone.zone_id],
+            ),
+        )
+    }
+
+
+def _vol_specs(zone, select_id):
+    color = _color(select_id, zone.zone_id, zone.enabled)
+    extent = (zone.x1, zone.x2, zone.y1, zone.y2, zone.z1, zone.z2)
+    specs = {
+        zone.zone_id: (
+            extent,
+            (),
+            {"line": {"color": color, "width": 5, "dash": "dot"}, "name": zone.name},
+            lambda: _box_trace(zone, *extent),
+        )
+    }
+    values, points = zone.values, zone.points
+    if values is not None and zone.show_values:
+        specs[zone.zone_id + "_values"] = (
+            (id(values), id(points)),
+            (values, points),
+            {"name": zone.name + " Values"},
+            lambda: _isosurface_trace(zone, values, points),
+        )
+    return specs
+
+
+def _box_trace(zone, x1, x2, y1, y2, z1, z2):
+    """a volume's edges, as one trace with breaks between them"""
+    corners = [
+        (x1, y1, z1),
+        (x2, y1, z1),
+        (x2, y2, z1),
+        (x1, y2, z1),
+        (x1, y1, z2),
+        (x2, y1, z2),
+        (x2, y2, z2),
+        (x1, y2, z2),
+    ]
+    x_coords, y_coords, z_coords = [], [], []
+    for v1, v2 in BOX_EDGES:
+        x_coords.extend([corners[v1][0], corners[v2][0], None])
+        y_coords.extend([corners[v1][1], corners[v2][1], None])
+        z_coords.extend([corners[v1][2], corners[v2][2], None])
+    return go.Scatter3d(
+        x=x_coords,
+        y=y_coords,
+        z=z_coords,
+        mode="lines",
+        legendgroup="zones",
+        legendgrouptitle_text="Calculation Zones",
+        customdata=[zone.zone_id],
     )
-    ax1.set_ylabel("eACH-UV")
-    ax1.set_xlabel(None)
-    # ax1.tick_params(axis='y', labelcolor='b')
-    ax1.set_ylim(bottom=0)
-    ax1.grid("--")
-    ax1.set_xticks(ax1.get_xticks())
-    ax1.set_xticklabels(
-        ax1.get_xticklabels(), rotation=45, ha="right", rotation_mode="anchor"
+
+
+def _isosurface_trace(zone, values, points):
+    X, Y, Z = np.meshgrid(*points)
+    return go.Isosurface(
+        x=X.flatten(),
+        y=Y.flatten(),
+        z=Z.flatten(),
+        value=values.flatten(),
+        surface_count=3,
+        isomin=values.mean() / 2,
+        opacity=0.25,
+        showscale=False,
+        colorbar=None,
+        customdata=[zone.zone_id + "_values"],
+        legendgroup="zones",
+        legendgrouptitle_text="Calculation Zones",
+        showlegend=True,
     )
 
-    # add a second axis to show CADR
-    ax2 = ax1.twinx()
-    sns.violinplot(
-        data=df,
-        x="Species",
-        y="CADR-UV [cfm]",
-        ax=ax2,
-        alpha=0,
-        legend=False,
-        inner=None,
+
+def _room_layout(x, y, z, scale):
+    """
+    the figure layout for a room, with the x axis reversed and the scene
+    shrunk by `scale` to fit the page
+    """
+    return dict(
+        scene=dict(
+            xaxis=dict(range=[x, 0]),
+            yaxis=dict(range=[0, y]),
+            zaxis=dict(range=[0, z]),
+            aspectratio=dict(x=x / z * scale, y=y / z * scale, z=scale),
+            camera=dict(projection=dict(type="orthographic")),
+        ),
+        height=750,
+        autosize=False,
+        margin=go.layout.Margin(l=0, r=0, b=0, t=0, pad=0),
+        legend=dict(x=0, y=1, yanchor="top", xanchor="left"),
     )
-    ax2.set_ylabel("CADR-UV [cfm]")
-    ax2.set_ylim(bottom=0)
-    title = f"eACH/CADR from GUV-222 with average fluence {round(fluence,3)} uW/cm2"
-    fig.suptitle(title)
+
+
+class SpeciesChart:
+    """
+    The species eACH/CADR chart for one disinfection dataset, laid out once.
+
+    eACH and CADR are proportional to the average fluence, and the chart's
+    axes scale with the data, so the violin (kde) shapes and swarm positions
+    are the same for every fluence up to a stretch of the y axis. They are
+    computed once, at 1 uW/cm2, and `render` just redraws them scaled.
+    """
+
+    def __init__(self, group):
+        df = pd.DataFrame(
+            {
+                "Species": group.species,
+                "Kingdom": group.kingdom,
+                "eACH-UV": group.eACH(1),
+            }
+        )
+        # lay the chart out exactly as seaborn would, then keep its geometry
+        fig = Figure(figsize=(8, 5))
+        ax1 = fig.subplots()
+        sns.violinplot(
+            data=df,
+            x="Species",
+            y="eACH-UV",
+            hue="Kingdom",
+            hue_order=["Bacteria", "Virus"],
+            inner=None,
+            ax=ax1,
+            alpha=0.5,
+            legend=False,
+        )
+        sns.swarmplot(
+            data=df,
+            x="Species",
+            y="eACH-UV",
+            hue="Kingdom",
+            hue_order=["Bacteria", "Virus"],
+            ax=ax1,
+            size=8,
+            alpha=0.9,
+        )
+        ax1.set_ylim(bottom=0)
+        fig.draw_without_rendering()  # swarm positions are only set on draw
+
+        self.violins, self.swarms = [], []
+        for coll in ax1.collections:
+            style = {
+                "facecolors": coll.get_facecolor(),
+                "edgecolors": coll.get_edgecolor(),
+                "linewidths": coll.get_linewidth(),
+                "alpha": coll.get_alpha(),
+                "zorder": coll.get_zorder(),
+            }
+            if isinstance(coll, PathCollection):
+                self.swarms.append((coll.get_offsets().copy(), coll.get_sizes(), style))
+            else:
+                verts = [path.vertices.copy() for path in coll.get_paths()]
+                self.violins.append((verts, style))
+        # species with a single observation get a line instead of a violin
+        self.lines = [
+            (
+                line.get_xdata(),
+                line.get_ydata(),
+                {
+                    "color": line.get_color(),
+                    "linewidth": line.get_linewidth(),
+                    "alpha": line.get_alpha(),
+                    "zorder": line.get_zorder(),
+                },
+            )
+            for line in ax1.lines
+        ]
+        self.xlim = ax1.get_xlim()
+        self.ytop = ax1.get_ylim()[1]
+        self.xticks = ax1.get_xticks()
+        self.xticklabels = [label.get_text() for label in ax1.get_xticklabels()]
+        legend = ax1.get_legend()
+        self.legend_title = legend.get_title().get_text()
+        self.legend = [
+            (
+                text.get_text(),
+                {
+                    "color": handle.get_markerfacecolor(),
+                    "markersize": handle.get_markersize(),
+                    "alpha": handle.get_alpha(),
+                },
+            )
+            for text, handle in zip(legend.get_texts(), legend.legend_handles)
+        ]
+
+    def render(self, fluence, volume):
+        """
+        the chart for an average fluence in uW/cm2 and a room volume in cubic
+        feet (which sets the CADR axis)
+        """
+        scale = fluence  # the geometry is laid out at 1 uW/cm2
+        fig = Figure(figsize=(8, 5))
+        ax1 = fig.subplots()
+        for verts, style in self.violins:
+            scaled = [v * (1, scale) for v in verts]
+            ax1.add_collection(PolyCollection(scaled, **style))
+        for xdata, ydata, style in self.lines:
+            ax1.plot(xdata, np.asarray(ydata) * scale, **style)
+        for offsets, sizes, style in self.swarms:
+            ax1.scatter(offsets[:, 0], offsets[:, 1] * scale, s=sizes, **style)
+        ax1.set_xlim(self.xlim)
+        ax1.set_ylim(0, self.ytop * scale)
+        ax1.set_ylabel("eACH-UV")
+        ax1.grid("--")
+        ax1.set_xticks(self.xticks)
+        ax1.set_xticklabels(
+            self.xticklabels, rotation=45, ha="right", rotation_mode="anchor"
+        )
+        handles = [
+            Line2D([], [], marker="o", linestyle="", **style)
+            for _, style in self.legend
+        ]
+        labels = [label for label, _ in self.legend]
+        ax1.legend(handles, labels, title=self.legend_title)
+
+        # second axis shows CADR, which is eACH scaled by the room volume
+        ax2 = ax1.twinx()
+        ax2.set_ylim(0, self.ytop * scale * volume / 60)
+        ax2.set_ylabel("CADR-UV [cfm]")
+        title = f"eACH/CADR from GUV-222 with average fluence {round(fluence,3)} uW/cm2"
+        fig.suptitle(title)
+        return fig
+
+
+@lru_cache(maxsize=None)
+def get_species_chart(medium="Aerosol", wavelength=222):
+    """SpeciesChart for a disinfection dataset, laid out once per process"""
+    return SpeciesChart(get_disinfection_index().get(medium, wavelength))
+
+
+def plot_species(fluence, volume):
+    """violin (kde) and swarmplots showing eACH and CADR for variety of species that have had k measured at 222nm in aerosol"""
+    return get_species_chart("Aerosol", 222).render(fluence, volume)
+
+
+def plot_sweep(tables, x_label, y_label=None):
+    """
+    heatmaps of the headline metrics of a parameter sweep, from the tables of
+    `_sweep.sweep_slice`
+    """
+    # darker is better for fluence, and worse for doses and hours to tlv
+    cmaps = {
+        "fluence_mean": "mako_r",
+        "skin_max": "rocket_r",
+        "eye_max": "rocket_r",
+        "hours_to_tlv": "rocket",
+    }
+    fig = Figure(figsize=(10, 8), layout="constrained")
+    axes = fig.subplots(2, 2).ravel()
+    for ax, (metric, cmap) in zip(axes, cmaps.items()):
+        table = tables[metric]
+        sns.heatmap(table, ax=ax, annot=True, fmt=".3g", cmap=cmap, cbar=False)
+        ax.set_title(METRICS[metric])
+        ax.set_xlabel(x_label)
+        ax.set_ylabel("" if y_label is None else y_label)
     return fig
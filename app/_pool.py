@@ -0,0 +1,253 @@
+import os
+import atexit
+import logging
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from multiprocessing import get_context
+from multiprocessing.shared_memory import SharedMemory
+from concurrent.futures import ProcessPoolExecutor, as_completed, wait
+from concurrent.futures.process import BrokenProcessPool
+import numpy as np
+from app._kernel import CHUNK_ELEMENTS, LampBatch, batches, evaluate_zone
+
+logger = logging.getLogger(__name__)
+
+# worker processes for evaluating zones; set GUV_CALC_PROCESSES=1 to disable
+CALC_PROCESSES = int(os.environ.get("GUV_CALC_PROCESSES", os.cpu_count() or 1))
+# below this many lamp x point evaluations, the pool costs more than it saves
+PARALLEL_MIN_ELEMENTS = 2 ** 21
+TILES_PER_PROCESS = 4  # more tiles than processes, for load balancing and progress
+SHARED_TABLE_BLOCKS = 16  # sets of candela tables kept in shared memory
+
+BATCH_FIELDS = [
+    "lamp_ids",
+    "positions",
+    "rotations",
+    "thetamap",
+    "phimap",
+    "table_index",
+]
+
+
+@lru_cache(maxsize=None)
+def get_process_pool():
+    """process pool shared by every session's calculations"""
+    return ProcessPoolExecutor(
+        max_workers=CALC_PROCESSES, mp_context=get_context("spawn")
+    )
+
+
+def _share(array):
+    """copy `array` into a new shared memory block"""
+    shm = SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+    return shm
+
+
+def _spec(shm, array):
+    """what a worker needs to attach to the array in `shm`"""
+    return (shm.name, array.shape, array.dtype.str)
+
+
+def _release(shm):
+    shm.close()
+    try:
+        shm.unlink()
+    except FileNotFoundError:
+        pass
+
+
+class SharedTables:
+    """
+    Candela tables published to shared memory for the pool's workers.
+
+    Blocks are keyed by the set of ies files in a LampBatch. Tables depend only
+    on file contents, so a block is written the first time a set of files is
+    evaluated and reused by every later calculation with the same files, and
+    workers keep their attachments open between tasks - photometry is never
+    pickled. Blocks in use by a running calculation are pinned; beyond
+    `max_blocks`, the least recently used unpinned blocks are unlinked.
+    """
+
+    def __init__(self, max_blocks=SHARED_TABLE_BLOCKS):
+        self.max_blocks = max_blocks
+        self._lock = threading.Lock()
+        self._blocks = OrderedDict()  # table_keys -> (SharedMemory, spec)
+        self._pins = {}  # table_keys -> number of calculations using the block
+
+    def acquire(self, batch):
+        """spec of a shared block holding `batch.tables`, pinned until released"""
+        key = batch.table_keys
+        with self._lock:
+            if key in self._blocks:
+                self._blocks.move_to_end(key)
+            else:
+                shm = _share(batch.tables)
+                self._blocks[key] = (shm, _spec(shm, batch.tables))
+            self._pins[key] = self._pins.get(key, 0) + 1
+            self._evict()
+            return self._blocks[key][1]
+
+    def release(self, batch):
+        key = batch.table_keys
+        with self._lock:
+            self._pins[key] -= 1
+            if not self._pins[key]:
+                del self._pins[key]
+            self._evict()
+
+    def _evict(self):
+        unpinned = [key for key in self._blocks if key not in self._pins]
+        for key in unpinned[: max(len(self._blocks) - self.max_blocks, 0)]:
+            shm, _ = self._blocks.pop(key)
+            _release(shm)
+
+    def close(self):
+        with self._lock:
+            for shm, _ in self._blocks.values():
+                _release(shm)
+            self._blocks.clear()
+
+
+@lru_cache(maxsize=None)
+def get_shared_tables():
+    """the SharedTables for this process; its blocks are unlinked at exit"""
+    tables = SharedTables()
+    atexit.register(tables.close)
+    return tables
+
+
+# worker side: table blocks this worker has attached to, most recent last
+_attached = OrderedDict()
+
+
+def _attach_tables(spec):
+    name, shape, dtype = spec
+    if name in _attached:
+        _attached.move_to_end(name)
+        return _attached[name][1]
+    shm = SharedMemory(name=name)
+    tables = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    tables.setflags(write=False)
+    _attached[name] = (shm, tables)
+    while len(_attached) > SHARED_TABLE_BLOCKS:
+        _, (old, _) = _attached.popitem(last=False)
+        old.close()
+    return tables
+
+
+def _evaluate_tile(
+    state, tables_spec, coords_spec, out_spec, rows, start, stop, flags, scale
+):
+    """
+    evaluate one batch of lamps at points start:stop, writing the results into
+    rows of the shared output block. returns each lamp's max irradiance.
+    """
+    batch = LampBatch(tables=_attach_tables(tables_spec), **state)
+    coords_shm = SharedMemory(name=coords_spec[0])
+    out_shm = SharedMemory(name=out_spec[0])
+    try:
+        coords = np.ndarray(coords_spec[1], dtype=coords_spec[2], buffer=coords_shm.buf)
+        out = np.ndarray(out_spec[1], dtype=out_spec[2], buffer=out_shm.buf)
+        irradiance = batch.evaluate(coords[start:stop], **flags)
+        first, last = rows
+        if last - first == len(batch):  # a row per lamp
+            out[first:last, start:stop] = irradiance * scale
+        else:  # a single row for the batch's total
+            out[first, start:stop] = irradiance.sum(axis=0) * scale
+        del coords, out  # views must go before their blocks are closed
+        return irradiance.max(axis=1)
+    finally:
+        coords_shm.close()
+        out_shm.close()
+
+
+def evaluate_zone_parallel(lamps, zone, per_lamp=True, on_chunk=None):
+    """
+    same as `_kernel.evaluate_zone`, but with the zone's points split into tiles
+    that are evaluated across the process pool. small zones, and pools of a
+    single process, are evaluated in this process instead.
+    """
+    num_points = zone.coords.shape[0]
+    if CALC_PROCESSES <= 1 or len(lamps) * num_points < PARALLEL_MIN_ELEMENTS:
+        return evaluate_zone(lamps, zone, per_lamp=per_lamp, on_chunk=on_chunk)
+    try:
+        return _evaluate_on_pool(lamps, zone, per_lamp, on_chunk)
+    except BrokenProcessPool:
+        logger.warning("Calculation pool failed, evaluating in-process instead")
+        get_process_pool.cache_clear()
+        return evaluate_zone(lamps, zone, per_lamp=per_lamp, on_chunk=on_chunk)
+
+
+def _evaluate_on_pool(lamps, zone, per_lamp, on_chunk):
+    lamp_batches = batches(lamps)
+    num_points = zone.coords.shape[0]
+    scale = 3.6 * zone.hours if zone.dose else 1
+    flags = dict(fov80=zone.fov80, vert=zone.vert, horiz=zone.horiz)
+    # one output row per lamp, or, if only the total is wanted, per batch
+    num_rows = len(lamps) if per_lamp else len(lamp_batches)
+
+    coords = np.ascontiguousarray(zone.coords, dtype=float)
+    coords_shm = _share(coords)
+    out_shm = SharedMemory(create=True, size=num_rows * num_points * 8)
+    out = np.ndarray((num_rows, num_points), dtype=float, buffer=out_shm.buf)
+    out_spec = _spec(out_shm, out)
+    shared_tables = get_shared_tables()
+    acquired = []
+    futures = {}
+    try:
+        row = 0
+        for b, batch in enumerate(lamp_batches):
+            tables_spec = shared_tables.acquire(batch)
+            acquired.append(batch)
+            state = {key: getattr(batch, key) for key in BATCH_FIELDS}
+            rows = (row, row + len(batch)) if per_lamp else (b, b + 1)
+            row += len(batch)
+            tile = min(
+                max(CHUNK_ELEMENTS // len(batch), 1),
+                -(-num_points // (CALC_PROCESSES * TILES_PER_PROCESS)),
+            )
+            for start in range(0, num_points, tile):
+                future = get_process_pool().submit(
+                    _evaluate_tile,
+                    state,
+                    tables_spec,
+                    _spec(coords_shm, coords),
+                    out_spec,
+                    rows,
+                    start,
+                    min(start + tile, num_points),
+                    flags,
+                    scale,
+                )
+                futures[future] = b
+
+        batch_maxes = [np.full(len(batch), -np.inf) for batch in lamp_batches]
+        for done, future in enumerate(as_completed(futures)):
+            if on_chunk is not None:
+                on_chunk(done / len(futures))
+            b = futures[future]
+            batch_maxes[b] = np.maximum(batch_maxes[b], future.result())
+
+        total = out.sum(axis=0).reshape(*zone.num_points)
+        values = {} if per_lamp else None
+        maxes = {}
+        row = 0
+        for batch, batch_max in zip(lamp_batches, batch_maxes):
+            for i, lamp_id in enumerate(batch.lamp_ids):
+                maxes[lamp_id] = batch_max[i]
+                if per_lamp:
+                    values[lamp_id] = out[row + i].reshape(*zone.num_points).copy()
+            row += len(batch)
+        return values, total, maxes
+    finally:
+        # workers may still be writing if we're here early; let them finish
+        for future in futures:
+            future.cancel()
+        wait(futures)
+        for batch in acquired:
+            shared_tables.release(batch)
+        del out
+        _release(coords_shm)
+        _release(out_shm)
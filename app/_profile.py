@@ -0,0 +1,297 @@
+import sys
+import json
+import time
+import pstats
+import marshal
+import cProfile
+import threading
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime
+import streamlit as st
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+# query parameter that turns profiling on for the session that opens the page with it
+PROFILE_PARAM = "profile"
+PROFILE_RUNS = 20  # runs kept per session; older ones are dropped
+# calls under this fraction of a run's time, or this deep, aren't broken down
+# in flame graphs; their time is shown under OTHER_FRAME instead
+FLAME_MIN_FRACTION = 1e-3
+FLAME_MAX_DEPTH = 200
+OTHER_FRAME = ("~", 0, "(other)")
+# before python 3.12 a cProfile profile only sees the thread it's enabled on.
+# from 3.12 it's interpreter-wide: it sees every thread, and only one can be
+# enabled at a time
+THREAD_LOCAL_PROFILES = sys.version_info < (3, 12)
+
+ss = st.session_state
+
+
+class ProfileRun:
+    """One capture: a rerun with the callbacks that triggered it, or a background job."""
+
+    def __init__(self, label):
+        self.label = label
+        self.started = datetime.now()
+        self.seconds = None
+        self.stats = None  # pstats' {func: (cc, nc, tt, ct, callers)}
+        self.callbacks = []
+        self.profile = cProfile.Profile()
+        self._start = time.perf_counter()
+
+    def enable(self):
+        """
+        start or resume profiling; False if another profile is already running
+        and this one can't be, which only happens from python 3.12
+        """
+        try:
+            self.profile.enable()
+        except ValueError:
+            return False
+        return True
+
+    def finish(self):
+        self.profile.create_stats()  # which also disables it
+        self.stats = self.profile.stats
+        self.profile = None
+        self.seconds = time.perf_counter() - self._start
+
+    @property
+    def name(self):
+        if not self.callbacks:
+            return self.label
+        return f"{self.label} ({', '.join(self.callbacks)})"
+
+
+class SessionProfiler:
+    """
+    cProfile captures of one session's reruns, the widget callbacks before
+    each of them, and the background jobs it starts, keeping the last
+    `max_runs`.
+
+    Before python 3.12, cProfile only traces the thread it's enabled on, so
+    nothing is traced for other sessions, and work a job farms out to worker
+    processes or other threads shows up as time spent waiting on them. From
+    3.12 (see THREAD_LOCAL_PROFILES) a profile also traces every other thread
+    while it's enabled, other sessions' included, and only one can be enabled
+    at a time, so runs that start while another is being profiled are skipped.
+    """
+
+    def __init__(self, max_runs=PROFILE_RUNS):
+        self.runs = deque(maxlen=max_runs)
+        self._lock = threading.Lock()
+        self._pending = None  # callbacks run before the script's next rerun
+        self._open = None  # the rerun being profiled
+
+    def _add(self, run):
+        run.finish()
+        with self._lock:
+            self.runs.append(run)
+
+    def start(self):
+        """start profiling a rerun, from the top of the script"""
+        if self._open is not None:
+            # the last rerun was interrupted, e.g. by st.rerun
+            self._open.label = "rerun (interrupted)"
+            self._add(self._open)
+        run, self._pending = self._pending or ProfileRun("rerun"), None
+        self._open = run if run.enable() else None
+
+    def finish(self):
+        """stop profiling the rerun, at the end of the script"""
+        if self._open is not None:
+            self._add(self._open)
+            self._open = None
+
+    def callback(self, call, name):
+        """call a widget callback, adding it to the next rerun's profile"""
+        if self._pending is None:
+            self._pending = ProfileRun("rerun")
+        self._pending.callbacks.append(name)
+        if not self._pending.enable():
+            return call()
+        try:
+            call()
+        finally:
+            self._pending.profile.disable()
+
+    @contextmanager
+    def capture(self, label):
+        """profile the block, e.g. a background job, as a run of its own"""
+        run = ProfileRun(label)
+        if not run.enable():
+            yield
+            return
+        try:
+            yield
+        finally:
+            self._add(run)
+
+    def summary(self):
+        """[{"run", "started", "seconds"}] for each run kept, oldest first"""
+        with self._lock:
+            runs = list(self.runs)
+        return [
+            {
+                "run": run.name,
+                "started": run.started.strftime("%H:%M:%S"),
+                "seconds": round(run.seconds, 3),
+            }
+            for run in runs
+        ]
+
+    def pstats_file(self):
+        """every run kept, combined, in the format pstats.Stats loads"""
+        with self._lock:
+            runs = list(self.runs)
+        combined = {}
+        for run in runs:
+            for func, stat in run.stats.items():
+                if func in combined:
+                    stat = pstats.add_func_stats(combined[func], stat)
+                combined[func] = stat
+        return marshal.dumps(combined)
+
+    def speedscope_file(self):
+        """every run kept, each as its own profile, in speedscope's JSON format"""
+        with self._lock:
+            runs = list(self.runs)
+        frames, frame_index, profiles = [], {}, []
+        for run in runs:
+            samples, weights = [], []
+            for stack, seconds in flame_stacks(run.stats):
+                for func in stack:
+                    if func not in frame_index:
+                        frame_index[func] = len(frames)
+                        frames.append(_frame(func))
+                samples.append([frame_index[func] for func in stack])
+                weights.append(seconds)
+            profiles.append(
+                {
+                    "type": "sampled",
+                    "name": f"{run.name} {run.started.strftime('%H:%M:%S')}",
+                    "unit": "seconds",
+                    "startValue": 0,
+                    "endValue": sum(weights),
+                    "samples": samples,
+                    "weights": weights,
+                }
+            )
+        speedscope = {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "shared": {"frames": frames},
+            "profiles": profiles,
+            "name": "Illuminate-GUV",
+            "exporter": "illuminate-guv",
+        }
+        return json.dumps(speedscope).encode()
+
+
+def _frame(func):
+    filename, line, name = func
+    if filename == "~":  # builtins
+        return {"name": name}
+    return {"name": name, "file": filename, "line": line}
+
+
+def flame_stacks(stats):
+    """
+    [(stack, seconds)] of the time spent in each function along each call
+    path, for a flame graph. cProfile only keeps totals per caller/callee
+    pair, so a function's time is split between the paths into it in
+    proportion to the time each of its callers spent in it. recursive calls
+    aren't followed, but shown whole where they're made, and calls too small
+    to show are lumped together under OTHER_FRAME.
+    """
+    callees = {}
+    for func, (_, _, _, _, callers) in stats.items():
+        # the time spent in `func` from each caller, recursion aside
+        edges = {c: e[3] for c, e in callers.items() if c in stats and c != func}
+        called = sum(edges.values())
+        for caller, edge_time in edges.items():
+            if called > 0:
+                callees.setdefault(caller, []).append((func, edge_time / called))
+    roots = [
+        func
+        for func, (_, _, _, _, callers) in stats.items()
+        if not any(caller in stats for caller in callers)
+    ]
+    total = sum(stat[2] for stat in stats.values())
+    min_seconds = total * FLAME_MIN_FRACTION
+    stacks = []
+
+    def walk(stack, share):
+        own_time = stats[stack[-1]][2]
+        if own_time > 0:
+            stacks.append((stack, own_time * share))
+        other = 0.0
+        for callee, fraction in callees.get(stack[-1], []):
+            callee_share = share * fraction
+            seconds = stats[callee][3] * callee_share
+            if callee in stack:
+                stacks.append((stack + [callee], seconds))
+            elif seconds < min_seconds or len(stack) >= FLAME_MAX_DEPTH:
+                other += seconds
+            else:
+                walk(stack + [callee], callee_share)
+        if other > 0:
+            stacks.append((stack + [OTHER_FRAME], other))
+
+    for func in roots:
+        walk([func], 1.0)
+    return stacks
+
+
+def session_profiler():
+    """
+    the session's SessionProfiler if the page was opened with ?profile=1, or
+    None. sessions without it aren't touched.
+    """
+    enabled = st.query_params.get(PROFILE_PARAM) == "1"
+    profiler = ss.get("profiler")
+    if enabled and profiler is None:
+        profiler = ss.profiler = SessionProfiler()
+        _hook_callbacks(profiler)
+    elif not enabled and profiler is not None:
+        profiler.finish()
+        _hook_callbacks(None)
+        del ss.profiler
+        profiler = None
+    return profiler
+
+
+def active_profiler():
+    """the profiler of the session whose script is running, if it has one"""
+    if get_script_run_ctx(suppress_warning=True) is None:
+        return None
+    return ss.get("profiler")
+
+
+def _hook_callbacks(profiler):
+    """
+    route this session's widget callbacks through `profiler`, or back to
+    Streamlit if None. Streamlit calls them before the script runs, so the
+    script can't wrap them itself; the hook is set on this session's own
+    widget state only, and is skipped if Streamlit's internals have moved.
+    """
+    ctx = get_script_run_ctx(suppress_warning=True)
+    state = getattr(getattr(ctx, "session_state", None), "_state", None)
+    widgets = getattr(state, "_new_widget_state", None)
+    if widgets is None or not hasattr(widgets, "call_callback"):
+        return
+    if profiler is None:
+        widgets.__dict__.pop("call_callback", None)
+        return
+    call_callback = type(widgets).call_callback
+
+    def profiled_call_callback(widget_id):
+        metadata = widgets.widget_metadata.get(widget_id)
+        callback = getattr(metadata, "callback", None)
+        if callback is None:
+            return call_callback(widgets, widget_id)
+        profiler.callback(
+            lambda: call_callback(widgets, widget_id),
+            getattr(callback, "__name__", "callback"),
+        )
+
+    widgets.call_callback = profiled_call_callback
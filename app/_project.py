@@ -0,0 +1,287 @@
+import io
+import json
+import shutil
+import zlib
+import inspect
+import zipfile
+from pathlib import Path
+import numpy as np
+from guv_calcs.room import Room
+from guv_calcs.lamp import Lamp
+from guv_calcs.calc_zone import CalcPlane, CalcVol
+from app._blob_cache import content_hash
+from app._calculate import get_contribution_cache, lamp_key, zone_key
+from app._catalog import CACHE_DIR
+from app._photometry import WEIGHTS_URL, load_lamp_file, load_lamp_spectra
+from app._spectral import get_weightings
+
+PROJECT_VERSION = 1
+PROJECT_DIR = CACHE_DIR / "projects"
+# grids at least this big are memory-mapped from disk when a project is loaded
+MMAP_MIN_BYTES = 16 * 1024 ** 2
+PROJECTS_KEPT = 8  # unpacked projects kept on disk for memory-mapping
+
+ZONE_TYPES = {"Plane": CalcPlane, "Volume": CalcVol}
+LAMP_KEYS = [
+    "lamp_id",
+    "name",
+    "filename",
+    "x",
+    "y",
+    "z",
+    "angle",
+    "aimx",
+    "aimy",
+    "aimz",
+    "intensity_units",
+    "enabled",
+]
+
+
+# what reading a truncated or corrupted zip, or one of its members, can raise
+DAMAGED_ZIP_ERRORS = (
+    zipfile.BadZipFile,
+    zlib.error,
+    OSError,
+    EOFError,
+    NotImplementedError,  # a corrupted compression method
+)
+
+
+class ProjectError(ValueError):
+    """raised when a file isn't a project this version can load"""
+
+
+def _init_keys(cls):
+    """the keyword arguments of a class's constructor, as guv_calcs' from_json uses"""
+    return [key for key in inspect.signature(cls.__init__).parameters if key != "self"]
+
+
+def _plain(val):
+    """numpy scalars to python ones, for json"""
+    return val.item() if isinstance(val, np.generic) else val
+
+
+def _blob(source):
+    """the bytes of a lamp's file or spectrum, whether held in memory or on disk"""
+    if isinstance(source, bytes):
+        return source
+    if isinstance(source, (str, Path)) and Path(source).is_file():
+        return Path(source).read_bytes()
+    return None
+
+
+def _saved_zones(room):
+    """zones worth saving; bare CalcZones are placeholders awaiting a type"""
+    return [zone for zone in room.calc_zones.values() if zone.calctype in ZONE_TYPES]
+
+
+def project_metadata(room):
+    """
+    (metadata, grids, blobs) for a room: the json-able description of the
+    room, its lamps and zones; {name: array} of every zone's values and every
+    lamp's own contribution; and {content hash: bytes} of the ies and spectrum
+    files the lamps use
+    """
+    grids = {}
+    blobs = {}
+
+    def add_grid(values):
+        name = f"grids/{len(grids)}.npy"
+        grids[name] = values
+        return name
+
+    def add_blob(data):
+        if data is None:
+            return None
+        digest = content_hash(data)
+        blobs[digest] = data
+        return digest
+
+    lamps = []
+    for lamp in room.lamps.values():
+        meta = {key: _plain(getattr(lamp, key)) for key in LAMP_KEYS}
+        # kept as well as the aim point, so the pose round-trips exactly
+        meta["heading"] = _plain(lamp.heading)
+        meta["bank"] = _plain(lamp.bank)
+        meta["photometry"] = add_blob(_blob(lamp.filedata))
+        meta["spectrum"] = add_blob(_blob(lamp.spectra_source))
+        meta["max_irradiances"] = {
+            zone_id: float(val) for zone_id, val in lamp.max_irradiances.items()
+        }
+        lamps.append(meta)
+
+    zones = []
+    for zone in _saved_zones(room):
+        cls = ZONE_TYPES[zone.calctype]
+        meta = {
+            key: _plain(getattr(zone, key))
+            for key in _init_keys(cls)
+            if key != "values"
+        }
+        meta["calctype"] = zone.calctype
+        meta["values"] = None if zone.values is None else add_grid(zone.values)
+        lamp_values = getattr(zone, "lamp_values", None)
+        meta["lamp_values"] = lamp_values and {
+            lamp_id: add_grid(values) for lamp_id, values in lamp_values.items()
+        }
+        zones.append(meta)
+
+    metadata = {
+        "version": PROJECT_VERSION,
+        "room": {key: _plain(getattr(room, key)) for key in _init_keys(Room)},
+        "lamps": lamps,
+        "zones": zones,
+    }
+    return metadata, grids, blobs
+
+
+def project_fingerprint(room):
+    """
+    (fingerprint, grids): the fingerprint changes whenever the saved project
+    would, and is cheap, since grids are compared by id rather than read. keep
+    the grids for as long as the fingerprint, so their ids can't be reused.
+    """
+    metadata, grids, _ = project_metadata(room)
+    digest = content_hash(json.dumps(metadata, sort_keys=True).encode())
+    grids = tuple(grids.values())
+    return (digest, tuple(id(values) for values in grids)), grids
+
+
+def save_project(room):
+    """
+    the room, its lamps, zones and results as a project file: a zip holding
+    `project.json`, each grid as a deflated .npy (as in an .npz), and each ies
+    and spectrum file once, under `blobs/` by content hash
+    """
+    metadata, grids, blobs = project_metadata(room)
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr("project.json", json.dumps(metadata, indent=4))
+        for name, values in grids.items():
+            with zf.open(name, "w", force_zip64=True) as f:
+                np.lib.format.write_array(f, np.asarray(values), allow_pickle=False)
+        for digest, data in blobs.items():
+            zf.writestr(f"blobs/{digest}", data)
+    return buffer.getvalue()
+
+
+def load_project(data):
+    """
+    a Room, with its results, from a project file. nothing is recalculated:
+    zone values and the skin and eye zones' lamp contributions are restored as
+    saved, and the contributions are also primed into the contribution cache
+    so those zones recalculate instantly if unchanged.
+    grids of MMAP_MIN_BYTES or more are unpacked to disk and memory-mapped
+    rather than read into memory.
+    """
+    try:
+        zf = zipfile.ZipFile(io.BytesIO(data))
+    except DAMAGED_ZIP_ERRORS as e:
+        raise ProjectError("Not a project file") from e
+    with zf:
+        try:
+            metadata = json.loads(zf.read("project.json"))
+        except (KeyError, ValueError) + DAMAGED_ZIP_ERRORS as e:
+            raise ProjectError("Not a project file") from e
+        if not isinstance(metadata, dict):
+            raise ProjectError("Not a project file")
+        if metadata.get("version") != PROJECT_VERSION:
+            version = metadata.get("version")
+            raise ProjectError(f"Unsupported project version {version}")
+        grids = _GridReader(zf, content_hash(data))
+        try:
+            room = Room(**metadata["room"])
+            for meta in metadata["lamps"]:
+                room.add_lamp(_load_lamp(zf, meta))
+            for meta in metadata["zones"]:
+                room.add_calc_zone(_load_zone(grids, meta))
+        except (KeyError, TypeError, ValueError) + DAMAGED_ZIP_ERRORS as e:
+            raise ProjectError(f"Damaged project file: {e!r}") from e
+    _prime_cache(room)
+    return room
+
+
+def _load_lamp(zf, meta):
+    lamp = Lamp(
+        **{key: meta[key] for key in LAMP_KEYS if key != "filename"},
+        spectral_weight_source=WEIGHTS_URL,
+        spectral_weightings=get_weightings(),
+    )
+    lamp.heading = meta["heading"]
+    lamp.bank = meta["bank"]
+    if meta["photometry"] is not None:
+        filedata = zf.read(f"blobs/{meta['photometry']}")
+        load_lamp_file(lamp, filename=meta["filename"], filedata=filedata)
+    else:
+        lamp.filename = meta["filename"]
+    if meta["spectrum"] is not None:
+        load_lamp_spectra(lamp, zf.read(f"blobs/{meta['spectrum']}"))
+    lamp.max_irradiances = dict(meta["max_irradiances"])
+    return lamp
+
+
+def _load_zone(grids, meta):
+    cls = ZONE_TYPES[meta["calctype"]]
+    zone = cls(**{key: meta[key] for key in _init_keys(cls) if key != "values"})
+    if meta["values"] is not None:
+        zone.values = grids.read(meta["values"])
+    lamp_values = meta["lamp_values"]
+    zone.lamp_values = lamp_values and {
+        lamp_id: grids.read(name) for lamp_id, name in lamp_values.items()
+    }
+    return zone
+
+
+def _prime_cache(room):
+    """put a loaded room's lamp contributions where calculate_room will find them"""
+    cache = get_contribution_cache()
+    for zone in room.calc_zones.values():
+        lamp_values = getattr(zone, "lamp_values", None) or {}
+        for lamp_id, values in lamp_values.items():
+            lamp = room.lamps.get(lamp_id)
+            if lamp is None or lamp.filedata is None:
+                continue
+            max_irradiance = lamp.max_irradiances.get(zone.zone_id)
+            if max_irradiance is not None:
+                cache.put((lamp_key(lamp), zone_key(zone)), values, max_irradiance)
+
+
+class _GridReader:
+    """
+    Reads the grids out of an open project zip. Small grids are read into
+    memory; big ones are unpacked once, into a directory named by the
+    project's content hash, and memory-mapped read-only from there.
+    """
+
+    def __init__(self, zf, digest):
+        self.zf = zf
+        self.directory = PROJECT_DIR / digest
+
+    def read(self, name):
+        info = self.zf.getinfo(name)
+        if info.file_size < MMAP_MIN_BYTES:
+            return np.load(io.BytesIO(self.zf.read(name)), allow_pickle=False)
+        path = self.directory / Path(name).name
+        if not path.exists():
+            self._unpack(name, path)
+        return np.load(path, mmap_mode="r")
+
+    def _unpack(self, name, path):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(".tmp")
+        with self.zf.open(name) as src, open(tmp_path, "wb") as dst:
+            shutil.copyfileobj(src, dst)  # streamed, never whole in memory
+        tmp_path.replace(path)
+        _prune_projects(keep=self.directory)
+
+
+def _prune_projects(keep, max_projects=PROJECTS_KEPT):
+    """remove the least recently unpacked projects beyond `max_projects`"""
+    projects = sorted(
+        (p for p in PROJECT_DIR.iterdir() if p.is_dir() and p != keep),
+        key=lambda p: p.stat().st_mtime,
+    )
+    # open memory maps stay valid after their files are unlinked
+    for old in projects[: max(len(projects) + 1 - max_projects, 0)]:
+        shutil.rmtree(old, ignore_errors=True)
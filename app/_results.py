@@ -1,10 +1,19 @@
 import streamlit as st
-import numpy as np
-from app._widget import close_results, update_ozone_results
+import pandas as pd
+from app._widget import close_results, cancel_calculation, update_ozone_results
+from app._figures import session_figures
+from app._plot import plot_species
+from app._disinfection import room_volume_ft3
+from app._engine import (
+    SPECIAL_ZONES,
+    calculate_ozone_increase,
+    get_unweighted_hours_to_tlv,
+    get_weighted_hours_to_tlv,
+    missing_spectra,
+)
 
 ss = st.session_state
 WEIGHTS_URL = "data/UV Spectral Weighting Curves.csv"
-SPECIAL_ZONES = ["WholeRoomFluence", "SkinLimits", "EyeLimits"]
 
 
 def results_page(room):
@@ -15,6 +24,13 @@ def results_page(room):
         "X", on_click=close_results, use_container_width=True, key="close_results"
     )
 
+    calculation_status(room)
+    job = ss.get("calc_job")
+    if job is not None and job.running:
+        if all(zone.values is None for zone in room.calc_zones.values()):
+            # nothing to show until the first calculation lands
+            return
+
     # do some checks first. do we actually have any lamps?
     msg = "You haven't added any luminaires yet! Try adding a luminaire by clicking the `Add Luminaire` button, and then hit `Calculate`"
     if not room.lamps:
@@ -47,6 +63,137 @@ def results_page(room):
                 st.write("Max:", round(vals.max(), 3), unitstr)
 
 
+def calculation_status(room):
+    """show progress of a background calculation, and swap its results in once done"""
+    job = ss.get("calc_job")
+    if job is None:
+        return
+    if job.running:
+        calculation_progress()
+    elif job.succeeded:
+        if not job.applied:
+            finish_calculation(room, job)
+        refinement_status(job)
+    elif job.error is not None:
+        st.error(f"Calculation failed: {job.error}")
+    elif job.cancelled:
+        st.info("Calculation cancelled.")
+
+
+@st.experimental_fragment(run_every=0.5)
+def calculation_progress():
+    """progress bar and cancel button, polled while the calculation runs"""
+    job = ss.get("calc_job")
+    if job is None:
+        return
+    if job.running:
+        cols = st.columns([6, 1])
+        cols[0].progress(job.progress, text=f"Calculating... {job.message}")
+        cols[1].button(
+            "Cancel",
+            on_click=cancel_calculation,
+            use_container_width=True,
+            key="cancel_calculation",
+        )
+        if job.stages:
+            provisional_results(job)
+    else:
+        # rerun the whole page so the results get swapped in
+        st.rerun()
+
+
+def _format_error(error):
+    return "-" if error is None else f"±{round(error * 100, 1)}%"
+
+
+def provisional_results(job):
+    """headline numbers from the latest finished stage of a progressive calculation"""
+    stage = job.latest_stage
+    room = stage.room
+    error = stage.error or {}
+    st.caption(
+        f"Provisional results from stage {len(job.stages)} of {job.num_stages}, "
+        f"on a grid {stage.factor}x coarser than requested. Estimated errors "
+        "are the change since the previous stage."
+    )
+    rows = []
+    if "WholeRoomFluence" in stage.summary:
+        rows.append(
+            [
+                "Average fluence (μW/cm2)",
+                round(stage.summary["WholeRoomFluence"], 3),
+                _format_error(error.get("WholeRoomFluence")),
+            ]
+        )
+    if "SkinLimits" in stage.summary and "EyeLimits" in stage.summary:
+        skin_units = room.calc_zones["SkinLimits"].units
+        eye_units = room.calc_zones["EyeLimits"].units
+        rows.append(
+            [
+                f"Max skin dose, 8 hours ({skin_units})",
+                round(stage.summary["SkinLimits"], 3),
+                _format_error(error.get("SkinLimits")),
+            ]
+        )
+        rows.append(
+            [
+                f"Max eye dose, 8 hours ({eye_units})",
+                round(stage.summary["EyeLimits"], 3),
+                _format_error(error.get("EyeLimits")),
+            ]
+        )
+        # hours to TLV are inversely proportional to the max doses
+        hours_error = None
+        if stage.error is not None:
+            hours_error = max(error.get("SkinLimits", 0), error.get("EyeLimits", 0))
+        rows.append(
+            [
+                "Hours to TLV (monochromatic)",
+                round(min(get_unweighted_hours_to_tlv(room)), 2),
+                _format_error(hours_error),
+            ]
+        )
+        rows.append(
+            [
+                "Hours to TLV (spectrally weighted)",
+                round(min(get_weighted_hours_to_tlv(room)), 2),
+                _format_error(hours_error),
+            ]
+        )
+    df = pd.DataFrame(rows, columns=["", "Value", "Estimated error"])
+    st.dataframe(df, hide_index=True)
+
+
+def refinement_status(job):
+    """say how far a finished progressive calculation got, and how accurate it is"""
+    stage = job.latest_stage
+    if stage is None or not job.progressive:
+        return
+    error = max(stage.error.values()) if stage.error else None
+    if job.partial:
+        st.warning(
+            f"The time limit was reached before the calculation finished refining. "
+            f"Results are from a grid {stage.factor}x coarser than requested, "
+            f"with an estimated error of {_format_error(error)}."
+        )
+    elif error is not None:
+        st.caption(
+            f"Results changed by at most {_format_error(error)} in the last refinement stage."
+        )
+
+
+def finish_calculation(room, job):
+    """copy a finished job's results onto the room and format the species plot"""
+    job.apply(room)
+    ss.kdf = job.kdf
+    fluence = room.calc_zones["WholeRoomFluence"]
+    if fluence.values is not None and ss.kdf is not None:
+        # format the figure now so we don't redo it on every rerun
+        session_figures().put(
+            "species", plot_species(fluence.values.mean(), room_volume_ft3(room))
+        )
+
+
 def print_safety(room):
     """print photobiological safety results"""
     st.subheader("Photobiological Safety", divider="grey")
@@ -90,6 +237,7 @@ def print_safety(room):
         )
 
         # weighted hours to TLV
+        _warn_missing_spectra(room)
         hours_skin_w, hours_eye_w = get_weighted_hours_to_tlv(room)
         hours_to_tlv = min([hours_skin_w, hours_eye_w])
         if hours_to_tlv > 8:
@@ -106,12 +254,15 @@ def print_safety(room):
 
         SHOW_PLOTS = st.checkbox("Show Plots", value=True)
         if SHOW_PLOTS:
+            figures = session_figures()
             cols = st.columns(2)
             cols[0].pyplot(
-                skin.plot_plane(title="8-Hour Skin Dose"), **{"transparent": "True"}
+                figures.put("skin_dose", skin.plot_plane(title="8-Hour Skin Dose")),
+                **{"transparent": "True"},
             )
             cols[1].pyplot(
-                eye.plot_plane(title="8-Hour Eye Dose"), **{"transparent": "True"}
+                figures.put("eye_dose", eye.plot_plane(title="8-Hour Eye Dose")),
+                **{"transparent": "True"},
             )
 
 
@@ -129,8 +280,9 @@ def print_efficacy(room):
 
     if fluence.values is not None:
         SHOW_KPLOT = st.checkbox("Show Plot", value=True)
-        if SHOW_KPLOT:
-            st.pyplot(ss.kfig)
+        kfig = session_figures().get("species")
+        if SHOW_KPLOT and kfig is not None:
+            st.pyplot(kfig)
         SHOW_KDATA = st.checkbox("Show Data", value=True)
         if SHOW_KDATA:
             st.dataframe(ss.kdf, hide_index=True)
@@ -170,210 +322,9 @@ def print_airchem(room):
     st.write(f"Estimated increase in indoor ozone from UV: {ozone_str}")
 
 
-def get_unweighted_hours_to_tlv(room):
-    """
-    calculate hours to tlv without taking into account lamp spectra
-    """
-
-    skin_standard, eye_standard = _get_standards(room.standard)
-    mono_skinmax, mono_eyemax = _get_mono_limits(222, room)
-
-    skin_limits = room.calc_zones["SkinLimits"]
-    eye_limits = room.calc_zones["EyeLimits"]
-
-    skin_hours = mono_skinmax * 8 / skin_limits.values.max()
-    eye_hours = mono_eyemax * 8 / eye_limits.values.max()
-    return skin_hours, eye_hours
-
-
-def get_weighted_hours_to_tlv(room):
-    """
-    calculate the hours to tlv in a particular room, given a particular installation of lamps
-
-    technically speaking; in the event of overlapping beams, it is possible to check which
-    lamps are shining on that spot and what their spectra are. this function currently doesn't do that
-
-    TODO: good lord this function is a nightmare. let's make it less horrible eventually
-    """
-
-    skin_standard, eye_standard = _get_standards(room.standard)
-    mono_skinmax, mono_eyemax = _get_mono_limits(222, room)
-
-    skin_limits = room.calc_zones["SkinLimits"]
-    eye_limits = room.calc_zones["EyeLimits"]
-
-    skin_hours, eyes_hours, skin_maxes, eye_maxes = _tlvs_over_lamps(room)
-
-    # now check that overlapping beams in the calc zone aren't pushing you over the edge
-    # max irradiance in the wholeplane
-    global_skin_max = round(skin_limits.values.max() / 3.6 / 8, 3)  # to uW/cm2
-    global_eye_max = round(eye_limits.values.max() / 3.6 / 8, 3)
-    # max irradiance on the plane produced by each lamp
-    local_skin_max = round(max(skin_maxes), 3)
-    local_eye_max = round(max(eye_maxes), 3)
-
-    if global_skin_max > local_skin_max or global_eye_max > local_eye_max:
-        # first pick a lamp to use the spectra of. one with a spectra is preferred.
-        chosen_lamp = _select_representative_lamp(room, skin_standard)
-        if len(chosen_lamp.spectra) > 0:
-            # calculate weighted if possible
-            new_skin_hours = _get_weighted_hours(
-                chosen_lamp, global_skin_max, skin_standard
-            )
-            new_eye_hours = _get_weighted_hours(
-                chosen_lamp, global_eye_max, eye_standard
-            )
-        else:
-            # these will be in mJ/cm2/8 hrs
-            new_skin_hours = mono_skinmax * 8 / skin_limits.values.max()
-            new_eye_hours = mono_eyemax * 8 / eye_limits.values.max()
-
-        skin_hours.append(new_skin_hours)
-        eyes_hours.append(new_eye_hours)
-    return min(skin_hours), min(eyes_hours)
-
-
-def _get_standards(standard):
-    """return the relevant skin and eye limit standards"""
-    if "ANSI IES RP 27.1-22" in standard:
-        skin_standard = "ANSI IES RP 27.1-22 (Skin)"
-        eye_standard = "ANSI IES RP 27.1-22 (Eye)"
-    elif "IEC 62471-6:2022" in standard:
-        skin_standard = "IEC 62471-6:2022 (Eye/Skin)"
-        eye_standard = skin_standard
-    else:
-        raise KeyError(f"Room standard {standard} is not valid")
-
-    return skin_standard, eye_standard
-
-
-def _get_mono_limits(wavelength, room):
-    """
-    load the monochromatic skin and eye limits at a given wavelength
-    """
-    # just pick the first lamp in the list
-    lamp_id = next(iter(room.lamps))
-    weights = room.lamps[lamp_id].spectral_weightings
-
-    skin_standard, eye_standard = _get_standards(room.standard)
-    skindata = dict(zip(*weights[skin_standard]))
-    eyedata = dict(zip(*weights[eye_standard]))
-
-    return 3 / skindata[wavelength], 3 / eyedata[wavelength]
-
-
-def _tlvs_over_lamps(room):
-    """calculate the hours to TLV over each lamp in the calc zone"""
-
-    skin_standard, eye_standard = _get_standards(room.standard)
-    mono_skinmax, mono_eyemax = _get_mono_limits(222, room)
-
-    # iterate over all lamps
-    hours_to_tlv_skin, hours_to_tlv_eye = [], []
-    skin_maxes, eye_maxes = [], []
-    for lamp_id, lamp in room.lamps.items():
-        if len(lamp.max_irradiances) > 0:
-            # get max irradiance shown by this lamp upon both zones
-            skin_irradiance = lamp.max_irradiances["SkinLimits"]
-            eye_irradiance = lamp.max_irradiances["EyeLimits"]
-
-            if len(lamp.spectra) > 0:
-                # if lamp has a spectra associated with it, calculate the weighted spectra
-                skin_hours = _get_weighted_hours(lamp, skin_irradiance, skin_standard)
-                eye_hours = _get_weighted_hours(lamp, eye_irradiance, eye_standard)
-            else:
-                # if it doesn't, first, yell.
-                st.warning(
-                    f"{lamp.name} does not have an associated spectra. Photobiological safety calculations will be inaccurate."
-                )
-                # then just use the monochromatic approximation
-                skin_hours = mono_skinmax * 8 / skin_irradiance
-                eye_hours = mono_eyemax * 8 / eye_irradiance
-            hours_to_tlv_skin.append(skin_hours)
-            hours_to_tlv_eye.append(eye_hours)
-            skin_maxes.append(skin_irradiance)
-            eye_maxes.append(eye_irradiance)
-    if len(room.lamps.items()) == 0:
-        hours_to_tlv_skin, hours_to_tlv_eye = [np.inf], [np.inf]
-        skin_maxes, eye_maxes = [0], [0]
-
-    return hours_to_tlv_skin, hours_to_tlv_eye, skin_maxes, eye_maxes
-
-
-def _get_weighted_hours(lamp, irradiance, standard):
-    """
-    calculate hours to tlv for a particular lamp, calc zone, and standard
-    """
-
-    # get spectral data for this lamp
-    wavelength = lamp.spectra["Unweighted"][0]
-    rel_intensities = lamp.spectra["Unweighted"][1]
-    # determine total power in the spectra as it corresponds to total power
-    idx = np.intersect1d(np.argwhere(wavelength >= 200), np.argwhere(wavelength <= 280))
-    spectral_power = _sum_spectrum(wavelength[idx], rel_intensities[idx])
-    ratio = irradiance / spectral_power
-    power_distribution = rel_intensities[idx] * ratio  # true spectra at calc plane
-    # load weights according to the standard
-    weights_list = lamp.spectral_weightings[standard]
-    # interpolate to match the spectra
-    weighting = np.interp(wavelength, weights_list[0], weights_list[1])
-
-    # weight the normalized spectra
-    weighted_spectra = power_distribution * weighting[idx]
-    # sum to get weighted power
-    weighted_power = _sum_spectrum(wavelength[idx], weighted_spectra)
-
-    seconds_to_tlv = 3000 / weighted_power  # seconds to reach 3 mJ/3000 uJ
-    hours_to_tlv = seconds_to_tlv / 3600  # hours to limit
-    return hours_to_tlv
-
-
-def _sum_spectrum(wavelength, intensity):
-    """
-    sum across a spectrum
-    """
-    weighted_intensity = [
-        intensity[i] * (wavelength[i] - wavelength[i - 1])
-        for i in range(1, len(wavelength))
-    ]
-    return sum(weighted_intensity)
-
-
-def _select_representative_lamp(room, standard):
-    """
-    select a lamp to use for calculating the spectral limits in the event
-    that no single lamp is contributing exclusively to the TLVs
-    """
-    if len(set([lamp.filename for lamp_id, lamp in room.lamps.items()])) <= 1:
-        # if they're all the same just use the first lamp in the list
-        chosen_lamp = room.lamps[next(iter(room.lamps))]
-    else:
-        # otherwise pick the least convenient one
-        weighted_sums = {}
-        for lamp_id, lamp in room.lamps.items():
-            # iterate through all lamps and pick the one with the highest value sum
-            if len(lamp.spectra) > 0:
-                # either eye or skin standard can be used for this purpose
-                weighted_sums[lamp_id] = lamp.spectra[standard].sum()
-
-        if len(weighted_sums) > 0:
-            chosen_id = max(weighted_sums, key=weighted_sums.get)
-            chosen_lamp = room.lamps[chosen_id]
-        else:
-            # if no lamps have a spectra then it doesn't matter. pick any lamp.
-            chosen_lamp = room.lamps[next(iter(room.lamps))]
-    return chosen_lamp
-
-
-def calculate_ozone_increase(room):
-    """
-    ozone generation constant is currently hardcoded to 10 for GUV222
-    this should really be based on spectra instead
-    but this is a relatively not very big deal, because
-    """
-    avg_fluence = room.calc_zones["WholeRoomFluence"].values.mean()
-    ozone_gen = 10  # hardcoded for now, eventually should be based on spectra bu
-    ach = room.air_changes
-    ozone_decay = room.ozone_decay_constant
-    ozone_increase = avg_fluence * ozone_gen / (ach + ozone_decay)
-    return ozone_increase
+def _warn_missing_spectra(room):
+    """yell about any calculated lamp that has no spectrum"""
+    for lamp in missing_spectra(room):
+        st.warning(
+            f"{lamp.name} does not have an associated spectra. Photobiological safety calculations will be inaccurate."
+        )
@@ -1,9 +1,20 @@
+import pandas as pd
 import streamlit as st
+from app._disinfection import room_volume_ft3
+from app._figures import session_figures
+from app._optimize_sidebar import show_optimize
+from app._plot import plot_species
+from app._project import ProjectError, load_project, project_fingerprint, save_project
+from app._uploads import QuotaExceeded
+from app._website_helpers import get_disinfection_table, make_file_list
 from app._widget import (
     update_room,
     update_room_standard,
     update_ozone,
+    update_calc_settings,
     close_sidebar,
+    initialize_results,
+    initialize_zone,
 )
 
 SELECT_LOCAL = "Select local file..."
@@ -82,6 +93,31 @@ def room_sidebar(room):
         key="ozone_decay_constant",
     )
 
+    st.subheader("Calculation", divider="grey")
+    cols = st.columns(2)
+    cols[0].checkbox(
+        "Show provisional results",
+        on_change=update_calc_settings,
+        key="calc_progressive",
+        help="Calculate on a coarse grid first and refine it in stages, showing the results of each stage as soon as it's done.",
+    )
+    cols[1].number_input(
+        "Time limit (seconds)",
+        on_change=update_calc_settings,
+        min_value=0.0,
+        step=5.0,
+        key="calc_deadline",
+        help="Stop refining once this much time has passed, and report the best result so far. 0 means no limit.",
+    )
+    st.button(
+        "Optimize Layout",
+        on_click=show_optimize,
+        args=[room],
+        use_container_width=True,
+        key="optimize_layout",
+        help="Search for the luminaire positions and aim points that give the most fluence within the TLV.",
+    )
+
     st.subheader("Units", divider="grey")
     st.write("Coming soon")
 
@@ -173,30 +209,127 @@ def project_sidebar(room):
         use_container_width=True,
     )
 
-    st.write("*Coming soon...*")
-
     st.subheader("Save Project", divider="grey")
-
-    st.download_button(
-        label="Save",
-        data="{some_dummy_data}",
-        file_name="illuminate.json",
-        use_container_width=True,
-        key="download_project",
-        disabled=True,
+    st.write(
+        "Projects include the room, luminaires and calculation zones, along with any results, so they open without recalculating."
     )
+    project_download(room)
 
     st.subheader("Load Project", divider="grey")
-    uploaded_file = st.file_uploader(
+    st.file_uploader(
         "Load Project",
-        type="json",
-        on_change=None,
+        type="guv",
+        on_change=load_project_file,
         key="upload_project",
         label_visibility="collapsed",
-        disabled=True,
     )
-    if uploaded_file is not None:
-        pass
+
+    profiler = ss.get("profiler")
+    if profiler is not None:
+        profile_downloads(profiler)
+
+
+def profile_downloads(profiler):
+    """the session's profiles, for sessions opened with ?profile=1"""
+    st.subheader("Profiles", divider="grey")
+    st.write(
+        f"The last {profiler.runs.maxlen} reruns and background jobs of this session are profiled. The rerun showing this page is added once it finishes."
+    )
+    summary = profiler.summary()
+    if not summary:
+        return
+    st.dataframe(pd.DataFrame(summary), hide_index=True, use_container_width=True)
+    cols = st.columns(2)
+    cols[0].download_button(
+        label="Download pstats",
+        data=profiler.pstats_file(),
+        file_name="illuminate-guv.pstats",
+        mime="application/octet-stream",
+        use_container_width=True,
+        key="download_pstats",
+    )
+    cols[1].download_button(
+        label="Download speedscope",
+        data=profiler.speedscope_file(),
+        file_name="illuminate-guv.speedscope.json",
+        mime="application/json",
+        use_container_width=True,
+        key="download_speedscope",
+        help="Open at speedscope.app",
+    )
+
+
+def project_download(room):
+    """
+    a download of the room as a project file, once it's been prepared; the
+    file is only built on request, and again after anything in it changes
+    """
+    fingerprint, _ = project_fingerprint(room)
+    cached = ss.get("project_file")
+    if cached is not None and cached[0] == fingerprint:
+        st.download_button(
+            label="Save",
+            data=cached[2],
+            file_name="illuminate.guv",
+            mime="application/zip",
+            use_container_width=True,
+            key="download_project",
+        )
+    else:
+        ss.project_file = None  # stale; don't keep it around
+        st.button(
+            "Prepare Download",
+            on_click=prepare_project_file,
+            args=[room],
+            use_container_width=True,
+            key="prepare_project",
+        )
+
+
+def prepare_project_file(room):
+    fingerprint, grids = project_fingerprint(room)
+    ss.project_file = (fingerprint, grids, save_project(room))
+
+
+def load_project_file():
+    """replace the room with the uploaded project's, showing its saved results"""
+    uploaded_file = ss["upload_project"]
+    if uploaded_file is None:
+        return
+    try:
+        room = load_project(uploaded_file.getvalue())
+    except ProjectError as e:
+        st.error(f"Could not load {uploaded_file.name}: {e}")
+        return
+
+    job = ss.get("calc_job")
+    if job is not None and job.running:
+        job.cancel()
+    ss.calc_job = None
+    ss.selected_lamp_id = None
+    ss.selected_zone_id = None
+    # lamps from files that aren't in the catalog are offered like uploads
+    for lamp in room.lamps.values():
+        if lamp.filedata is not None and lamp.filename not in ss.lampfile_options:
+            try:
+                ss.uploaded_files.add_file(lamp.filename, lamp.filedata)
+                if lamp.spectra_source is not None:
+                    ss.uploaded_files.add_spectra(lamp.filename, lamp.spectra_source)
+            except QuotaExceeded as e:
+                st.warning(f"{lamp.filename} won't be offered for new luminaires: {e}")
+    make_file_list()
+    for zone in room.calc_zones.values():
+        initialize_zone(zone)
+    initialize_results(room)
+    ss.room = room
+
+    fluence = room.calc_zones.get("WholeRoomFluence")
+    if fluence is not None and fluence.values is not None:
+        ss.kdf = get_disinfection_table(fluence.values.mean(), room)
+        session_figures().put(
+            "species", plot_species(fluence.values.mean(), room_volume_ft3(room))
+        )
+        ss.show_results = True
 
 
 def default_sidebar(room):
@@ -294,7 +427,6 @@ def default_sidebar(room):
         - **Generating a report**: Generate a polished safety and efficacy report of an installation with a click of a button
         - **Copying objects**: Duplicate a luminaire or calculation zone
         - **Interactive plotting**: Place luminaires and draw calculation zones directly onto the interactive visualization plot
-        - **Saving and load projects**: Save all the parameters of a project as a .json blob, and upload again
         - **Locally installable app**: Run easily as a desktop app without internet access
         - **Support for other GUV wavelengths**: Currently, only GUV222 with krypton-chloride lamps is supported. Future releases will also support GUV254        
         - **More accurate near-field modeling**: Definitions of GUV sources that take into account emission surface geometry and near-field radiation distribution.
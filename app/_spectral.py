@@ -0,0 +1,79 @@
+from functools import lru_cache
+import numpy as np
+from guv_calcs.lamp import Lamp
+
+WEIGHTS_URL = "data/UV Spectral Weighting Curves.csv"
+# the band over which a lamp's spectrum is integrated for TLV purposes, in nm
+SPECTRAL_WINDOW = (200, 280)
+TLV_UJ = 3000  # 3 mJ/cm2 of weighted dose, in uJ/cm2
+
+
+@lru_cache(maxsize=None)
+def get_weightings():
+    """
+    the spectral weighting curves, {standard: (2, N) array of wavelengths and
+    weights}, parsed once per process and shared by every Lamp. arrays are
+    read-only and the dict must not be modified.
+    """
+    scratch = Lamp(lamp_id="_weights", spectral_weight_source=WEIGHTS_URL)
+    weightings = {}
+    for standard, curve in scratch.spectral_weightings.items():
+        weightings[standard] = np.array(curve, dtype=float)
+        weightings[standard].setflags(write=False)
+    return weightings
+
+
+@lru_cache(maxsize=None)
+def mono_limit(standard, wavelength):
+    """the TLV in mJ/cm2 of monochromatic light at `wavelength` under `standard`"""
+    wavelengths, weights = get_weightings()[standard]
+    return 3 / dict(zip(wavelengths, weights))[wavelength]
+
+
+class SpectralProfile:
+    """
+    A lamp's spectrum reduced to what hours-to-TLV calculations need.
+
+    Built once per spectrum: the 200-280 nm window is cut out, its
+    integration deltas taken, and every standard's weighting curve
+    interpolated onto it. `effectiveness[standard]` is then the weighted power
+    per unit of unweighted power in the window, so the weighted irradiance at
+    a point is just irradiance * effectiveness.
+    """
+
+    def __init__(self, spectra, weightings):
+        wavelength = np.asarray(spectra["Unweighted"][0], dtype=float)
+        intensity = np.asarray(spectra["Unweighted"][1], dtype=float)
+        low, high = SPECTRAL_WINDOW
+        window = (wavelength >= low) & (wavelength <= high)
+        deltas = np.diff(wavelength[window])
+        # each sample counts over the step up to it, as in a left Riemann sum
+        weights = intensity[window][1:] * deltas
+        self.power = weights.sum()
+        self.effectiveness = {}
+        for standard, (curve_wavelengths, curve) in weightings.items():
+            weighting = np.interp(wavelength, curve_wavelengths, curve)[window][1:]
+            self.effectiveness[standard] = (weights @ weighting) / self.power
+
+
+def spectral_profile(lamp):
+    """the lamp's SpectralProfile, or None if it has no spectrum"""
+    profile = getattr(lamp, "spectral_profile", None)
+    if profile is None and len(lamp.spectra) > 0:
+        profile = SpectralProfile(lamp.spectra, lamp.spectral_weightings)
+    return profile
+
+
+def effectiveness(lamps, standard, mono_wavelength=None):
+    """
+    (L,) array of each lamp's spectral effectiveness under `standard`. lamps
+    that have no spectrum get nan, or, if `mono_wavelength` is given, the
+    effectiveness of monochromatic light at that wavelength.
+    """
+    fallback = np.nan
+    if mono_wavelength is not None:
+        fallback = 3 / mono_limit(standard, mono_wavelength)
+    profiles = [spectral_profile(lamp) for lamp in lamps]
+    return np.array(
+        [fallback if p is None else p.effectiveness[standard] for p in profiles]
+    )
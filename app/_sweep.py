@@ -0,0 +1,231 @@
+import copy
+import time
+import itertools
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import numpy as np
+import pandas as pd
+from app._calculate import calculate_room, snapshot_room
+from app._engine import room_results
+from app._jobs import BackgroundJob
+from app._metrics import session_bound
+from app._placement import get_lamp_position
+from app._pool import CALC_PROCESSES
+
+# variants calculated at once; big zones also spread over the process pool
+SWEEP_WORKERS = max(CALC_PROCESSES, 2)
+MAX_SWEEP_POINTS = 500
+
+LAMP_PARAMETERS = ["x", "y", "z", "tilt", "orientation", "rotation", "count"]
+ROOM_PARAMETERS = ["room_x", "room_y", "room_z"]
+PARAMETER_LABELS = {
+    "x": "Position X",
+    "y": "Position Y",
+    "z": "Position Z",
+    "tilt": "Tilt",
+    "orientation": "Orientation",
+    "rotation": "Rotation",
+    "count": "Number of luminaires",
+    "room_x": "Room length (X)",
+    "room_y": "Room width (Y)",
+    "room_z": "Room height (Z)",
+}
+# what each variant reports, and how it's labelled in tables and heatmaps
+METRICS = {
+    "fluence_mean": "Average fluence (μW/cm2)",
+    "skin_max": "Max skin dose, 8 hours (mJ/cm2)",
+    "eye_max": "Max eye dose, 8 hours (mJ/cm2)",
+    "hours_to_tlv": "Hours to TLV",
+    "hours_to_tlv_mono": "Hours to TLV (monochromatic)",
+    "eACH_mean": "Mean eACH-UV",
+    "ozone_ppb": "Ozone increase (ppb)",
+}
+
+
+@lru_cache(maxsize=None)
+def get_sweep_executor():
+    """worker pool shared by every session's sweeps"""
+    return ThreadPoolExecutor(max_workers=SWEEP_WORKERS, thread_name_prefix="sweep")
+
+
+def default_settings(room, lamp):
+    """
+    {param: {"on", "min", "max", "steps"}} to start the sweep widgets from,
+    with nothing swept yet
+    """
+    ranges = {
+        "x": (0.0, float(room.x), 3),
+        "y": (0.0, float(room.y), 3),
+        "z": (round(room.z / 2, 2), float(lamp.z), 3),
+        "tilt": (0.0, 60.0, 3),
+        "orientation": (0.0, 270.0, 4),
+        "rotation": (0.0, 90.0, 3),
+        "count": (1, 4, 4),
+        "room_x": (float(room.x), round(room.x * 2, 2), 3),
+        "room_y": (float(room.y), round(room.y * 2, 2), 3),
+        "room_z": (float(room.z), round(room.z * 1.5, 2), 3),
+    }
+    return {
+        param: {"on": False, "min": start, "max": stop, "steps": steps}
+        for param, (start, stop, steps) in ranges.items()
+    }
+
+
+def sweep_values(start, stop, steps, param=None):
+    """`steps` evenly spaced values from start to stop; whole numbers for count"""
+    values = np.linspace(start, stop, max(int(steps), 1))
+    if param == "count":
+        return sorted(set(int(round(val)) for val in values))
+    return [float(val) for val in values]
+
+
+def sweep_points(ranges):
+    """every combination of the values in {param: values}, as a list of dicts"""
+    params = list(ranges)
+    return [dict(zip(params, vals)) for vals in itertools.product(*ranges.values())]
+
+
+def check_ranges(ranges):
+    """raise ValueError if a sweep can't be run as specified"""
+    unknown = [param for param in ranges if param not in PARAMETER_LABELS]
+    if unknown:
+        raise ValueError(f"Unknown sweep parameters: {unknown}")
+    if "count" in ranges and ("x" in ranges or "y" in ranges):
+        raise ValueError(
+            "Position X and Y can't be swept along with the number of luminaires, which are placed automatically"
+        )
+    num_points = int(np.prod([len(vals) for vals in ranges.values()]))
+    if num_points > MAX_SWEEP_POINTS:
+        raise ValueError(
+            f"{num_points} combinations is too many to sweep; the limit is {MAX_SWEEP_POINTS}"
+        )
+    return num_points
+
+
+def apply_parameters(room, lamp_id, params):
+    """
+    a copy of `room` with one combination of sweep parameters applied.
+
+    room parameters resize the room and its standard zones; lamp parameters
+    apply to lamp `lamp_id`, or, if `count` is given, to that many copies of it
+    placed where `Add Luminaire` would put them. the room itself is untouched,
+    and photometry and unchanged zone grids are shared with it.
+    """
+    variant = snapshot_room(room)
+    if any(param in params for param in ROOM_PARAMETERS):
+        variant.x = params.get("room_x", variant.x)
+        variant.y = params.get("room_y", variant.y)
+        variant.z = params.get("room_z", variant.z)
+        variant.set_dimensions()
+        _resize_standard_zones(variant)
+
+    template = variant.lamps.pop(lamp_id)
+    if "count" in params:
+        lamps = []
+        for i in range(params["count"]):
+            lamp = copy.copy(template)
+            lamp.lamp_id = f"{template.lamp_id}_{i + 1}"
+            lamp.position = template.position.copy()
+            lamp.aim_point = template.aim_point.copy()
+            lamp.max_irradiances = {}
+            x, y = get_lamp_position(lamp_idx=i + 1, x=variant.x, y=variant.y)
+            lamp.move(x=x, y=y)
+            lamps.append(lamp)
+    else:
+        lamps = [template]
+    for lamp in lamps:
+        lamp.move(x=params.get("x"), y=params.get("y"), z=params.get("z"))
+        if "tilt" in params:
+            lamp.set_tilt(params["tilt"], dimensions=variant.dimensions)
+        if "orientation" in params:
+            lamp.set_orientation(params["orientation"], dimensions=variant.dimensions)
+        if "rotation" in params:
+            lamp.rotate(params["rotation"])
+        variant.lamps[lamp.lamp_id] = lamp
+    return variant
+
+
+def _resize_standard_zones(room):
+    """same as `update_room` does to the special zones when the room is resized"""
+    zones = room.calc_zones
+    if "WholeRoomFluence" in zones:
+        zones["WholeRoomFluence"].set_dimensions(x2=room.x, y2=room.y, z2=room.z)
+    for zone_id in ["SkinLimits", "EyeLimits"]:
+        if zone_id in zones:
+            zones[zone_id].set_dimensions(x2=room.x, y2=room.y)
+
+
+def evaluate_variant(room, lamp_id, params, cancel_event=None):
+    """one row of a sweep's results: the parameters, then each metric"""
+    variant = apply_parameters(room, lamp_id, params)
+    calculate_room(variant, cancel_event=cancel_event)
+    results = room_results(variant)
+    return {**params, **{key: results.get(key, np.nan) for key in METRICS}}
+
+
+class SweepJob(BackgroundJob):
+    """
+    A parameter sweep running in the background on a snapshot of a room.
+
+    Every combination of the values in `ranges` is applied to a copy of the
+    room and calculated, several at once. They all go through the shared
+    ContributionCache, so lamp/zone pairs that a combination leaves alone -
+    the room's other lamps, or the first copies of the lamp when only the
+    count changes - are computed once for the whole sweep, and again not at
+    all if it's rerun with some of the same values. Rows are added to `rows`
+    as combinations finish.
+    """
+
+    label = "sweep"
+
+    def __init__(self, room, lamp_id, ranges):
+        super().__init__()
+        self.num_points = check_ranges(ranges)
+        self.room = snapshot_room(room)
+        self.lamp_id = lamp_id
+        self.ranges = ranges
+        self.points = sweep_points(ranges)
+        self.rows = {}
+        self._start()
+
+    def _run(self):
+        evaluate = session_bound(evaluate_variant)
+        futures = {
+            get_sweep_executor().submit(
+                evaluate, self.room, self.lamp_id, params, self._cancel_event
+            ): i
+            for i, params in enumerate(self.points)
+        }
+        try:
+            for future in as_completed(futures):
+                self.rows[futures[future]] = future.result()
+                self.progress = len(self.rows) / len(self.points)
+        finally:
+            for future in futures:
+                future.cancel()
+        self.finished_at = time.monotonic()
+        return self.results
+
+    @property
+    def results(self):
+        """the finished rows, in sweep order, as a DataFrame"""
+        rows = [self.rows[i] for i in sorted(self.rows)]
+        columns = list(self.ranges) + list(METRICS)
+        return pd.DataFrame(rows, columns=columns)
+
+
+def sweep_slice(results, x, y=None, fixed=None):
+    """
+    {metric: table} of each metric over parameters `x` (columns) and `y`
+    (rows), with any other swept parameters held at the values in `fixed`
+    """
+    df = results
+    for param, val in (fixed or {}).items():
+        df = df[np.isclose(df[param], val)]
+    if y is None:
+        y = "_"
+        df = df.assign(_="")
+    return {
+        metric: df.pivot_table(index=y, columns=x, values=metric, aggfunc="mean")
+        for metric in METRICS
+    }
@@ -0,0 +1,201 @@
+import streamlit as st
+from app._figures import session_figures
+from app._plot import plot_sweep
+from app._sweep import (
+    LAMP_PARAMETERS,
+    METRICS,
+    PARAMETER_LABELS,
+    ROOM_PARAMETERS,
+    SweepJob,
+    check_ranges,
+    default_settings,
+    sweep_slice,
+    sweep_values,
+)
+from app._widget import close_sidebar, initialize_sweep, update_sweep_settings
+
+ss = st.session_state
+
+
+def show_sweep(room):
+    """update sidebar to show the parameter sweep for the selected luminaire"""
+    ss.sweep_lamp_id = ss.selected_lamp_id
+    if "sweep_settings" not in ss:
+        ss.sweep_settings = default_settings(room, room.lamps[ss.sweep_lamp_id])
+    ss.editing = "sweep"
+
+
+def sweep_ranges():
+    """{param: values} for every parameter switched on in the sweep settings"""
+    return {
+        param: sweep_values(setting["min"], setting["max"], setting["steps"], param)
+        for param, setting in ss.sweep_settings.items()
+        if setting["on"]
+    }
+
+
+def start_sweep(room):
+    """start sweeping in the background, replacing any sweep already running"""
+    job = ss.get("sweep_job")
+    if job is not None and job.running:
+        job.cancel()
+    ss.sweep_job = SweepJob(room, ss.sweep_lamp_id, sweep_ranges())
+
+
+def cancel_sweep():
+    job = ss.get("sweep_job")
+    if job is not None:
+        job.cancel()
+
+
+def sweep_sidebar(room):
+    """sidebar content for sweeping lamp and room parameters"""
+    cols = st.columns([10, 1])
+    cols[0].subheader("Parameter Sweep")
+    cols[1].button(
+        "X",
+        on_click=close_sidebar,
+        args=[room],
+        use_container_width=True,
+        key="close_sweep",
+    )
+    lamp = room.lamps.get(ss.sweep_lamp_id)
+    if lamp is None:
+        st.warning("The luminaire being swept has been removed.")
+        return
+
+    initialize_sweep()
+    st.write(
+        f"Calculate every combination of the parameters below for **{lamp.name}** and the room. Other luminaires stay where they are."
+    )
+    st.subheader("Luminaire", divider="grey")
+    for param in LAMP_PARAMETERS:
+        sweep_range_inputs(param)
+    st.subheader("Room", divider="grey")
+    for param in ROOM_PARAMETERS:
+        sweep_range_inputs(param)
+
+    ranges = sweep_ranges()
+    try:
+        num_points = check_ranges(ranges) if ranges else 0
+        problem = None if ranges else "Select at least one parameter to sweep."
+    except ValueError as e:
+        num_points, problem = 0, str(e)
+    if problem is not None:
+        st.warning(problem)
+    else:
+        st.caption(f"{num_points} combinations")
+    st.button(
+        "Run Sweep",
+        on_click=start_sweep,
+        args=[room],
+        type="primary",
+        use_container_width=True,
+        disabled=problem is not None,
+        key="run_sweep",
+    )
+    sweep_status()
+
+
+def sweep_range_inputs(param):
+    """checkbox to sweep a parameter, and the range to sweep it over"""
+    is_count = param == "count"
+    cols = st.columns([3, 2, 2, 2])
+    cols[0].checkbox(
+        PARAMETER_LABELS[param],
+        on_change=update_sweep_settings,
+        key=f"sweep_{param}_on",
+    )
+    disabled = not ss[f"sweep_{param}_on"]
+    for col, field, label in zip(
+        cols[1:], ["min", "max", "steps"], ["From", "To", "Steps"]
+    ):
+        col.number_input(
+            label,
+            min_value=1 if is_count or field == "steps" else None,
+            step=1 if is_count or field == "steps" else 0.1,
+            on_change=update_sweep_settings,
+            disabled=disabled,
+            label_visibility="collapsed" if param != LAMP_PARAMETERS[0] else "visible",
+            key=f"sweep_{param}_{field}",
+        )
+
+
+def sweep_status():
+    """progress of the sweep while it runs, and its table and heatmaps once done"""
+    job = ss.get("sweep_job")
+    if job is None:
+        return
+    if job.running:
+        sweep_progress()
+    elif job.error is not None:
+        st.error(f"Sweep failed: {job.error}")
+    elif job.cancelled:
+        st.info("Sweep cancelled.")
+    elif job.succeeded:
+        sweep_results(job)
+
+
+@st.experimental_fragment(run_every=0.5)
+def sweep_progress():
+    """progress bar and cancel button, polled while the sweep runs"""
+    job = ss.get("sweep_job")
+    if job is None:
+        return
+    if job.running:
+        cols = st.columns([6, 1])
+        cols[0].progress(
+            job.progress, text=f"Sweeping... {len(job.rows)} of {job.num_points}"
+        )
+        cols[1].button(
+            "Cancel",
+            on_click=cancel_sweep,
+            use_container_width=True,
+            key="cancel_sweep",
+        )
+    else:
+        st.rerun()
+
+
+def sweep_results(job):
+    """the results table, and heatmaps over any two swept parameters"""
+    st.subheader("Results", divider="grey")
+    results = job.results
+    st.caption(f"{job.num_points} combinations in {round(job.elapsed, 1)} seconds")
+    labels = {param: PARAMETER_LABELS[param] for param in job.ranges}
+    table = results.rename(columns={**labels, **METRICS})
+    st.dataframe(table.round(3), hide_index=True)
+    st.download_button(
+        "Download CSV",
+        data=table.to_csv(index=False),
+        file_name="sweep.csv",
+        use_container_width=True,
+        key="download_sweep",
+    )
+
+    params = list(job.ranges)
+    cols = st.columns(2)
+    x = cols[0].selectbox(
+        "Heatmap X axis", params, format_func=labels.get, key="sweep_heatmap_x"
+    )
+    y_options = [None] + [param for param in params if param != x]
+    y = cols[1].selectbox(
+        "Heatmap Y axis",
+        y_options,
+        index=min(1, len(y_options) - 1),
+        format_func=lambda param: "None" if param is None else labels[param],
+        key="sweep_heatmap_y",
+    )
+    fixed = {}
+    for param in params:
+        if param not in [x, y]:
+            fixed[param] = st.select_slider(
+                labels[param], job.ranges[param], key=f"sweep_fixed_{param}"
+            )
+    key = (id(job), x, y, tuple(fixed.items()))
+    figures = session_figures()
+    fig = figures.get("sweep", key)
+    if fig is None:
+        tables = sweep_slice(results, x, y, fixed)
+        fig = figures.put("sweep", plot_sweep(tables, labels[x], y and labels[y]), key)
+    st.pyplot(fig)
@@ -1,7 +1,8 @@
 import streamlit as st
 from guv_calcs.calc_zone import CalcPlane, CalcVol
-from app._website_helpers import add_new_lamp, add_new_zone, get_disinfection_table
-from app._plot import plot_species
+from app._website_helpers import add_new_lamp, add_new_zone
+from app._calculate import room_key
+from app._jobs import CalcJob
 from app._widget import (
     initialize_lamp,
     initialize_zone,
@@ -126,13 +127,19 @@ def update_zone_select(zone_names, room):
 
 
 def calculate(room):
-    """calculate and show results in right pane"""
+    """start calculating in the background and show results in right pane"""
     ss.show_results = True
     initialize_results(room)
-    room.calculate()
-    # format the figure and disinfection table now so we don't redo it later
-    fluence = room.calc_zones["WholeRoomFluence"]
-    if fluence.values is not None:
-        avg_fluence = fluence.values.mean()
-        ss.kdf = get_disinfection_table(avg_fluence, room)
-        ss.kfig = plot_species(ss.kdf, avg_fluence)
+    key = room_key(room)
+    job = ss.get("calc_job")
+    if job is not None and job.key == key and not job.cancelled:
+        if job.running or (job.succeeded and not job.partial):
+            # nothing has changed since this job was started, so reuse it
+            return
+    if job is not None and job.running:
+        job.cancel()
+    ss.calc_job = CalcJob(
+        room,
+        progressive=ss.calc_settings["progressive"],
+        deadline=ss.calc_settings["deadline"] or None,
+    )
@@ -0,0 +1,230 @@
+import os
+import time
+import uuid
+import atexit
+import shutil
+import logging
+import threading
+import weakref
+from functools import lru_cache
+from pathlib import Path
+from ._blob_cache import content_hash
+from ._catalog import CACHE_DIR
+from ._metrics import get_metrics, stats_gauges
+
+logger = logging.getLogger(__name__)
+
+UPLOAD_DIR = CACHE_DIR / "uploads"
+# bytes of uploaded files each session may hold; a file counts once per session
+SESSION_QUOTA_BYTES = 16 * 1024 ** 2
+# another process's upload directory left untouched this long is assumed to
+# have been left behind by one that didn't exit cleanly
+ORPHAN_SECONDS = 24 * 3600
+
+
+class QuotaExceeded(ValueError):
+    """Raised when an upload would take a session over its quota."""
+
+
+class UploadMissing(LookupError):
+    """Raised when a session's upload can no longer be read from the store."""
+
+
+class UploadStore:
+    """
+    Shared on-disk store for user-uploaded lamp files, by content hash.
+
+    Sessions hold references to files rather than their bytes, so a file
+    uploaded by any number of sessions is stored once, and is deleted when
+    the last session holding it lets go of it. Each session may hold at most
+    `quota_bytes`. References only live as long as the process, so each
+    process stores its files in a directory of its own under `root`, removed
+    by `close`; directories of other processes that haven't been touched for
+    ORPHAN_SECONDS are cleared on startup.
+    """
+
+    def __init__(self, root=UPLOAD_DIR, quota_bytes=SESSION_QUOTA_BYTES):
+        self.root = Path(root)
+        self.directory = self.root / f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.quota_bytes = quota_bytes
+        self._lock = threading.Lock()
+        self._sizes = {}  # hash -> size
+        self._refs = {}  # hash -> owners holding it
+        self._held = {}  # owner -> hashes it holds
+        self.uploads = 0
+        self.deduplicated = 0
+        self._clear_orphans()
+
+    def put(self, owner, data):
+        """store `data` for `owner`; returns its content hash"""
+        digest = content_hash(data)
+        with self._lock:
+            held = self._held.setdefault(owner, set())
+            self.uploads += 1
+            if digest in held:
+                return digest
+            used = sum(self._sizes[d] for d in held)
+            if used + len(data) > self.quota_bytes:
+                raise QuotaExceeded(
+                    f"uploads are limited to {self.quota_bytes // 1024 ** 2} MB per session"
+                )
+            if digest in self._sizes:
+                self.deduplicated += 1
+            else:
+                self._write(digest, data)
+            self._refs.setdefault(digest, set()).add(owner)
+            held.add(digest)
+        return digest
+
+    def get(self, digest):
+        """the bytes of a stored file, or None if nobody holds it any more"""
+        try:
+            data = (self.directory / digest).read_bytes()
+            os.utime(self.directory)  # in use; see _clear_orphans
+        except OSError:
+            return None
+        return data
+
+    def release(self, owner, digest):
+        """`owner` no longer needs the file; it's deleted if nobody else does"""
+        with self._lock:
+            self._held.get(owner, set()).discard(digest)
+            owners = self._refs.get(digest)
+            if owners is None:
+                return
+            owners.discard(owner)
+            if not owners:
+                self._delete(digest)
+
+    def release_all(self, owner):
+        """let go of everything `owner` holds, e.g. once its session has ended"""
+        with self._lock:
+            held = self._held.pop(owner, set())
+        for digest in held:
+            self.release(owner, digest)
+
+    def used_bytes(self, owner):
+        with self._lock:
+            return sum(self._sizes[d] for d in self._held.get(owner, ()))
+
+    def stats(self):
+        """stored and referenced bytes, for sizing the quota"""
+        with self._lock:
+            stored = sum(self._sizes.values())
+            referenced = sum(self._sizes[d] * len(o) for d, o in self._refs.items())
+            return {
+                "files": len(self._sizes),
+                "bytes": stored,
+                "referenced_bytes": referenced,
+                "sessions": len(self._held),
+                "uploads": self.uploads,
+                "deduplicated": self.deduplicated,
+            }
+
+    def close(self):
+        """delete every file this process stored, e.g. at exit"""
+        with self._lock:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self._sizes.clear()
+            self._refs.clear()
+            self._held.clear()
+
+    def _clear_orphans(self):
+        """remove other processes' directories that have been left untouched"""
+        if not self.root.is_dir():
+            return
+        cutoff = time.time() - ORPHAN_SECONDS
+        for path in self.root.iterdir():
+            try:
+                if path.is_dir() and path.stat().st_mtime < cutoff:
+                    shutil.rmtree(path, ignore_errors=True)
+            except OSError:
+                pass
+
+    def _write(self, digest, data):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.directory / f"{digest}.tmp"
+        tmp_path.write_bytes(data)
+        tmp_path.replace(self.directory / digest)
+        self._sizes[digest] = len(data)
+
+    def _delete(self, digest):
+        self._sizes.pop(digest, None)
+        self._refs.pop(digest, None)
+        try:
+            (self.directory / digest).unlink()
+        except OSError as e:
+            logger.warning(f"Could not delete upload {digest}: {e}")
+
+
+@lru_cache(maxsize=None)
+def get_upload_store():
+    """the one UploadStore shared by every session in this process; cleared at exit"""
+    store = UploadStore()
+    atexit.register(store.close)
+    get_metrics().add_collector(
+        lambda: stats_gauges("process_uploads", store.stats(), "Uploaded files")
+    )
+    return store
+
+
+class SessionUploads:
+    """
+    The lamp files one session has uploaded, by name: content hashes of ies
+    files, and of spectra uploaded for them, in the shared UploadStore. The
+    session's references are released once this is garbage collected, which
+    happens when Streamlit drops an expired session's state.
+    """
+
+    def __init__(self, store=None):
+        self.store = get_upload_store() if store is None else store
+        self.owner = uuid.uuid4().hex
+        self.files = {}  # name -> ies file hash
+        self.spectra = {}  # name -> spectrum hash
+        weakref.finalize(self, self.store.release_all, self.owner)
+
+    def __contains__(self, name):
+        return name in self.files
+
+    def names(self):
+        return list(self.files)
+
+    def add_file(self, name, data):
+        """keep an ies file under `name`; raises QuotaExceeded"""
+        self._add(self.files, name, data)
+
+    def add_spectra(self, name, data):
+        """
+        keep a spectrum for the uploaded ies file `name`; raises QuotaExceeded,
+        or KeyError if no ies file was uploaded under that name, as a spectrum
+        could never be found again for it
+        """
+        if name not in self.files:
+            raise KeyError(f"No ies file {name} has been uploaded")
+        self._add(self.spectra, name, data)
+
+    def file_data(self, name):
+        """
+        (ies data, spectrum data or None) uploaded under `name`; raises
+        UploadMissing if either can't be read back from the store
+        """
+        fdata = self._read(self.files[name], name)
+        digest = self.spectra.get(name)
+        spectra_data = None if digest is None else self._read(digest, name)
+        return fdata, spectra_data
+
+    def used_bytes(self):
+        return self.store.used_bytes(self.owner)
+
+    def _read(self, digest, name):
+        data = self.store.get(digest)
+        if data is None:
+            raise UploadMissing(f"{name} is no longer available")
+        return data
+
+    def _add(self, names, name, data):
+        old = names.get(name)
+        names[name] = self.store.put(self.owner, data)
+        in_use = list(self.files.values()) + list(self.spectra.values())
+        if old is not None and old not in in_use:
+            self.store.release(self.owner, old)
@@ -1,7 +1,10 @@
 import streamlit as st
-import requests
-import matplotlib.pyplot as plt
 from guv_calcs.calc_zone import CalcPlane, CalcVol
+from app._blob_cache import fetch_lamp_files
+from app._fetch import UpstreamUnavailable
+from app._figures import session_figures
+from app._photometry import load_lamp_file, load_lamp_spectra
+from app._uploads import UploadMissing
 
 ss = st.session_state
 
@@ -20,27 +23,73 @@ def close_results():
     ss.show_results = False
 
 
+def cancel_calculation():
+    """stop the running calculation; whatever results were shown stay shown"""
+    job = ss.get("calc_job")
+    if job is not None:
+        job.cancel()
+
+
+def get_lamp_file_data(fname):
+    """
+    (ies data, spectrum data) for a lamp file option, either of which may be
+    None. raises UpstreamUnavailable if it's from the osluv server and can't
+    be downloaded right now, or UploadMissing if it was uploaded and can't be
+    read back.
+    """
+    if fname in ss.vendored_spectra.keys():
+        # files from osluv server
+        return fetch_lamp_files(ss.vendored_lamps[fname], ss.vendored_spectra[fname])
+    if fname in ss.uploaded_files:
+        # previously uploaded files
+        return ss.uploaded_files.file_data(fname)
+    return None, None
+
+
 def update_lamp_filename(lamp):
     """update lamp filename from widget"""
     fname = ss[f"file_{lamp.lamp_id}"]
     spectra_data = None
     fdata = None
     if fname != SELECT_LOCAL:
-        if fname in ss.vendored_spectra.keys():
-            # files from osluv server
-            lampdata = ss.vendored_lamps[fname]
-            fdata = requests.get(lampdata).content
-            spectra_source = ss.vendored_spectra[fname]
-            spectra_data = requests.get(spectra_source).content
-        elif fname in ss.uploaded_files.keys():
-            # previously uploaded files
-            fdata = ss.uploaded_files[fname]
-
-    lamp.reload(filename=fname, filedata=fdata)
-    lamp.load_spectra(spectra_data)
+        try:
+            fdata, spectra_data = get_lamp_file_data(fname)
+        except UpstreamUnavailable:
+            st.warning(
+                f"{fname} could not be downloaded right now. Please try again shortly."
+            )
+            fname = None
+            ss[f"file_{lamp.lamp_id}"] = None
+        except UploadMissing as e:
+            st.warning(f"{e}. Please upload it again.")
+            fname = None
+            ss[f"file_{lamp.lamp_id}"] = None
+
+    load_lamp_file(lamp, filename=fname, filedata=fdata)
+    load_lamp_spectra(lamp, spectra_data)
     if len(lamp.spectra) > 0:
-        fig, ax = plt.subplots()
-        ss.spectrafig = lamp.plot_spectra(fig=fig, title="")
+        lamp.plot_spectra(fig=session_figures().reuse("spectra"), title="")
+    else:
+        session_figures().discard("spectra")
+
+
+def update_calc_settings():
+    """update how calculations are run from the room editing widgets"""
+    ss.calc_settings["progressive"] = ss["calc_progressive"]
+    ss.calc_settings["deadline"] = ss["calc_deadline"]
+
+
+def update_sweep_settings():
+    """update the parameter sweep ranges from the sweep widgets"""
+    for param, setting in ss.sweep_settings.items():
+        for field in setting:
+            setting[field] = ss[f"sweep_{param}_{field}"]
+
+
+def update_optimize_settings():
+    """update the layout optimizer settings from its widgets"""
+    for field in ss.optimize_settings:
+        ss.optimize_settings[field] = ss[f"optimize_{field}"]
 
 
 def update_room(room):
@@ -124,6 +173,8 @@ def initialize_room(room):
         "ozone_decay_constant",
         "air_changes_results",
         "ozone_decay_constant_results",
+        "calc_progressive",
+        "calc_deadline",
     ]
     vals = [
         room.x,
@@ -140,10 +191,29 @@ def initialize_room(room):
         room.ozone_decay_constant,
         room.air_changes,
         room.ozone_decay_constant,
+        ss.calc_settings["progressive"],
+        ss.calc_settings["deadline"],
     ]
     add_keys(keys, vals)
 
 
+def initialize_sweep():
+    """initialize parameter sweep widgets with the present ranges"""
+    keys = []
+    vals = []
+    for param, setting in ss.sweep_settings.items():
+        for field, val in setting.items():
+            keys.append(f"sweep_{param}_{field}")
+            vals.append(val)
+    add_keys(keys, vals)
+
+
+def initialize_optimize():
+    """initialize layout optimizer widgets with the present settings"""
+    keys = [f"optimize_{field}" for field in ss.optimize_settings]
+    add_keys(keys, list(ss.optimize_settings.values()))
+
+
 def initialize_lamp(lamp):
     """initialize lamp editing widgets with their present values"""
     keys = [
@@ -1,13 +1,19 @@
+import time
 import streamlit as st
-import requests
-import matplotlib.pyplot as plt
-import plotly.graph_objs as go
 from guv_calcs.room import Room
 from app._top_ribbon import top_ribbon, calculate
 from app._plot import room_plot
 from app._results import results_page
 from app._lamp_sidebar import lamp_sidebar
 from app._zone_sidebar import zone_sidebar
+from app._sweep_sidebar import sweep_sidebar
+from app._optimize_sidebar import optimize_sidebar
+from app._blob_cache import fetch_lamp_files
+from app._figures import session_figures
+from app._metrics import count, record_stage, span, start_metrics_server
+from app._photometry import load_lamp_file, load_lamp_spectra
+from app._profile import session_profiler
+from app._uploads import SessionUploads
 from app._sidebar import (
     room_sidebar,
     default_sidebar,
@@ -55,6 +61,15 @@ st.markdown(
 
 ss = st.session_state
 
+rerun_started = time.perf_counter()
+start_metrics_server()
+count("guv_reruns_total")
+
+# only for sessions opened with ?profile=1
+profiler = session_profiler()
+if profiler is not None:
+    profiler.start()
+
 SELECT_LOCAL = "Select local file..."
 CONTACT_STR = (
     "Questions? Comments? Found a bug? Want a feature? Contact contact-assay@osluv.org"
@@ -74,15 +89,20 @@ if "selected_zone_id" not in ss:
     ss.selected_zone_id = None  # use None when no lamp is selected
 
 if "uploaded_files" not in ss:
-    ss.uploaded_files = {}
+    ss.uploaded_files = SessionUploads()
+
+if "calc_settings" not in ss:
+    # deadline is in seconds; 0 means no deadline
+    ss.calc_settings = {"progressive": True, "deadline": 0.0}
 
 if "lampfile_options" not in ss:
     ies_files = get_local_ies_files()  # local files for testing
-    (
-        index_data,
-        vendored_lamps,
-        vendored_spectra,
-    ) = get_ies_files()  # files from assays.osluv.org
+    with span("catalog"):
+        (
+            index_data,
+            vendored_lamps,
+            vendored_spectra,
+        ) = get_ies_files()  # files from assays.osluv.org
     ss.index_data, ss.vendored_lamps, ss.vendored_spectra = (
         index_data,
         vendored_lamps,
@@ -92,27 +112,9 @@ if "lampfile_options" not in ss:
     ss.lampfile_options = options
     ss.spectra_options = []
 
-if "fig" not in ss:
-    ss.fig = go.Figure()
-    # Adding an empty scatter3d trace to make the plot appear correctly
-    ss.fig.add_trace(
-        go.Scatter3d(
-            x=[0],  # No data points yet
-            y=[0],
-            z=[0],
-            opacity=0,
-            showlegend=False,
-            customdata=["placeholder"],
-        )
-    )
-    ss.eyefig = plt.figure()
-    ss.skinfig = plt.figure()
-    ss.spectrafig, _ = plt.subplots()
-    ss.kfig = None
+if "kdf" not in ss:
     ss.kdf = None
 
-fig = ss.fig
-
 if "room" not in ss:
     ss.room = Room()
     ss.room = add_standard_zones(ss.room)
@@ -126,14 +128,13 @@ if "room" not in ss:
             ss.room, name=preview_lamp, interactive=False, defaults=defaults
         )
         lamp = ss.room.lamps[lamp_id]
-        # load ies data
-        fdata = requests.get(ss.vendored_lamps[preview_lamp]).content
-        lamp.reload(filename=preview_lamp, filedata=fdata)
-        # load spectra
-        spectra_data = requests.get(ss.vendored_spectra[preview_lamp]).content
-        lamp.load_spectra(spectra_data)
-        fig, ax = plt.subplots()
-        ss.spectrafig = lamp.plot_spectra(fig=fig, title="")
+        # load ies data and spectra
+        fdata, spectra_data = fetch_lamp_files(
+            ss.vendored_lamps[preview_lamp], ss.vendored_spectra[preview_lamp]
+        )
+        load_lamp_file(lamp, filename=preview_lamp, filedata=fdata)
+        load_lamp_spectra(lamp, spectra_data)
+        lamp.plot_spectra(fig=session_figures().reuse("spectra"), title="")
         # calculate and display results
         calculate(ss.room)  # normally a callback
         ss.editing = None  # just for aesthetics
@@ -141,7 +142,8 @@ if "room" not in ss:
 
 room = ss.room
 
-top_ribbon(room)
+with span("top_ribbon"):
+    top_ribbon(room)
 
 if ss.show_results or ss.editing is not None:
     left_pane, right_pane = st.columns([2, 3])
@@ -151,31 +153,43 @@ else:
 
 with left_pane:
     if ss.editing is not None:
-        if ss.editing == "lamps" and ss.selected_lamp_id is not None:
-            lamp_sidebar(room)
-        elif ss.editing in ["zones", "planes", "volumes"] and ss.selected_zone_id:
-            zone_sidebar(room)
-        elif ss.editing == "room":
-            room_sidebar(room)
-        elif ss.editing == "about":
-            default_sidebar(room)
-        elif ss.editing == "project":
-            project_sidebar(room)
-        else:
-            st.write("")
+        with span("sidebar", panel=ss.editing):
+            if ss.editing == "lamps" and ss.selected_lamp_id is not None:
+                lamp_sidebar(room)
+            elif ss.editing in ["zones", "planes", "volumes"] and ss.selected_zone_id:
+                zone_sidebar(room)
+            elif ss.editing == "room":
+                room_sidebar(room)
+            elif ss.editing == "about":
+                default_sidebar(room)
+            elif ss.editing == "project":
+                project_sidebar(room)
+            elif ss.editing == "sweep":
+                sweep_sidebar(room)
+            elif ss.editing == "optimize":
+                optimize_sidebar(room)
+            else:
+                st.write("")
         if ss.show_results:
             # add this here since it'll look nicer than on the results side
             st.write(CONTACT_STR)
     else:
         if ss.show_results:
-            room_plot(room)
+            with span("room_plot"):
+                room_plot(room)
             st.write(CONTACT_STR)
 
         # if not ss.show_results, then this is an empty panel
 
 with right_pane:
     if ss.show_results:
-        results_page(room)
+        with span("results_page"):
+            results_page(room)
     else:
-        room_plot(room)
+        with span("room_plot"):
+            room_plot(room)
         st.write(CONTACT_STR)
+
+record_stage("rerun", time.perf_counter() - rerun_started)
+if profiler is not None:
+    profiler.finish()
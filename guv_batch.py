@@ -0,0 +1,58 @@
+import sys
+import argparse
+from app._batch import BATCH_PROCESSES, open_writer, read_specs, run_batch
+
+EPILOG = """
+examples:
+  python guv_batch.py specs/ -o results.parquet
+  python guv_batch.py rooms.jsonl --processes 8 > results.jsonl
+
+run from the repository root. see `build_room` in app/_batch.py for the spec format.
+"""
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Calculate many rooms without the web app, streaming the results as they finish.",
+        epilog=EPILOG,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument(
+        "specs", help="a directory of .json/.jsonl room specs, or one such file"
+    )
+    parser.add_argument(
+        "-o", "--output", help="file to write results to (default: stdout, as JSONL)"
+    )
+    parser.add_argument(
+        "-f",
+        "--format",
+        choices=["jsonl", "parquet"],
+        help="output format (default: parquet if the output ends .parquet, else JSONL)",
+    )
+    parser.add_argument(
+        "-p",
+        "--processes",
+        type=int,
+        default=BATCH_PROCESSES,
+        help=f"worker processes (default: {BATCH_PROCESSES})",
+    )
+    args = parser.parse_args(argv)
+    if args.format == "parquet" and args.output is None:
+        parser.error("parquet output needs --output")
+
+    specs = list(read_specs(args.specs))
+    writer = open_writer(args.output, args.format)
+    failed = 0
+    try:
+        for n, result in enumerate(run_batch(specs, processes=args.processes), 1):
+            writer.write(result)
+            failed += result["error"] is not None
+            status = result["error"] or f"done in {round(result['elapsed'], 2)}s"
+            print(f"[{n}/{len(specs)}] {result['id']}: {status}", file=sys.stderr)
+    finally:
+        writer.close()
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
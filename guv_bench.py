@@ -0,0 +1,97 @@
+import sys
+import argparse
+from app._bench import (
+    BENCH_REPEATS,
+    REGRESSION_THRESHOLD,
+    SUITES,
+    compare,
+    load_results,
+    run_benchmarks,
+    save_results,
+)
+
+EPILOG = """
+examples:
+  python guv_bench.py -o baseline.json
+  python guv_bench.py -o current.json --compare baseline.json
+  python guv_bench.py --suite calculate -k spacing=0.1
+
+run from the repository root. exits with status 1 if --compare finds a regression,
+or if no benchmarks match --suite and --match.
+"""
+
+
+def _ms(seconds):
+    return "-" if seconds is None else f"{seconds * 1000:.2f} ms"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Time the calculation, results and placement hot paths, and compare against a baseline.",
+        epilog=EPILOG,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument("-o", "--output", help="file to write the timings to, as JSON")
+    parser.add_argument(
+        "-c", "--compare", help="a previous --output to compare the timings against"
+    )
+    parser.add_argument(
+        "-s",
+        "--suite",
+        action="append",
+        choices=list(SUITES),
+        help="only run these suites (default: all); may be repeated",
+    )
+    parser.add_argument(
+        "-k", "--match", help="only run benchmarks whose names contain this"
+    )
+    parser.add_argument(
+        "-r",
+        "--repeats",
+        type=int,
+        default=BENCH_REPEATS,
+        help=f"times to run each benchmark (default: {BENCH_REPEATS})",
+    )
+    parser.add_argument(
+        "-t",
+        "--threshold",
+        type=float,
+        default=REGRESSION_THRESHOLD,
+        help=f"fraction slower than the baseline that counts as a regression (default: {REGRESSION_THRESHOLD})",
+    )
+    args = parser.parse_args(argv)
+    baseline = load_results(args.compare) if args.compare else None
+
+    def log(name, timings):
+        print(
+            f"{name}: best {_ms(timings['min'])}, median {_ms(timings['median'])}",
+            file=sys.stderr,
+        )
+
+    results = run_benchmarks(args.suite, args.match, args.repeats, log=log)
+    if not results:
+        print("no benchmarks matched", file=sys.stderr)
+        return 1
+    if args.output:
+        save_results(results, args.output)
+    if baseline is None:
+        return 0
+
+    if args.suite or args.match:
+        # benchmarks that weren't run aren't missing
+        baseline = {name: val for name, val in baseline.items() if name in results}
+    rows = compare(results, baseline, args.threshold)
+    width = max(len(row["name"]) for row in rows)
+    for row in rows:
+        ratio = "" if row["ratio"] is None else f"x{row['ratio']:.2f}"
+        print(
+            f"{row['name']:<{width}}  {_ms(row['baseline']):>12}  {_ms(row['current']):>12}  {ratio:>6}  {row['status']}"
+        )
+    regressions = [row for row in rows if row["status"] == "regression"]
+    if regressions:
+        print(f"{len(regressions)} regression(s)", file=sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,56 @@
+import pytest
+import requests
+from app import _fetch
+from app._fetch import CircuitBreaker, UpstreamUnavailable, http_get
+
+URL = "https://assay.example/index.json"
+
+
+class FakeSession:
+    """stands in for the pooled session, raising `error` from every GET"""
+
+    def __init__(self, error):
+        self.error = error
+        self.calls = 0
+
+    def get(self, url, headers=None, timeout=None):
+        self.calls += 1
+        raise self.error
+
+
+@pytest.fixture
+def breaker(monkeypatch):
+    # opens on the first failure, and lets a trial through straight away
+    breaker = CircuitBreaker(threshold=1, cooldown=0)
+    monkeypatch.setattr(_fetch, "get_breaker", lambda: breaker)
+    return breaker
+
+
+@pytest.mark.parametrize(
+    "error",
+    [
+        requests.exceptions.ChunkedEncodingError("truncated"),
+        requests.exceptions.ContentDecodingError("bad gzip"),
+        requests.exceptions.TooManyRedirects("loop"),
+    ],
+)
+def test_failed_trial_lets_the_next_trial_through(monkeypatch, breaker, error):
+    session = FakeSession(error)
+    monkeypatch.setattr(_fetch, "get_session", lambda: session)
+    for _ in range(3):
+        with pytest.raises(UpstreamUnavailable):
+            http_get(URL)
+    # the first request opens the circuit; each later one is a trial
+    assert session.calls == 3
+    assert breaker.is_open
+
+
+def test_unexpected_error_still_ends_the_trial(monkeypatch, breaker):
+    session = FakeSession(RuntimeError("boom"))
+    monkeypatch.setattr(_fetch, "get_session", lambda: session)
+    breaker.record_failure()  # open, so the requests below are trials
+    for _ in range(2):
+        with pytest.raises(RuntimeError):
+            http_get(URL)
+    assert session.calls == 2
+    assert breaker.allow()
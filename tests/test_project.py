@@ -0,0 +1,69 @@
+import io
+import struct
+import zipfile
+import numpy as np
+import pytest
+from app._batch import build_room
+from app._calculate import calculate_room
+from app._project import ProjectError, load_project, save_project
+
+ROOM = {
+    "lamps": [{"file": "uvpro222_b1"}],
+    "standard_zones": False,
+    "zones": [
+        {
+            "type": "plane",
+            "zone_id": "Plane",
+            "height": 1.0,
+            "x1": 0,
+            "x2": 4,
+            "y1": 0,
+            "y2": 5,
+            "x_spacing": 0.5,
+            "y_spacing": 0.5,
+        }
+    ],
+}
+
+
+@pytest.fixture(scope="module")
+def project():
+    room = build_room(ROOM)
+    calculate_room(room)
+    return room, save_project(room)
+
+
+def corrupt_member(data, name):
+    """the project with one byte flipped in the middle of a member's data"""
+    info = zipfile.ZipFile(io.BytesIO(data)).getinfo(name)
+    offset = info.header_offset
+    # the local header is 30 bytes, then the name and extra field
+    name_len, extra_len = struct.unpack_from("<HH", data, offset + 26)
+    start = offset + 30 + name_len + extra_len
+    damaged = bytearray(data)
+    damaged[start + info.compress_size // 2] ^= 0xFF
+    return bytes(damaged)
+
+
+def test_round_trip(project):
+    room, data = project
+    loaded = load_project(data)
+    zone = loaded.calc_zones["Plane"]
+    np.testing.assert_array_equal(zone.values, room.calc_zones["Plane"].values)
+    assert list(loaded.lamps) == list(room.lamps)
+
+
+def test_corrupted_members_raise_project_error(project):
+    _, data = project
+    names = zipfile.ZipFile(io.BytesIO(data)).namelist()
+    grid = next(name for name in names if name.startswith("grids/"))
+    blob = next(name for name in names if name.startswith("blobs/"))
+    for name in ["project.json", grid, blob]:
+        with pytest.raises(ProjectError):
+            load_project(corrupt_member(data, name))
+
+
+def test_truncated_project_raises_project_error(project):
+    _, data = project
+    with pytest.raises(ProjectError):
+        load_project(data[: len(data) // 2])
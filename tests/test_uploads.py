@@ -0,0 +1,25 @@
+import pytest
+from app._uploads import SessionUploads, UploadMissing, UploadStore
+
+
+@pytest.fixture
+def uploads(tmp_path):
+    return SessionUploads(UploadStore(tmp_path))
+
+
+def test_spectrum_needs_an_uploaded_ies_file(uploads):
+    with pytest.raises(KeyError):
+        uploads.add_spectra("UVPro222 B1", b"wavelength,intensity")
+    assert uploads.used_bytes() == 0
+
+
+def test_lost_upload_raises(uploads):
+    uploads.add_file("lamp.ies", b"IESNA:LM-63-2002")
+    uploads.add_spectra("lamp.ies", b"wavelength,intensity")
+    assert uploads.file_data("lamp.ies") == (
+        b"IESNA:LM-63-2002",
+        b"wavelength,intensity",
+    )
+    uploads.store.close()
+    with pytest.raises(UploadMissing):
+        uploads.file_data("lamp.ies")